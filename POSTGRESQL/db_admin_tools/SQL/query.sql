@@ -3,51 +3,165 @@ CREATE USER USERNAME WITH PASSWORD 'PASSWORD';
 CREATE TABLE IF NOT EXISTS backup_dbs (
     datname TEXT PRIMARY KEY,
     size text,
+    size_bytes BIGINT,
     rank INTEGER,
     status VARCHAR(20) DEFAULT 'PENDING',
     last_backup_date TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    worker_id TEXT,
+    heartbeat_at TIMESTAMP,
+    lease_expires_at TIMESTAMP,
+    fingerprint TEXT,
+    last_success_date TIMESTAMP,
+    verify_status VARCHAR(20),
+    last_verify_date TIMESTAMP,
+    verify_seconds DOUBLE PRECISION,
+    restore_bytes_per_sec DOUBLE PRECISION,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP,
+    last_error TEXT
 );
 
+-- Columnas añadidas después de la primera versión, para instalaciones existentes
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS size_bytes BIGINT;
+
+-- Columnas de reclamación de trabajos para instalaciones existentes
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS worker_id TEXT;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+
+-- Detección de cambios para instalaciones existentes
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS fingerprint TEXT;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS last_success_date TIMESTAMP;
+
+-- Verificación de restauración (verify_backups.py) para instalaciones existentes
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS verify_status VARCHAR(20);
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS last_verify_date TIMESTAMP;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS verify_seconds DOUBLE PRECISION;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS restore_bytes_per_sec DOUBLE PRECISION;
+
+-- Reintentos con backoff para instalaciones existentes
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP;
+ALTER TABLE backup_dbs ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+CREATE INDEX IF NOT EXISTS backup_dbs_status_rank_idx ON backup_dbs (status, rank);
+
 COMMENT ON COLUMN backup_dbs.status IS 'PENDING: Indica que la base de datos está pendiente de ser respaldada.
 IN_PROGRESS: Indica que el proceso de respaldo de la base de datos está en curso.
 SUCCESS: Indica que el respaldo de la base de datos se completó exitosamente.
-FAILED: Indica que el respaldo de la base de datos falló.
+FAILED: Indica que el respaldo de la base de datos falló (error permanente o sin intentos restantes).
+RETRY: Indica que el respaldo falló por un error transitorio y se reintentará a partir de next_attempt_at.
 NO_PERMISSIONS: Indica que el usuario no tiene permisos para respaldar la base de datos.';
 
-CREATE OR REPLACE FUNCTION sync_databases()
-RETURNS VOID AS $$
+COMMENT ON COLUMN backup_dbs.worker_id IS 'Proceso de backup (host:pid o BACKUP_WORKER_ID) que reclamó la base de datos.';
+COMMENT ON COLUMN backup_dbs.size_bytes IS 'Tamaño de la base de datos en bytes (pg_database_size) en la última sincronización. size guarda la versión legible.';
+COMMENT ON COLUMN backup_dbs.fingerprint IS 'md5 de tup_inserted, tup_updated, tup_deleted y stats_reset de pg_stat_database, tomado al iniciar el último backup exitoso.';
+COMMENT ON COLUMN backup_dbs.last_success_date IS 'Fecha del último backup exitoso. Limita cuánto tiempo puede omitirse una base de datos sin cambios.';
+COMMENT ON COLUMN backup_dbs.lease_expires_at IS 'Fin del lease del trabajo IN_PROGRESS. Si expira sin heartbeat, la base de datos vuelve a PENDING.';
+COMMENT ON COLUMN backup_dbs.attempts IS 'Intentos de backup desde la última sincronización o el último SUCCESS. Se incrementa al reclamar la base de datos.';
+COMMENT ON COLUMN backup_dbs.next_attempt_at IS 'Fecha (reloj del proceso de backup) a partir de la cual se puede reclamar una base de datos en RETRY.';
+COMMENT ON COLUMN backup_dbs.verify_status IS 'VERIFIED: El último backup se restauró y sus tablas coinciden con el origen.
+MISMATCH: Se restauró, pero faltan tablas o el número de filas difiere más de lo admitido.
+FAILED: No se encontró el backup o falló el descifrado o pg_restore.';
+COMMENT ON COLUMN backup_dbs.restore_bytes_per_sec IS 'Tamaño de la base restaurada dividido entre el tiempo de pg_restore en la última verificación.';
+
+-- Histórico de trabajos de backup (una fila por intento), escrito por backup_postgres.py y backup_async.py
+CREATE TABLE IF NOT EXISTS backup_history (
+    id BIGSERIAL PRIMARY KEY,
+    datname TEXT NOT NULL,
+    worker_id TEXT,
+    status VARCHAR(20) NOT NULL,
+    attempt INTEGER NOT NULL DEFAULT 1,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL,
+    queue_wait_seconds DOUBLE PRECISION,
+    dump_seconds DOUBLE PRECISION,
+    encrypt_seconds DOUBLE PRECISION,
+    bytes_in BIGINT,
+    bytes_out BIGINT,
+    throughput_bytes_per_sec DOUBLE PRECISION
+);
+
+CREATE INDEX IF NOT EXISTS backup_history_datname_finished_idx ON backup_history (datname, finished_at);
+
+COMMENT ON COLUMN backup_history.bytes_in IS 'Bytes producidos por pg_dump (antes de comprimir y cifrar).';
+COMMENT ON COLUMN backup_history.bytes_out IS 'Bytes escritos en el artefacto final (o chunks nuevos en el modo dedup).';
+COMMENT ON COLUMN backup_history.encrypt_seconds IS 'En modo streaming, tiempo que compresor y gpg siguen trabajando tras terminar pg_dump.';
+
+-- Las versiones anteriores devolvían VOID; eliminarlas evita la ambigüedad con la nueva firma
+DROP FUNCTION IF EXISTS sync_databases();
+DROP FUNCTION IF EXISTS sync_databases(INTERVAL);
+
+-- max_age: tiempo máximo que una base de datos sin cambios puede quedar sin respaldar.
+-- Debe ser menor que RETENTION_DAYS de backup_postgres.py para no quedarse sin backups.
+-- Con max_age = 0 todas las bases de datos vuelven a PENDING.
+-- Devuelve el número de filas insertadas, actualizadas y eliminadas.
+CREATE OR REPLACE FUNCTION sync_databases(max_age INTERVAL DEFAULT INTERVAL '6 days')
+RETURNS TABLE(rows_inserted INTEGER, rows_updated INTEGER, rows_deleted INTEGER) AS $$
 begin
 
-    -- Insertar nuevas bases de datos
-    INSERT INTO backup_dbs (datname, size, status, updated_at)
-    SELECT datname,
-    pg_size_pretty(pg_database_size(datname)) AS size,
-    'PENDING', CURRENT_TIMESTAMP
-    FROM pg_database
-    WHERE datistemplate = false
-    AND datname NOT IN (SELECT datname FROM backup_dbs);
+    -- Tomar una sola vez el tamaño (pg_database_size recorre todo el directorio de la base de datos)
+    -- y el fingerprint de cada base de datos
+    DROP TABLE IF EXISTS pg_temp.sync_snapshot;
+    CREATE TEMP TABLE sync_snapshot ON COMMIT DROP AS
+    SELECT d.datname,
+        pg_database_size(d.datname) AS size_bytes,
+        md5(concat_ws(':', s.tup_inserted, s.tup_updated, s.tup_deleted, s.stats_reset)) AS fingerprint
+    FROM pg_database d
+    LEFT JOIN pg_stat_database s ON s.datname = d.datname
+    WHERE d.datistemplate = false;
+
+    -- Insertar nuevas bases de datos y actualizar tamaño, rank y estado de las existentes.
+    -- Solo pasan a PENDING las que cambiaron desde el último backup exitoso o cuyo último
+    -- backup es más antiguo que max_age; las filas sin cambios no se reescriben.
+    -- Las filas IN_PROGRESS con un lease vigente las está respaldando un trabajador y no se tocan.
+    WITH desired AS (
+        SELECT sn.datname,
+            sn.size_bytes,
+            ROW_NUMBER() OVER (ORDER BY sn.size_bytes ASC) AS rank,
+            CASE
+                WHEN b.status = 'IN_PROGRESS'
+                    AND b.lease_expires_at > CURRENT_TIMESTAMP
+                THEN b.status
+                WHEN b.status = 'SUCCESS'
+                    AND b.fingerprint = sn.fingerprint
+                    AND b.last_success_date > CURRENT_TIMESTAMP - max_age
+                THEN b.status
+                ELSE 'PENDING'
+            END AS status
+        FROM sync_snapshot sn
+        LEFT JOIN backup_dbs b ON b.datname = sn.datname
+    ),
+    upserted AS (
+        INSERT INTO backup_dbs AS b (datname, size, size_bytes, rank, status, updated_at)
+        SELECT datname, pg_size_pretty(size_bytes), size_bytes, rank, status, CURRENT_TIMESTAMP
+        FROM desired
+        ON CONFLICT (datname) DO UPDATE
+        SET size = EXCLUDED.size,
+            size_bytes = EXCLUDED.size_bytes,
+            rank = EXCLUDED.rank,
+            status = EXCLUDED.status,
+            -- Una nueva ejecución empieza con los intentos a cero
+            attempts = CASE WHEN EXCLUDED.status = 'PENDING' THEN 0 ELSE b.attempts END,
+            next_attempt_at = CASE WHEN EXCLUDED.status = 'PENDING' THEN NULL ELSE b.next_attempt_at END,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (b.size_bytes, b.rank, b.status)
+            IS DISTINCT FROM (EXCLUDED.size_bytes, EXCLUDED.rank, EXCLUDED.status)
+        RETURNING (b.xmax = 0) AS is_insert
+    )
+    SELECT count(*) FILTER (WHERE is_insert), count(*) FILTER (WHERE NOT is_insert)
+    INTO rows_inserted, rows_updated
+    FROM upserted;
 
     -- Eliminar bases de datos que ya no existen
-    DELETE FROM backup_dbs
-    WHERE datname NOT IN (
-        SELECT datname
-        FROM pg_database
-        WHERE datistemplate = false
+    DELETE FROM backup_dbs b
+    WHERE NOT EXISTS (
+        SELECT 1 FROM sync_snapshot sn WHERE sn.datname = b.datname
     );
+    GET DIAGNOSTICS rows_deleted = ROW_COUNT;
 
-    -- Actualizar el estado al PENDING y ordenar las bases de datos por el tamaño
-    WITH RankedDatabases AS (
-        SELECT datname,
-            ROW_NUMBER() OVER (ORDER BY pg_database_size(datname) ASC) AS rank
-        FROM pg_database
-        WHERE datistemplate = false
-    )
-    UPDATE backup_dbs
-    SET status = 'PENDING',
-        rank = rd.rank
-    FROM RankedDatabases rd
-    WHERE backup_dbs.datname = rd.datname;
+    RETURN NEXT;
 
 EXCEPTION
     WHEN OTHERS THEN
@@ -56,10 +170,39 @@ EXCEPTION
 END;
 $$ LANGUAGE plpgsql;
 
-SELECT sync_databases();
+SELECT * FROM sync_databases();
 
 SELECT *
 FROM backup_dbs 
 WHERE status = 'PENDING'
 ORDER BY rank
-LIMIT 3 OFFSET 0;
\ No newline at end of file
+LIMIT 3 OFFSET 0;
+
+-- Reclamar de forma atómica las siguientes bases de datos para un proceso de backup
+UPDATE backup_dbs b
+SET status = 'IN_PROGRESS',
+    worker_id = 'host:pid',
+    heartbeat_at = CURRENT_TIMESTAMP,
+    lease_expires_at = CURRENT_TIMESTAMP + INTERVAL '10 minutes',
+    attempts = b.attempts + 1,
+    next_attempt_at = NULL
+FROM (
+    SELECT datname FROM backup_dbs
+    WHERE status = 'PENDING'
+    OR (status = 'RETRY' AND next_attempt_at <= CURRENT_TIMESTAMP)
+    ORDER BY rank DESC NULLS LAST
+    LIMIT 3
+    FOR UPDATE SKIP LOCKED
+) claimed
+WHERE b.datname = claimed.datname
+RETURNING b.datname;
+
+-- Bases de datos que dominan la ventana de backup en la última semana
+SELECT datname, count(*) AS jobs,
+       round(avg(dump_seconds + encrypt_seconds)::numeric, 1) AS avg_seconds,
+       round((avg(throughput_bytes_per_sec) / 1024 / 1024)::numeric, 1) AS avg_mb_per_sec
+FROM backup_history
+WHERE finished_at > now() - INTERVAL '7 days'
+GROUP BY datname
+ORDER BY avg_seconds DESC
+LIMIT 20;
@@ -0,0 +1,548 @@
+"""
+Motor de backup basado en asyncio, alternativo al pool de hilos de backup_postgres.py.
+
+Cada trabajo es una corrutina: pg_dump, el compresor y gpg se lanzan con
+asyncio.create_subprocess_exec y los datos pasan entre etapas con lecturas acotadas y
+`await drain()`, así una etapa lenta frena a la anterior sin acumular memoria. La tabla de
+control se actualiza con asyncpg. Un semáforo limita los dumps concurrentes y las conexiones de
+pg_dump se reparten con el mismo presupuesto BACKUP_JOB_BUDGET que usa backup_postgres.py.
+
+Al detener el proceso (SIGINT/SIGTERM) o si falla el bucle de reclamación, se matan los
+procesos hijos, se eliminan los archivos parciales y las bases de datos IN_PROGRESS de este
+proceso vuelven a PENDING. Las señales que llegan durante esa limpieza se ignoran.
+
+Reutiliza la configuración de backup_postgres.py (.env.local) y requiere asyncpg.
+El repositorio deduplicado (BACKUP_STORE=dedup) solo está soportado en backup_postgres.py.
+
+Uso:
+    python backup_async.py
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import tempfile
+import uuid
+import subprocess
+from datetime import datetime
+
+import backup_postgres as bp
+import db_admin_core as core
+import backup_metrics
+import backup_throttle
+
+# Dumps simultáneos del motor asíncrono
+ASYNC_CONCURRENCY = int(os.getenv('BACKUP_ASYNC_CONCURRENCY', str(bp.BACKUP_WORKERS)))
+# Tamaño máximo de cada lectura entre etapas: acota la memoria por trabajo
+RELAY_CHUNK_SIZE = 1024 * 1024
+
+log_message = bp.log_message
+
+async def create_control_pool():
+    """Crear el pool asyncpg para la tabla de control (import perezoso: dependencia opcional)"""
+    import asyncpg
+    return await asyncpg.create_pool(host=bp.PGHOST, user=bp.DB_USER, password=bp.DB_PASSWORD,
+                                     database=bp.DB_NAME, min_size=1, max_size=ASYNC_CONCURRENCY + 2)
+
+async def claim_database(control_pool):
+    """Reclamar la siguiente base de datos PENDING (mismo criterio que claim_databases_to_backup)"""
+    order = 'DESC' if bp.BACKUP_ORDER == 'largest_first' else 'ASC'
+    row = await control_pool.fetchrow(f"""
+        UPDATE backup_dbs b
+        SET status = 'IN_PROGRESS',
+            worker_id = $1,
+            heartbeat_at = CURRENT_TIMESTAMP,
+            lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => $2),
+            attempts = b.attempts + 1,
+            next_attempt_at = NULL
+        FROM (
+            SELECT datname FROM backup_dbs
+            WHERE status = 'PENDING'
+            OR (status = 'RETRY' AND next_attempt_at <= $3)
+            ORDER BY rank {order} NULLS LAST
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ) claimed
+        WHERE b.datname = claimed.datname
+        RETURNING b.datname, b.size_bytes, b.attempts;
+    """, bp.WORKER_ID, float(bp.LEASE_SECONDS), datetime.now())
+    return (row['datname'], row['size_bytes'], row['attempts']) if row else None
+
+async def update_status(control_pool, db, status, fingerprint=None, next_attempt_at=None, error=None):
+    """Escribir el estado final (o RETRY) de una base de datos reclamada por este proceso"""
+    try:
+        await control_pool.execute("""
+            UPDATE backup_dbs
+            SET status = $1,
+            last_backup_date = CURRENT_TIMESTAMP,
+            lease_expires_at = NULL,
+            fingerprint = CASE WHEN $1 = 'SUCCESS' THEN $2 ELSE fingerprint END,
+            last_success_date = CASE WHEN $1 = 'SUCCESS' THEN CURRENT_TIMESTAMP ELSE last_success_date END,
+            attempts = CASE WHEN $1 = 'SUCCESS' THEN 0 ELSE attempts END,
+            next_attempt_at = $5,
+            last_error = CASE WHEN $1 = 'SUCCESS' THEN NULL ELSE coalesce($6, last_error) END
+            WHERE datname = $3
+            AND worker_id = $4;
+        """, status, fingerprint, db, bp.WORKER_ID, next_attempt_at, error)
+    except Exception as e:
+        log_message(f"ERROR - Al actualizar el estado del backup para {db}: {e}")
+
+async def get_fingerprint(control_pool, db):
+    """Fingerprint de actividad de la base de datos (ver bp.get_database_fingerprint)
+
+    Usa el catálogo compartido si sync_databases ya lo llenó en el mismo proceso.
+    """
+    fingerprints = core.database_fingerprints(bp.DB_NAME, load=False)
+    if fingerprints and db in fingerprints:
+        return fingerprints[db]
+    try:
+        return await control_pool.fetchval("""
+            SELECT md5(concat_ws(':', tup_inserted, tup_updated, tup_deleted, stats_reset))
+            FROM pg_stat_database
+            WHERE datname = $1;
+        """, db)
+    except Exception as e:
+        log_message(f"ERROR - Al obtener el fingerprint de la base de datos {db}: {e}")
+        return None
+
+async def reset_in_progress(control_pool):
+    """Devolver a PENDING las bases de datos IN_PROGRESS de este proceso (cancelación o error)"""
+    released = await control_pool.fetch("""
+        UPDATE backup_dbs
+        SET status = 'PENDING',
+            worker_id = NULL,
+            lease_expires_at = NULL
+        WHERE status = 'IN_PROGRESS'
+        AND worker_id = $1
+        RETURNING datname;
+    """, bp.WORKER_ID)
+    if released:
+        log_message(f"INFO - Bases de datos devueltas a PENDING al detener el proceso: {[r['datname'] for r in released]}")
+
+async def release_expired_leases(control_pool):
+    """Devolver a PENDING las bases de datos IN_PROGRESS cuyo lease expiró (procesos caídos)"""
+    try:
+        released = await control_pool.fetch("""
+            UPDATE backup_dbs
+            SET status = 'PENDING', worker_id = NULL, lease_expires_at = NULL
+            WHERE status = 'IN_PROGRESS' AND lease_expires_at < CURRENT_TIMESTAMP
+            RETURNING datname;
+        """)
+        if released:
+            log_message(f"INFO - Leases expirados devueltos a PENDING: {[r['datname'] for r in released]}")
+    except Exception as e:
+        log_message(f"ERROR - Al liberar los leases expirados: {e}")
+
+async def heartbeat(control_pool):
+    """Renovar periódicamente los leases de este proceso y liberar los expirados de otros procesos"""
+    while True:
+        await asyncio.sleep(bp.HEARTBEAT_SECONDS)
+        try:
+            await control_pool.execute("""
+                UPDATE backup_dbs
+                SET heartbeat_at = CURRENT_TIMESTAMP,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => $1)
+                WHERE status = 'IN_PROGRESS'
+                AND worker_id = $2;
+            """, float(bp.LEASE_SECONDS), bp.WORKER_ID)
+        except Exception as e:
+            log_message(f"ERROR - Al renovar los leases de [{bp.WORKER_ID}]: {e}")
+        await release_expired_leases(control_pool)
+        await asyncio.to_thread(bp.export_metrics)
+
+async def kill_process(proc):
+    """Matar un proceso y descartar su stdout pendiente
+
+    asyncio solo da por terminado un proceso cuando sus pipes llegan a EOF; si nadie lee el
+    stdout pausado, proc.wait() no volvería nunca.
+    """
+    if proc.returncode is None:
+        proc.kill()
+    if proc.stdout is not None:
+        while await proc.stdout.read(RELAY_CHUNK_SIZE):
+            pass
+    await proc.wait()
+
+async def relay(upstream, downstream, counter, throttle=()):
+    """Copiar stdout de una etapa al stdin de la siguiente respetando la backpressure
+
+    Si la etapa siguiente muere, se mata la anterior para que no quede bloqueada en el pipe.
+    """
+    try:
+        while True:
+            data = await upstream.stdout.read(RELAY_CHUNK_SIZE)
+            if not data:
+                break
+            counter[0] += len(data)
+            delay = backup_throttle.throttle_delay(throttle, len(data))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if downstream.stdin.is_closing():
+                # Tras un EPIPE el transporte descarta las escrituras sin error: hay que detectarlo aquí
+                raise BrokenPipeError(f"La etapa {downstream.pid} cerró su entrada")
+            downstream.stdin.write(data)
+            await downstream.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        await kill_process(upstream)
+        raise
+    finally:
+        downstream.stdin.close()
+
+async def run_pipeline_async(commands, output_path, metrics, throttle=()):
+    """Versión asíncrona de bp.run_pipeline; cuenta en metrics['bytes_in'] los bytes de la primera
+    etapa y devuelve (segundos hasta que termina la primera etapa, segundos totales)"""
+    processes = []
+    stderr_files = []
+    relays = []
+    counter = [0]
+    start = time.monotonic()
+    first_stage_end = []
+    try:
+        with open(output_path, 'wb') as output:
+            for i, cmd in enumerate(commands):
+                is_last = i == len(commands) - 1
+                err = tempfile.TemporaryFile()
+                stderr_files.append(err)
+                processes.append(await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE if i else asyncio.subprocess.DEVNULL,
+                    stdout=output if is_last else asyncio.subprocess.PIPE,
+                    stderr=err, env=bp.dump_env()))
+
+            for i, (upstream, downstream) in enumerate(zip(processes, processes[1:])):
+                relays.append(asyncio.create_task(relay(upstream, downstream, counter if i == 0 else [0],
+                                                        throttle if i == 0 else ())))
+            # El primer relay termina cuando la primera etapa cierra su stdout
+            relays[0].add_done_callback(lambda task: first_stage_end.append(time.monotonic()))
+            await asyncio.gather(*relays, return_exceptions=True)
+            for proc in processes:
+                await proc.wait()
+        end = time.monotonic()
+        metrics['bytes_in'] = counter[0]
+
+        failed = [(proc, err) for proc, err in zip(processes, stderr_files) if proc.returncode != 0]
+        if failed:
+            broken = (-signal.SIGPIPE, -signal.SIGKILL)
+            proc, err = ([f for f in failed if f[0].returncode not in broken] or failed)[0]
+            err.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, commands[processes.index(proc)], stderr=err.read())
+        return first_stage_end[0] - start, end - start
+    except BaseException:
+        for task in relays:
+            task.cancel()
+        await asyncio.gather(*relays, return_exceptions=True)
+        for proc in processes:
+            await kill_process(proc)
+        raise
+    finally:
+        for err in stderr_files:
+            err.close()
+
+async def run_process_async(cmd):
+    """Ejecutar un proceso sin stdout y lanzar CalledProcessError con su stderr si falla"""
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.PIPE, env=bp.dump_env())
+    try:
+        _, stderr = await proc.communicate()
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+
+async def acquire_dump_jobs(wanted):
+    """bp.acquire_dump_jobs sin bloquear el bucle de eventos
+
+    La espera ocurre en un hilo; si la tarea se cancela mientras espera, los jobs que ese hilo
+    reserve después se devuelven al presupuesto en cuanto los obtiene.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(bp.acquire_dump_jobs, wanted))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(
+            lambda f: None if f.cancelled() or f.exception() else bp.release_dump_jobs(f.result()))
+        raise
+
+async def dump_database(db, backup_path, size_bytes, metrics):
+    """Generar el artefacto cifrado de una base de datos; rellena tiempos y bytes en metrics
+
+    Como en backup_postgres.py, las conexiones de pg_dump se toman del presupuesto global
+    BACKUP_JOB_BUDGET (bp.acquire_dump_jobs): un dump grande recibe los jobs que estén libres
+    en ese momento y los devuelve al terminar el dump.
+    """
+    compression = bp.select_compression(size_bytes)
+    parallel = size_bytes is not None and size_bytes >= bp.PARALLEL_DUMP_THRESHOLD_MB * 1024 ** 2
+    jobs = await acquire_dump_jobs(bp.PARALLEL_DUMP_JOBS if parallel else 1)
+    try:
+        if not parallel or jobs < 2:
+            commands, extension = bp.build_backup_pipeline(db, compression)
+            encrypted_backup_file = os.path.join(backup_path, f"{db}{extension}")
+            dump_seconds, total_seconds = await run_pipeline_async(commands, encrypted_backup_file, metrics,
+                                                                   bp.job_throttle())
+            metrics['dump_seconds'] = dump_seconds
+            metrics['encrypt_seconds'] = total_seconds - dump_seconds
+            return encrypted_backup_file
+
+        log_message(f"INFO - Backup en paralelo para DB: [{db}] con {jobs} jobs")
+        dump_dir = os.path.join(backup_path, f"{db}.backup.dir")
+        try:
+            start = time.monotonic()
+            await run_process_async(bp.build_directory_dump_command(db, jobs, dump_dir, compression))
+            metrics['dump_seconds'] = time.monotonic() - start
+            stages, extension = bp.directory_tar_stages(compression)
+            encrypted_backup_file = os.path.join(backup_path, f"{db}{extension}")
+            _, metrics['encrypt_seconds'] = await run_pipeline_async([['tar', '-C', dump_dir, '-cf', '-', '.']] + stages,
+                                                                     encrypted_backup_file, metrics)
+            return encrypted_backup_file
+        finally:
+            await asyncio.to_thread(bp.shutil.rmtree, dump_dir, True)
+    finally:
+        bp.release_dump_jobs(jobs)
+
+async def insert_history(control_pool, job):
+    """Guardar las métricas de un trabajo en backup_history (ver bp.flush_backup_status)"""
+    try:
+        await control_pool.execute("""
+            INSERT INTO backup_history (datname, worker_id, status, attempt, started_at, finished_at,
+                queue_wait_seconds, dump_seconds, encrypt_seconds, bytes_in, bytes_out, throughput_bytes_per_sec)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12);
+        """, job['datname'], bp.WORKER_ID, job['status'], job['attempt'], job['started_at'], job['finished_at'],
+            job['queue_wait_seconds'], job['dump_seconds'], job['encrypt_seconds'], job['bytes_in'],
+            job['bytes_out'], job['throughput_bytes_per_sec'])
+    except Exception as e:
+        log_message(f"ERROR - Al guardar el histórico del backup para {job['datname']}: {e}")
+
+async def record_failure(control_pool, db, attempt, error_message, status='FAILED'):
+    """Registrar un fallo (RETRY o estado final, ver bp.plan_retry); devuelve (estado, next_attempt_at)"""
+    status, next_attempt_at = bp.plan_retry(db, attempt, error_message, status)
+    await update_status(control_pool, db, status, next_attempt_at=next_attempt_at, error=error_message[:1000])
+    return status, next_attempt_at
+
+async def backup_database(control_pool, semaphore, db, size_bytes, backup_path, claimed_at, attempt):
+    """Respaldar una base de datos; libera el semáforo al terminar. Devuelve (db, estado, next_attempt_at)"""
+    metrics = {
+        'datname': db, 'status': 'FAILED', 'attempt': attempt,
+        'started_at': datetime.now(), 'finished_at': None,
+        'queue_wait_seconds': time.monotonic() - claimed_at,
+        'dump_seconds': 0.0, 'encrypt_seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0,
+    }
+    slot_held = True
+    with core.job_context(job_id=uuid.uuid4().hex, datname=db, attempt=attempt, worker_id=bp.WORKER_ID):
+        try:
+            start_time = datetime.now()
+            fingerprint = await get_fingerprint(control_pool, db)
+            encrypted_backup_file = await dump_database(db, backup_path, size_bytes, metrics)
+            # El registro en el índice (con el sha256, que relee el artefacto) no ocupa un hueco de dump
+            semaphore.release()
+            slot_held = False
+            file_size = os.path.getsize(encrypted_backup_file)
+            metrics['bytes_out'] = file_size
+            metrics['status'] = 'SUCCESS'
+            log_message(f"INFO - Backup completado y cifrado para DB: [{db}] en {datetime.now() - start_time}, "
+                        f"size del archivo: {file_size} bytes, leídos de pg_dump: {metrics['bytes_in']} bytes")
+            await update_status(control_pool, db, 'SUCCESS', fingerprint)
+            await asyncio.to_thread(bp.index_artifact, db, encrypted_backup_file, file_size, datetime.now())
+            return db, 'SUCCESS', None
+        except asyncio.CancelledError:
+            bp.remove_partial_backups(db, backup_path)
+            metrics['status'] = None  # Cancelado: vuelve a PENDING y no cuenta como trabajo terminado
+            raise
+        except subprocess.CalledProcessError as e:
+            error_message = bp.process_error_message(e)
+            log_message(f"ERROR - Al respaldar la base de datos {db}: {error_message}")
+            bp.remove_partial_backups(db, backup_path)
+            metrics['status'], next_attempt_at = await record_failure(control_pool, db, attempt, error_message,
+                                                                      bp.backup_error_status(error_message))
+            return db, metrics['status'], next_attempt_at
+        except Exception as e:
+            log_message(f"ERROR - backup_database - Al respaldar la base de datos {db}: {e}")
+            bp.remove_partial_backups(db, backup_path)
+            metrics['status'], next_attempt_at = await record_failure(control_pool, db, attempt, str(e))
+            return db, metrics['status'], next_attempt_at
+        finally:
+            if slot_held:
+                semaphore.release()
+            if metrics['status']:
+                metrics['finished_at'] = datetime.now()
+                job = backup_metrics.record_job(metrics)
+                bp.log_job(job)
+                await insert_history(control_pool, job)
+
+async def load_monitor(control_pool, allowed):
+    """Ajustar allowed[0] (dumps simultáneos permitidos) según la carga del servidor (ver bp.load_monitor_loop)"""
+    while True:
+        await asyncio.sleep(bp.BACKUP_LOAD_POLL_SECONDS)
+        try:
+            row = await control_pool.fetchrow("""
+                SELECT
+                    (SELECT count(*) FROM pg_stat_activity
+                     WHERE state = 'active'
+                     AND backend_type = 'client backend'
+                     AND usename IS DISTINCT FROM $1
+                     AND pid <> pg_backend_pid()) AS active_sessions,
+                    (SELECT coalesce(extract(epoch FROM max(replay_lag)), 0) FROM pg_stat_replication) AS replication_lag;
+            """, bp.DB_BUSER)
+        except Exception as e:
+            log_message(f"ERROR - Al consultar la carga del servidor: {e}")
+            continue
+        load = {'active_sessions': row['active_sessions'], 'replication_lag_seconds': float(row['replication_lag'])}
+        workers = backup_throttle.adjust_concurrency(allowed[0], bp.BACKUP_MIN_WORKERS, ASYNC_CONCURRENCY,
+                                                     load, bp.LOAD_LIMITS)
+        if workers != allowed[0]:
+            log_message(f"INFO - Concurrencia de backup {allowed[0]} -> {workers} (sesiones activas: "
+                        f"{load['active_sessions']}, lag de replicación: {load['replication_lag_seconds']:.1f} s)")
+            allowed[0] = workers
+
+async def run_backups(control_pool, backup_path):
+    """Reclamar bases de datos mientras haya hueco en el semáforo y esperar a que terminen todas
+
+    Devuelve las bases de datos que fallaron sin más reintentos.
+    """
+    semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    tasks = set()
+    successful_dbs = []
+    failed_dbs = []
+    # Reintentos programados por este proceso: {datname: next_attempt_at}
+    retries = {}
+    consecutive_failures = 0
+    allowed = [ASYNC_CONCURRENCY]
+    monitor = asyncio.create_task(load_monitor(control_pool, allowed)) if bp.ADAPTIVE_CONCURRENCY else None
+
+    def on_done(task):
+        nonlocal consecutive_failures
+        tasks.discard(task)
+        if task.cancelled():
+            return
+        db, status, next_attempt_at = task.result()
+        if status == 'SUCCESS':
+            successful_dbs.append(db)
+            consecutive_failures = 0
+        elif status == 'RETRY':
+            retries[db] = next_attempt_at
+        else:
+            failed_dbs.append(db)
+            consecutive_failures += 1
+
+    try:
+        while consecutive_failures < bp.BACKUP_MAX_CONSECUTIVE_FAILURES:
+            await semaphore.acquire()
+            while len(tasks) >= allowed[0]:
+                await asyncio.sleep(1)  # Carga alta: esperar a que terminen trabajos o baje la carga
+            claimed_at = time.monotonic()
+            claimed = await claim_database(control_pool)
+            if not claimed:
+                semaphore.release()
+                if not tasks and not retries:
+                    break
+                # Nada disponible ahora: esperar a que termine un trabajo (puede dejar un RETRY) o venza un reintento
+                timeout = max(0.0, (min(retries.values()) - datetime.now()).total_seconds()) if retries else None
+                if tasks:
+                    await asyncio.wait(set(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(timeout)
+                now = datetime.now()
+                for db in [db for db, next_attempt_at in retries.items() if next_attempt_at <= now]:
+                    del retries[db]  # Se reclama en la siguiente vuelta (o ya lo tomó otro proceso)
+                continue
+            db, size_bytes, attempt = claimed
+            retries.pop(db, None)
+            task = asyncio.create_task(backup_database(control_pool, semaphore, db, size_bytes, backup_path,
+                                                       claimed_at, attempt))
+            tasks.add(task)
+            task.add_done_callback(on_done)
+        else:
+            log_message(f"ERROR - Se alcanzó el número máximo de fallos consecutivos [{bp.BACKUP_MAX_CONSECUTIVE_FAILURES}]. "
+                        f"Deteniendo el proceso de backup.")
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        if monitor is not None:
+            monitor.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Tras una cancelación o un error, lo reclamado por este proceso no debe esperar a que venza el lease
+        try:
+            await reset_in_progress(control_pool)
+        except Exception as e:
+            log_message(f"ERROR - Al devolver a PENDING las bases de datos de [{bp.WORKER_ID}]: {e}")
+
+    if successful_dbs:
+        log_message(f"INFO - Bases de datos respaldadas con éxito: {successful_dbs}")
+    if failed_dbs:
+        log_message(f"ERROR - Bases de datos que fallaron al respaldar: {failed_dbs}")
+    if retries:
+        log_message(f"INFO - Bases de datos en RETRY para la siguiente ejecución: {sorted(retries)}")
+    return failed_dbs
+
+async def main_async():
+    """Ejecutar el motor asíncrono; devuelve 0, o 1 si la configuración no es válida o alguna base de datos falló"""
+    if not bp.load_compression_rules():
+        return 1
+    if bp.BACKUP_STORE == 'dedup':
+        log_message("ERROR - El motor asíncrono no soporta BACKUP_STORE=dedup; usa backup_postgres.py")
+        return 1
+
+    backup_path = bp.create_backup_dir()
+    log_message(f"Directorio de backup: {backup_path}")
+    log_message(f"Motor asíncrono con {ASYNC_CONCURRENCY} dumps concurrentes (worker: {bp.WORKER_ID})")
+    await asyncio.to_thread(bp.ensure_backup_index)
+
+    loop = asyncio.get_running_loop()
+    current = asyncio.current_task()
+    stopping = False
+
+    def stop():
+        # Una segunda señal cancelaría la limpieza (matar procesos, devolver filas a PENDING)
+        nonlocal stopping
+        if stopping:
+            log_message("INFO - Señal ignorada: el proceso de backup ya se está deteniendo")
+            return
+        stopping = True
+        current.cancel()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+
+    metrics_server = backup_metrics.start_http_server(bp.BACKUP_METRICS_PORT) if bp.BACKUP_METRICS_PORT else None
+    control_pool = await create_control_pool()
+    heartbeat_task = asyncio.create_task(heartbeat(control_pool))
+    try:
+        await release_expired_leases(control_pool)
+        failed_dbs = await run_backups(control_pool, backup_path)
+    except asyncio.CancelledError:
+        log_message("INFO - Proceso de backup cancelado")
+        raise
+    finally:
+        heartbeat_task.cancel()
+        await control_pool.close()
+        bp.export_metrics()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    await asyncio.to_thread(bp.delete_old_backups)
+    log_message("---")
+    return 1 if failed_dbs else 0
+
+def main():
+    try:
+        exit_code = asyncio.run(main_async())
+        print(f"Proceso de backups completados. Detalles en el archivo {bp.LOG_FILE}")
+        return exit_code
+    except asyncio.CancelledError:
+        print(f"Proceso de backups cancelado. Detalles en el archivo {bp.LOG_FILE}")
+        return 1
+
+if __name__ == "__main__":
+    exit_code = 1
+    try:
+        exit_code = main()
+    except Exception as e:
+        log_message(f"ERROR - Error inesperado: {e}")
+        print(f"Error inesperado: {e}. Revisa el log para más detalles.")
+    sys.exit(exit_code)
@@ -0,0 +1,366 @@
+"""
+Índice local de artefactos de backup (SQLite, junto a los backups).
+
+backup_postgres.py registra cada artefacto al terminar un backup exitoso: base de datos,
+ruta, tipo ('file' para los archivos cifrados de las carpetas diarias, 'manifest' para los
+manifiestos del repositorio deduplicado), tamaño, sha256 y fecha. Con el índice:
+
+- el último backup de una base de datos se obtiene con una consulta por índice, sin recorrer
+  el árbol de backups;
+- la retención se evalúa sobre el índice con una política por base de datos (últimos N,
+  diarios, semanales, mensuales y antigüedad máxima) y los artefactos se eliminan en paralelo.
+
+Si el índice no existe (instalaciones anteriores), se reconstruye una vez recorriendo las
+carpetas de backup y los manifiestos. Los artefactos que no llegaron al índice (si falló su
+registro) se recuperan con index_unindexed(): la retención barre los anteriores a su ventana
+(sweep_unindexed, que solo recorre lo posterior al último barrido guardado en la tabla meta) y
+la verificación busca los más recientes que la última entrada de cada base de datos.
+
+Uso:
+    python backup_index.py list [--db DB]
+    python backup_index.py latest DB
+    python backup_index.py rebuild [--checksum]
+    python backup_index.py prune [--dry-run]
+"""
+
+import os
+import re
+import json
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+BACKUP_DIR = "backup/"
+INDEX_PATH = os.getenv('BACKUP_INDEX_PATH', os.path.join(BACKUP_DIR, 'index.sqlite3'))
+STORE_DIR = os.getenv('BACKUP_STORE_DIR', os.path.join(BACKUP_DIR, 'store'))
+# Política por defecto: la misma retención por antigüedad que delete_old_backups() usaba antes
+RETENTION_POLICY = os.getenv('BACKUP_RETENTION', 'within_days=7')
+DELETE_WORKERS = int(os.getenv('BACKUP_DELETE_WORKERS', '8'))
+
+# Nombre de los artefactos de las carpetas diarias (ver build_backup_pipeline y dump_database_parallel)
+ARTIFACT_NAME = re.compile(r'^(?P<datname>.+)\.backup(\.tar)?(\.zst|\.lz4|\.gz|\.xz)?\.gpg$')
+
+RETENTION_KEYS = ('within_days', 'last', 'daily', 'weekly', 'monthly')
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS artifacts (
+        id INTEGER PRIMARY KEY,
+        datname TEXT NOT NULL,
+        path TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        size_bytes INTEGER,
+        sha256 TEXT,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS artifacts_datname_created_idx ON artifacts (datname, created_at);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+"""
+
+# Una conexión por archivo de índice, compartida por los hilos del proceso
+connections = {}
+connections_lock = threading.Lock()
+
+def open_index(index_path=INDEX_PATH):
+    """Conexión (creada una sola vez) al índice; crea el archivo y el esquema si no existen"""
+    with connections_lock:
+        if index_path not in connections:
+            os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(index_path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            connections[index_path] = (conn, threading.Lock())
+        return connections[index_path]
+
+def close_index(index_path=INDEX_PATH):
+    with connections_lock:
+        entry = connections.pop(index_path, None)
+    if entry:
+        entry[0].close()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def record_artifact(db, path, kind, size_bytes, sha256=None, created_at=None, index_path=INDEX_PATH):
+    """Registrar (o reemplazar, si la ruta ya existe) un artefacto en el índice"""
+    conn, lock = open_index(index_path)
+    created_at = (created_at or datetime.now()).isoformat(timespec='seconds')
+    with lock, conn:
+        conn.execute("""
+            INSERT INTO artifacts (datname, path, kind, size_bytes, sha256, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE
+            SET datname = excluded.datname, kind = excluded.kind, size_bytes = excluded.size_bytes,
+                sha256 = excluded.sha256, created_at = excluded.created_at;
+        """, (db, os.path.normpath(path), kind, size_bytes, sha256, created_at))
+
+def get_meta(key, index_path=INDEX_PATH):
+    conn, lock = open_index(index_path)
+    with lock:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(key, value, index_path=INDEX_PATH):
+    conn, lock = open_index(index_path)
+    with lock, conn:
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                     (key, value))
+
+def list_artifacts(db=None, index_path=INDEX_PATH):
+    """Artefactos del índice, del más reciente al más antiguo"""
+    conn, lock = open_index(index_path)
+    with lock:
+        if db is None:
+            rows = conn.execute("SELECT * FROM artifacts ORDER BY datname, created_at DESC, id DESC").fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM artifacts WHERE datname = ? ORDER BY created_at DESC, id DESC",
+                                (db,)).fetchall()
+    return [dict(row) for row in rows]
+
+def latest_artifact(db, index_path=INDEX_PATH):
+    """Último artefacto de una base de datos que sigue en disco; las entradas huérfanas se eliminan"""
+    conn, lock = open_index(index_path)
+    while True:
+        with lock:
+            row = conn.execute("SELECT * FROM artifacts WHERE datname = ? ORDER BY created_at DESC, id DESC LIMIT 1",
+                               (db,)).fetchone()
+        if row is None or os.path.exists(row['path']):
+            return dict(row) if row else None
+        with lock, conn:
+            conn.execute("DELETE FROM artifacts WHERE id = ?", (row['id'],))
+
+def drop_missing(db=None, index_path=INDEX_PATH):
+    """Quitar del índice los artefactos cuyo archivo ya no existe. Devuelve sus rutas"""
+    missing = [artifact for artifact in list_artifacts(db, index_path) if not os.path.exists(artifact['path'])]
+    if missing:
+        conn, lock = open_index(index_path)
+        with lock, conn:
+            conn.executemany("DELETE FROM artifacts WHERE id = ?", [(artifact['id'],) for artifact in missing])
+    return [artifact['path'] for artifact in missing]
+
+def scan_artifacts(backup_dir=BACKUP_DIR, store_dir=STORE_DIR, db=None, since=None, until=None):
+    """Artefactos en disco (carpetas diarias y manifiestos) como dicts con las columnas del índice
+
+    db limita el recorrido a una base de datos; since y until, a las carpetas y manifiestos de
+    ese intervalo según su nombre, sin abrir los que quedan fuera.
+    """
+    if os.path.isdir(backup_dir):
+        for folder in sorted(os.listdir(backup_dir)):
+            try:
+                folder_date = datetime.strptime(folder, "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            if (since and folder_date < since.date()) or (until and folder_date > until.date()):
+                continue
+            folder_path = os.path.join(backup_dir, folder)
+            for name in os.listdir(folder_path):
+                match = ARTIFACT_NAME.match(name)
+                path = os.path.join(folder_path, name)
+                if match and (db is None or match.group('datname') == db) and os.path.isfile(path):
+                    stat = os.stat(path)
+                    yield {'datname': match.group('datname'), 'path': path, 'kind': 'file',
+                           'size_bytes': stat.st_size, 'created_at': datetime.fromtimestamp(stat.st_mtime)}
+
+    manifests_root = os.path.join(store_dir, 'manifests')
+    if os.path.isdir(manifests_root):
+        folders = [quote(db, safe='')] if db is not None else sorted(os.listdir(manifests_root))
+        for folder in folders:
+            folder_path = os.path.join(manifests_root, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for name in sorted(os.listdir(folder_path)):
+                if not name.endswith('.json'):
+                    continue
+                created_at = datetime.strptime(name[:-len('.json')], "%Y%m%dT%H%M%S")
+                if (since and created_at < since) or (until and created_at > until):
+                    continue
+                path = os.path.join(folder_path, name)
+                with open(path) as f:
+                    manifest = json.load(f)
+                yield {'datname': manifest['database'], 'path': path, 'kind': 'manifest',
+                       'size_bytes': manifest['size'], 'created_at': datetime.fromisoformat(manifest['created_at'])}
+
+def record_scanned(artifact, checksum=False, index_path=INDEX_PATH):
+    record_artifact(artifact['datname'], artifact['path'], artifact['kind'], artifact['size_bytes'],
+                    file_sha256(artifact['path']) if checksum else None, artifact['created_at'], index_path)
+
+def index_unindexed(artifacts, checksum=False, index_path=INDEX_PATH):
+    """Registrar los artefactos (de scan_artifacts) que no están en el índice. Devuelve los registrados"""
+    conn, lock = open_index(index_path)
+    added = []
+    for artifact in artifacts:
+        with lock:
+            known = conn.execute("SELECT 1 FROM artifacts WHERE path = ?", (os.path.normpath(artifact['path']),)).fetchone()
+        if known is None:
+            record_scanned(artifact, checksum, index_path)
+            added.append(artifact)
+    return added
+
+def sweep_unindexed(backup_dir=BACKUP_DIR, store_dir=STORE_DIR, until=None, checksum=False, index_path=INDEX_PATH):
+    """Registrar los artefactos anteriores a until que no están en el índice. Devuelve los registrados
+
+    Solo se recorren las carpetas y manifiestos posteriores al último barrido (meta 'swept_until'),
+    así el coste no crece con los backups que conservan las reglas semanales y mensuales.
+    """
+    swept_until = get_meta('swept_until', index_path)
+    since = datetime.fromisoformat(swept_until) if swept_until else None
+    added = index_unindexed(scan_artifacts(backup_dir, store_dir, since=since, until=until), checksum, index_path)
+    if until is not None and (since is None or until > since):
+        set_meta('swept_until', until.isoformat(timespec='seconds'), index_path)
+    return added
+
+def rebuild_index(backup_dir=BACKUP_DIR, store_dir=STORE_DIR, checksum=False, index_path=INDEX_PATH):
+    """Registrar los artefactos existentes en disco (carpetas diarias y manifiestos). Devuelve cuántos"""
+    started_at = datetime.now()
+    count = 0
+    for artifact in scan_artifacts(backup_dir, store_dir):
+        record_scanned(artifact, checksum, index_path)
+        count += 1
+    # Todo lo anterior a la reconstrucción ya está en el índice
+    set_meta('swept_until', started_at.isoformat(timespec='seconds'), index_path)
+    return count
+
+def parse_retention_policy(text):
+    """'within_days=7,last=3,daily=7,weekly=4,monthly=12' -> dict; las claves ausentes valen 0"""
+    policy = dict.fromkeys(RETENTION_KEYS, 0)
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        key, value = item.split('=')
+        if key not in policy:
+            raise ValueError(f"Clave de retención desconocida: {key}")
+        policy[key] = int(value)
+    return policy
+
+def select_expired(artifacts, policy, now):
+    """Artefactos que ninguna regla de la política conserva
+
+    Por base de datos se conservan: el último siempre, los `last` más recientes, los más
+    recientes que `within_days` días y el más reciente de cada uno de los últimos `daily`
+    días, `weekly` semanas ISO y `monthly` meses que tengan backups.
+    """
+    by_db = {}
+    for artifact in artifacts:
+        by_db.setdefault(artifact['datname'], []).append(artifact)
+
+    buckets = [
+        (policy['daily'], lambda created: created.date()),
+        (policy['weekly'], lambda created: created.isocalendar()[:2]),
+        (policy['monthly'], lambda created: (created.year, created.month)),
+    ]
+    cutoff = now - timedelta(days=policy['within_days'])
+    expired = []
+    for rows in by_db.values():
+        rows = sorted(rows, key=lambda row: (row['created_at'], row['id']), reverse=True)
+        keep = {rows[0]['id']}
+        keep.update(row['id'] for row in rows[:policy['last']])
+        if policy['within_days']:
+            keep.update(row['id'] for row in rows if datetime.fromisoformat(row['created_at']) >= cutoff)
+        for count, bucket_key in buckets:
+            seen = set()
+            for row in rows:
+                if len(seen) >= count:
+                    break
+                key = bucket_key(datetime.fromisoformat(row['created_at']))
+                if key not in seen:
+                    seen.add(key)
+                    keep.add(row['id'])
+        expired.extend(row for row in rows if row['id'] not in keep)
+    return expired
+
+def remove_artifact(artifact):
+    """Eliminar un artefacto del disco; devuelve los bytes liberados (0 si ya no existía)"""
+    path = artifact['path']
+    try:
+        if os.path.isdir(path):
+            size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+            shutil.rmtree(path)
+            return size
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+def delete_artifacts(artifacts, workers=DELETE_WORKERS, index_path=INDEX_PATH):
+    """Eliminar artefactos en paralelo y quitarlos del índice. Devuelve (eliminados, bytes, errores)"""
+    deleted = []
+    freed = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(remove_artifact, artifact): artifact for artifact in artifacts}
+        for future, artifact in futures.items():
+            try:
+                freed += future.result()
+                deleted.append(artifact['id'])
+            except OSError as e:
+                errors.append((artifact['path'], str(e)))
+
+    if deleted:
+        conn, lock = open_index(index_path)
+        with lock, conn:
+            conn.executemany("DELETE FROM artifacts WHERE id = ?", [(artifact_id,) for artifact_id in deleted])
+    return len(deleted), freed, errors
+
+def remove_empty_folders(backup_dir=BACKUP_DIR):
+    """Eliminar las carpetas diarias que quedaron vacías tras la retención"""
+    for folder in os.listdir(backup_dir):
+        folder_path = os.path.join(backup_dir, folder)
+        try:
+            datetime.strptime(folder, "%Y-%m-%d")
+            os.rmdir(folder_path)
+        except (ValueError, OSError):
+            continue  # No es una carpeta diaria o todavía tiene archivos
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice de artefactos de backup")
+    parser.add_argument('--index', default=INDEX_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help="Listar artefactos")
+    list_parser.add_argument('--db')
+
+    latest_parser = subparsers.add_parser('latest', help="Último artefacto de una base de datos")
+    latest_parser.add_argument('db')
+
+    rebuild_parser = subparsers.add_parser('rebuild', help="Registrar los artefactos existentes en disco")
+    rebuild_parser.add_argument('--checksum', action='store_true', help="Calcular el sha256 de cada artefacto")
+
+    prune_parser = subparsers.add_parser('prune', help="Aplicar la política de retención BACKUP_RETENTION")
+    prune_parser.add_argument('--policy', default=RETENTION_POLICY)
+    prune_parser.add_argument('--dry-run', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for artifact in list_artifacts(args.db, args.index):
+            print(f"{artifact['datname']}\t{artifact['created_at']}\t{artifact['kind']}\t{artifact['size_bytes']}\t{artifact['path']}")
+    elif args.command == 'latest':
+        artifact = latest_artifact(args.db, args.index)
+        if artifact:
+            print(artifact['path'])
+    elif args.command == 'rebuild':
+        print(f"Artefactos registrados: {rebuild_index(checksum=args.checksum, index_path=args.index)}")
+    elif args.command == 'prune':
+        expired = select_expired(list_artifacts(index_path=args.index), parse_retention_policy(args.policy), datetime.now())
+        if args.dry_run:
+            for artifact in expired:
+                print(f"{artifact['datname']}\t{artifact['created_at']}\t{artifact['path']}")
+            print(f"Artefactos a eliminar: {len(expired)}")
+            return
+        deleted, freed, errors = delete_artifacts(expired, index_path=args.index)
+        remove_empty_folders()
+        print(f"Artefactos eliminados: {deleted}, bytes liberados: {freed}, errores: {len(errors)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Métricas por base de datos del proceso de backup en formato de exposición de Prometheus.
+
+backup_postgres.py y backup_async.py registran cada trabajo con record_job(); las métricas
+se publican escribiendo un archivo para el textfile collector de node_exporter
+(BACKUP_METRICS_TEXTFILE) y/o sirviéndolas en http://<host>:<BACKUP_METRICS_PORT>/metrics.
+El histórico completo se guarda en la tabla backup_history (SQL/query.sql).
+"""
+
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Último trabajo de cada base de datos y contadores por estado de la ejecución actual
+jobs = {}
+status_totals = {}
+metrics_lock = threading.Lock()
+
+# (nombre, tipo, ayuda, función que extrae el valor del trabajo, etiquetas adicionales)
+JOB_METRICS = [
+    ('backup_job_duration_seconds', 'gauge', "Duración de la etapa en el último backup",
+     lambda job: job['dump_seconds'], {'stage': 'dump'}),
+    ('backup_job_duration_seconds', 'gauge', None,
+     lambda job: job['encrypt_seconds'], {'stage': 'encrypt'}),
+    ('backup_job_duration_seconds', 'gauge', None,
+     lambda job: job['dump_seconds'] + job['encrypt_seconds'], {'stage': 'total'}),
+    ('backup_job_queue_wait_seconds', 'gauge', "Tiempo entre la reclamación y el inicio del dump",
+     lambda job: job['queue_wait_seconds'], {}),
+    ('backup_job_bytes', 'gauge', "Bytes leídos de pg_dump (in) y escritos en el artefacto (out)",
+     lambda job: job['bytes_in'], {'direction': 'in'}),
+    ('backup_job_bytes', 'gauge', None,
+     lambda job: job['bytes_out'], {'direction': 'out'}),
+    ('backup_job_throughput_bytes_per_second', 'gauge', "Bytes de pg_dump por segundo del último backup",
+     lambda job: job['throughput_bytes_per_sec'], {}),
+    ('backup_job_attempt', 'gauge', "Intento del último backup (1 = sin reintentos)",
+     lambda job: job['attempt'], {}),
+    ('backup_job_success', 'gauge', "1 si el último backup terminó en SUCCESS",
+     lambda job: 1 if job['status'] == 'SUCCESS' else 0, {}),
+    ('backup_job_last_finish_timestamp_seconds', 'gauge', "Fin del último backup (epoch)",
+     lambda job: job['finished_at'].timestamp(), {}),
+]
+
+def throughput(job):
+    """Bytes de pg_dump por segundo de trabajo (dump + cifrado)"""
+    seconds = job['dump_seconds'] + job['encrypt_seconds']
+    return job['bytes_in'] / seconds if seconds > 0 else 0.0
+
+def record_job(job):
+    """Registrar las métricas de un trabajo terminado (seguro desde varios hilos)"""
+    job = dict(job, throughput_bytes_per_sec=throughput(job))
+    with metrics_lock:
+        jobs[job['datname']] = job
+        status_totals[job['status']] = status_totals.get(job['status'], 0) + 1
+    return job
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+def render_prometheus():
+    """Métricas actuales en formato de texto de Prometheus"""
+    with metrics_lock:
+        snapshot = list(jobs.values())
+        totals = dict(status_totals)
+
+    lines = []
+    for name, metric_type, help_text, value, extra_labels in JOB_METRICS:
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+        for job in snapshot:
+            labels = format_labels({'datname': job['datname'], **extra_labels})
+            lines.append(f"{name}{labels} {value(job)}")
+
+    lines.append("# HELP backup_jobs_total Trabajos terminados por estado en la ejecución actual")
+    lines.append("# TYPE backup_jobs_total counter")
+    for status, count in sorted(totals.items()):
+        lines.append(f"backup_jobs_total{format_labels({'status': status})} {count}")
+    lines.append("# HELP backup_metrics_generated_timestamp_seconds Momento en que se generaron las métricas")
+    lines.append("# TYPE backup_metrics_generated_timestamp_seconds gauge")
+    lines.append(f"backup_metrics_generated_timestamp_seconds {time.time()}")
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(path):
+    """Escribir las métricas de forma atómica para el textfile collector de node_exporter"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Las peticiones de Prometheus no se registran en el log del backup
+
+def start_http_server(port, address='127.0.0.1'):
+    """Servir /metrics en un hilo en segundo plano; devuelve el servidor para poder cerrarlo"""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,14 +1,28 @@
 import os
+import sys
+import json
+import signal
+import socket
+import threading
 import subprocess
+import tempfile
+import time
+import random
+import uuid
+import functools
+import re
 from datetime import datetime, timedelta
 import shutil
-from dotenv import load_dotenv
-import logging
-import psycopg2
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import backup_store
+import backup_metrics
+import backup_throttle
+import backup_index
+import db_admin_core as core
 
 # Cargar las variables de entorno desde el archivo .env
-load_dotenv('.env.local')
+core.load_env('.env.local')
 
 # Configuración
 BACKUP_DIR = "backup/"
@@ -27,11 +41,99 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAME = os.getenv('DB_DEFAULT')
 
 GPGNAME = os.getenv('GPG_NAME')
-# Configurar la variable de entorno para la contraseña
-os.environ['PGPASSWORD'] = DB_BPASSWORD
+
+# Modo streaming: pg_dump -> [compresor] -> gpg sin archivo intermedio en claro
+BACKUP_STREAMING = os.getenv('BACKUP_STREAMING', 'true').lower() in ('1', 'true', 'yes')
+# Etapa de compresión explícita en el flujo. Reglas "tamaño_mínimo_mb:codec:nivel" separadas por comas;
+# se aplica la regla con el mayor tamaño mínimo que no supere el tamaño de la base de datos en backup_dbs.
+# Ejemplo: "0:zstd:9,1024:zstd:3,51200:lz4:1". Vacío = sin etapa (compresión de pg_dump y gpg, como antes).
+# En los dumps en paralelo (-F d) no hay etapa: el codec se traduce a la compresión de pg_dump.
+BACKUP_COMPRESSION = os.getenv('BACKUP_COMPRESSION', '')
+# Hilos del compresor (0 = todos los núcleos) para los codecs multihilo
+BACKUP_COMPRESSION_THREADS = int(os.getenv('BACKUP_COMPRESSION_THREADS', '0'))
+
+# Codecs disponibles: comando de compresión a stdout y extensión del archivo
+COMPRESSION_CODECS = {
+    'zstd': (lambda level, threads: ['zstd', '-q', '-c', f'-{level}', f'-T{threads}'], '.zst'),
+    'lz4': (lambda level, threads: ['lz4', '-q', '-c', f'-{level}'], '.lz4'),
+    'pigz': (lambda level, threads: ['pigz', '-c', f'-{level}'] + (['-p', str(threads)] if threads else []), '.gz'),
+    'gzip': (lambda level, threads: ['gzip', '-c', f'-{level}'], '.gz'),
+    'xz': (lambda level, threads: ['xz', '-c', f'-{level}', f'-T{threads}'], '.xz'),
+}
+
+# Planificador: número de trabajadores y orden de la cola (largest_first | smallest_first)
+BACKUP_WORKERS = int(os.getenv('BACKUP_WORKERS', '3'))
+BACKUP_ORDER = os.getenv('BACKUP_ORDER', 'largest_first')
+# Fallos consecutivos (ya sin reintentos) tras los que se detiene el proceso de backup
+BACKUP_MAX_CONSECUTIVE_FAILURES = int(os.getenv('BACKUP_MAX_CONSECUTIVE_FAILURES', str(3 * BACKUP_WORKERS)))
+# Reintentos de errores transitorios: intentos totales por base de datos y backoff exponencial con jitter
+BACKUP_MAX_ATTEMPTS = int(os.getenv('BACKUP_MAX_ATTEMPTS', '3'))
+BACKUP_RETRY_BASE_SECONDS = float(os.getenv('BACKUP_RETRY_BASE_SECONDS', '30'))
+BACKUP_RETRY_MAX_SECONDS = float(os.getenv('BACKUP_RETRY_MAX_SECONDS', '900'))
+
+# Errores que no se resuelven reintentando (expresiones regulares sobre el mensaje en minúsculas);
+# cualquier otro error se reintenta hasta BACKUP_MAX_ATTEMPTS. Solo la base de datos o el rol
+# inexistentes son permanentes: "relation with OID ... does not exist" es una carrera con un DDL
+# concurrente (una tabla eliminada durante el dump) y se reintenta.
+PERMANENT_ERROR_PATTERNS = (
+    r'permiso denegado', r'permission denied',
+    r'database "[^"]*" does not exist', r'la base de datos «[^»]*» no existe',
+    r'role "[^"]*" does not exist', r'el rol «[^»]*» no existe',
+    r'authentication failed', r'autenti(fi)?caci[oó]n \S+ fall[oó]',
+    r'no pg_hba\.conf entry', r'no hay una l[ií]nea en pg_hba\.conf',
+    r'no public key', r'public key not found', r'unusable public key',
+    r'server version mismatch', r'discordancia en la versi[oó]n del servidor',
+)
+
+# Almacenamiento: 'folders' (backup/YYYY-MM-DD/, copia completa por día) o
+# 'dedup' (repositorio deduplicado por chunks en BACKUP_STORE_DIR, ver backup_store.py)
+BACKUP_STORE = os.getenv('BACKUP_STORE', 'folders')
+BACKUP_STORE_DIR = os.getenv('BACKUP_STORE_DIR', os.path.join(BACKUP_DIR, 'store'))
+# Clave secreta con la que se nombran los chunks (HMAC-SHA256); obligatoria en modo 'dedup'
+BACKUP_STORE_KEY = os.getenv('BACKUP_STORE_KEY', '')
+
+# Índice de artefactos (ver backup_index.py) y política de retención por base de datos:
+# within_days, last, daily, weekly y monthly; el último backup de cada base de datos siempre se conserva
+BACKUP_INDEX_PATH = os.getenv('BACKUP_INDEX_PATH', os.path.join(BACKUP_DIR, 'index.sqlite3'))
+BACKUP_INDEX_CHECKSUM = os.getenv('BACKUP_INDEX_CHECKSUM', 'true').lower() in ('1', 'true', 'yes')
+BACKUP_RETENTION = backup_index.parse_retention_policy(os.getenv('BACKUP_RETENTION', f'within_days={RETENTION_DAYS}'))
+BACKUP_DELETE_WORKERS = int(os.getenv('BACKUP_DELETE_WORKERS', '8'))
+
+# Métricas en formato Prometheus: archivo para el textfile collector y/o puerto HTTP local (0 = desactivado)
+BACKUP_METRICS_TEXTFILE = os.getenv('BACKUP_METRICS_TEXTFILE', '')
+BACKUP_METRICS_PORT = int(os.getenv('BACKUP_METRICS_PORT', '0'))
+
+# Límites de lectura de pg_dump en MB/s, global y por trabajo (0 = sin límite)
+BACKUP_RATE_LIMIT_MB = float(os.getenv('BACKUP_RATE_LIMIT_MB', '0'))
+BACKUP_JOB_RATE_LIMIT_MB = float(os.getenv('BACKUP_JOB_RATE_LIMIT_MB', '0'))
+# Concurrencia adaptativa: umbrales de carga del servidor (0 = señal desactivada) y trabajadores mínimos
+BACKUP_MAX_ACTIVE_SESSIONS = int(os.getenv('BACKUP_MAX_ACTIVE_SESSIONS', '0'))
+BACKUP_MAX_REPLICATION_LAG_SECONDS = float(os.getenv('BACKUP_MAX_REPLICATION_LAG_SECONDS', '0'))
+BACKUP_MIN_WORKERS = int(os.getenv('BACKUP_MIN_WORKERS', '1'))
+BACKUP_LOAD_POLL_SECONDS = float(os.getenv('BACKUP_LOAD_POLL_SECONDS', '15'))
+LOAD_LIMITS = {
+    'active_sessions': BACKUP_MAX_ACTIVE_SESSIONS,
+    'replication_lag_seconds': BACKUP_MAX_REPLICATION_LAG_SECONDS,
+}
+ADAPTIVE_CONCURRENCY = any(limit > 0 for limit in LOAD_LIMITS.values())
+
+# Dumps en paralelo (-F d -j N) para bases de datos grandes, dentro de un presupuesto global de
+# conexiones de pg_dump: un dump normal usa 1 y uno con -j N usa N + 1 (el proceso líder y N workers)
+PARALLEL_DUMP_THRESHOLD_MB = int(os.getenv('BACKUP_PARALLEL_THRESHOLD_MB', '10240'))
+PARALLEL_DUMP_JOBS = int(os.getenv('BACKUP_PARALLEL_JOBS', '4'))
+BACKUP_JOB_BUDGET = int(os.getenv('BACKUP_JOB_BUDGET', str(max(BACKUP_WORKERS, os.cpu_count() or 1))))
+
+# Reclamación de trabajos: identificador del proceso y duración del lease en backup_dbs
+WORKER_ID = os.getenv('BACKUP_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = int(os.getenv('BACKUP_LEASE_SECONDS', '600'))
+HEARTBEAT_SECONDS = max(1, LEASE_SECONDS // 3)
+
+# Escrituras de estado agrupadas: se envían al llegar a STATUS_FLUSH_SIZE o cada STATUS_FLUSH_SECONDS
+STATUS_FLUSH_SIZE = int(os.getenv('BACKUP_STATUS_FLUSH_SIZE', '50'))
+STATUS_FLUSH_SECONDS = float(os.getenv('BACKUP_STATUS_FLUSH_SECONDS', '5'))
 
 # Configuración de logging
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(message)s')
+logger = core.get_logger('backup_postgres', LOG_FILE)
 
 def create_backup_dir():
     """Crear directorio de backup con la fecha actual"""
@@ -40,184 +142,906 @@ def create_backup_dir():
     os.makedirs(backup_path, exist_ok=True)
     return backup_path
 
-def log_message(message):
-    """Registrar un mensaje en el log"""
-    logging.info(message)
+def log_message(message, **fields):
+    """Registrar un mensaje en el log; se encola y un hilo en segundo plano lo escribe en el archivo"""
+    core.log(logger, message, **fields)
+
+# Campos de un trabajo que se registran en su línea de fin (ver log_job)
+JOB_LOG_FIELDS = ('status', 'attempt', 'queue_wait_seconds', 'dump_seconds', 'encrypt_seconds',
+                  'bytes_in', 'bytes_out', 'throughput_bytes_per_sec')
+
+def log_job(job):
+    """Línea de fin de un trabajo con sus tiempos y bytes como campos estructurados"""
+    seconds = (job['finished_at'] - job['started_at']).total_seconds()
+    log_message(f"INFO - Trabajo de backup terminado para DB: [{job['datname']}] con estado {job['status']} "
+                f"en {seconds:.1f}s", seconds=seconds, **{field: job[field] for field in JOB_LOG_FIELDS})
+
+def dump_env():
+    """Entorno de pg_dump con la contraseña del usuario de backup; os.environ no se modifica"""
+    return core.pg_env(DB_BPASSWORD)
+
+def control_connection():
+    """Conexión a la base de datos de control del pool compartido (ver db_admin_core.py)"""
+    return core.connection(DB_NAME, BACKUP_WORKERS + 2)
 
-def update_backup_status(databases, status):
-    """Actualizar el estado del backup en la base de datos"""
+def close_control_pool():
+    """Cerrar todas las conexiones del pool de control"""
+    core.close_pool(DB_NAME)
+
+# Transiciones de estado pendientes de escribir: {datname: (status, timestamp)}
+pending_status = {}
+# Filas de backup_history pendientes de insertar
+pending_history = []
+pending_status_lock = threading.Lock()
+flush_lock = threading.Lock()
+last_status_flush = time.monotonic()
+
+def update_backup_status(databases, status, fingerprint=None, next_attempt_at=None, error=None):
+    """Registrar el estado del backup; se escribe en backup_dbs en lotes con flush_backup_status()
+
+    Las transiciones de una misma base de datos se agrupan y solo se escribe la última.
+    El fingerprint (ver get_database_fingerprint) solo se guarda junto a un SUCCESS;
+    next_attempt_at, junto a un RETRY.
+    """
+    now = datetime.now()
+    with pending_status_lock:
+        for db in databases:
+            pending_status[db] = (status, now, fingerprint, next_attempt_at, error)
+        should_flush = (len(pending_status) >= STATUS_FLUSH_SIZE
+                        or time.monotonic() - last_status_flush >= STATUS_FLUSH_SECONDS)
+    if should_flush:
+        flush_backup_status()
+
+def flush_backup_status():
+    """Escribir las transiciones pendientes en un único UPDATE ... FROM (VALUES ...)
+
+    Seguro para llamarse desde los hilos del pool. Solo se actualizan las filas reclamadas
+    por este proceso, así un trabajador cuyo lease expiró no sobrescribe el estado de otro.
+    """
+    global last_status_flush
+    with flush_lock:
+        with pending_status_lock:
+            batch = dict(pending_status)
+            pending_status.clear()
+            history = list(pending_history)
+            pending_history.clear()
+            last_status_flush = time.monotonic()
+        if not batch and not history:
+            return
+
+        try:
+            with control_connection() as conn, conn.cursor() as cur:
+                if history:
+                    execute_values(cur, """
+                        INSERT INTO backup_history (datname, worker_id, status, attempt, started_at, finished_at,
+                            queue_wait_seconds, dump_seconds, encrypt_seconds, bytes_in, bytes_out, throughput_bytes_per_sec)
+                        VALUES %s;
+                    """, [(job['datname'], WORKER_ID, job['status'], job['attempt'], job['started_at'], job['finished_at'],
+                           job['queue_wait_seconds'], job['dump_seconds'], job['encrypt_seconds'], job['bytes_in'],
+                           job['bytes_out'], job['throughput_bytes_per_sec']) for job in history])
+                if not batch:
+                    return
+                execute_values(cur, """
+                    UPDATE backup_dbs b
+                    SET status = v.status,
+                    last_backup_date = v.changed_at,
+                    lease_expires_at = NULL,
+                    fingerprint = CASE WHEN v.status = 'SUCCESS' THEN v.fingerprint ELSE b.fingerprint END,
+                    last_success_date = CASE WHEN v.status = 'SUCCESS' THEN v.changed_at ELSE b.last_success_date END,
+                    attempts = CASE WHEN v.status = 'SUCCESS' THEN 0 ELSE b.attempts END,
+                    next_attempt_at = v.next_attempt_at,
+                    last_error = CASE WHEN v.status = 'SUCCESS' THEN NULL ELSE coalesce(v.error, b.last_error) END
+                    FROM (VALUES %s) AS v(datname, status, changed_at, fingerprint, worker_id, next_attempt_at, error)
+                    WHERE b.datname = v.datname
+                    AND b.worker_id = v.worker_id;
+                """, [(db, status, changed_at, fingerprint, WORKER_ID, next_attempt_at, error)
+                      for db, (status, changed_at, fingerprint, next_attempt_at, error) in batch.items()],
+                    template="(%s, %s, %s::timestamp, %s, %s, %s::timestamp, %s)", page_size=max(STATUS_FLUSH_SIZE, 1))
+        except Exception as e:
+            log_message(f"ERROR - Al actualizar el estado del backup para {list(batch)}: {e}")
+            with pending_status_lock:
+                # Reintentar en el siguiente flush sin pisar transiciones más recientes
+                for db, entry in batch.items():
+                    pending_status.setdefault(db, entry)
+                pending_history.extend(history)
+
+def record_backup_metrics(job):
+    """Registrar las métricas de un trabajo: exposición Prometheus y fila en backup_history"""
+    job = backup_metrics.record_job(job)
+    log_job(job)
+    with pending_status_lock:
+        pending_history.append(job)
+
+def export_metrics():
+    """Escribir el archivo del textfile collector si está configurado"""
+    if BACKUP_METRICS_TEXTFILE:
+        try:
+            backup_metrics.write_textfile(BACKUP_METRICS_TEXTFILE)
+        except Exception as e:
+            log_message(f"ERROR - Al escribir las métricas en {BACKUP_METRICS_TEXTFILE}: {e}")
+
+def get_database_fingerprint(db):
+    """Obtener un fingerprint barato de la actividad de escritura de una base de datos
+
+    Se basa en los contadores tup_* de pg_stat_database y en stats_reset (un reinicio de
+    estadísticas cuenta como cambio). Debe coincidir con la expresión usada en sync_databases().
+    Se toma antes del dump, así cualquier escritura durante el backup provoca otro en la siguiente ejecución.
+    Se lee del catálogo compartido (core.database_fingerprints), que ya llena sync_databases si se
+    ejecutó antes en el mismo proceso; un fingerprint anterior al dump solo puede adelantar el siguiente backup.
+    """
     try:
-        conn = psycopg2.connect(host=PGHOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE backup_dbs 
-            SET status = %s,
-            last_backup_date = CURRENT_TIMESTAMP
-            WHERE datname = ANY(%s);
-        """, (status, databases))
-        conn.commit()
-        cur.close()
-        conn.close()
+        fingerprints = core.database_fingerprints(DB_NAME)
+        if db not in fingerprints:
+            # Base de datos creada después de consultar el catálogo
+            core.invalidate_catalog()
+            fingerprints = core.database_fingerprints(DB_NAME)
+        return fingerprints.get(db)
     except Exception as e:
-        log_message(f"ERROR - Al actualizar el estado del backup para {databases}: {e}")
+        log_message(f"ERROR - Al obtener el fingerprint de la base de datos {db}: {e}")
+        return None
 
-def get_databases_to_backup(limit):
-    """Obtener la lista de bases de datos que necesitan backup"""
-    try:
-        conn = psycopg2.connect(host=PGHOST, user=DB_BUSER, password=DB_BPASSWORD, dbname=DB_NAME)
-        cur = conn.cursor()
-        query = """SELECT datname FROM backup_dbs
+def claim_databases_to_backup(limit):
+    """Reclamar de forma atómica las siguientes bases de datos PENDING para este proceso
+
+    UPDATE ... RETURNING con FOR UPDATE SKIP LOCKED permite ejecutar varios procesos o
+    hosts de backup a la vez sin que dos de ellos respalden la misma base de datos.
+    El orden sigue el rank calculado por sync_databases() (rank 1 = la más pequeña).
+    También se reclaman los RETRY cuyo next_attempt_at ya pasó; next_attempt_at se escribe
+    con el reloj del trabajador, así que se compara con datetime.now() y no con el del servidor.
+    Devuelve una lista de tuplas (datname, tamaño en bytes o None, número de intento).
+    """
+    order = 'DESC' if BACKUP_ORDER == 'largest_first' else 'ASC'
+    query = f"""
+            UPDATE backup_dbs b
+            SET status = 'IN_PROGRESS',
+                worker_id = %s,
+                heartbeat_at = CURRENT_TIMESTAMP,
+                lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                attempts = b.attempts + 1,
+                next_attempt_at = NULL
+            FROM (
+                SELECT datname FROM backup_dbs
                 WHERE status = 'PENDING'
-                ORDER BY rank
-                LIMIT %s;"""
-        cur.execute(query, (limit,))
-        databases = [row[0] for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        log_message(f"Bases de datos obtenidas: {len(databases)}")
+                OR (status = 'RETRY' AND next_attempt_at <= %s)
+                ORDER BY rank {order} NULLS LAST
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) claimed
+            WHERE b.datname = claimed.datname
+            RETURNING b.datname, b.rank, b.size_bytes, b.attempts;"""
+    try:
+        with control_connection() as conn, conn.cursor() as cur:
+            cur.execute(query, (WORKER_ID, LEASE_SECONDS, datetime.now(), limit))
+            rows = sorted(cur.fetchall(), key=lambda row: row[1] if row[1] is not None else 0,
+                          reverse=(order == 'DESC'))
+        databases = [(row[0], row[2], row[3]) for row in rows]
+        log_message(f"Bases de datos reclamadas por [{WORKER_ID}]: {len(databases)}")
         return databases
     except Exception as e:
         log_message(f"ERROR - Al obtener la lista de bases de datos: {e}")
         return []
 
-def encrypt_file_with_gpg(file_path):
-    """Cifrar un archivo usando GPG"""
+def release_expired_leases():
+    """Devolver a PENDING las bases de datos IN_PROGRESS cuyo lease expiró (procesos caídos)"""
     try:
-        encrypted_file_path = file_path + '.gpg'
-        subprocess.run(['gpg', '--yes', '--output', encrypted_file_path, '--encrypt', '--recipient', GPGNAME, file_path], check=True)
-        os.remove(file_path)
-        return encrypted_file_path
-    except subprocess.CalledProcessError as e:
-        log_message(f"ERROR - Al cifrar el archivo {file_path} con GnuPG: {e}")
+        with control_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE backup_dbs
+                SET status = 'PENDING',
+                    worker_id = NULL,
+                    lease_expires_at = NULL
+                WHERE status = 'IN_PROGRESS'
+                AND lease_expires_at < CURRENT_TIMESTAMP
+                RETURNING datname;
+            """)
+            released = [row[0] for row in cur.fetchall()]
+        if released:
+            log_message(f"INFO - Leases expirados devueltos a PENDING: {released}")
+        return released
+    except Exception as e:
+        log_message(f"ERROR - Al liberar los leases expirados: {e}")
+        return []
+
+def renew_leases():
+    """Renovar el lease de todas las bases de datos IN_PROGRESS de este proceso"""
+    try:
+        with control_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE backup_dbs
+                SET heartbeat_at = CURRENT_TIMESTAMP,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE status = 'IN_PROGRESS'
+                AND worker_id = %s;
+            """, (LEASE_SECONDS, WORKER_ID))
+    except Exception as e:
+        log_message(f"ERROR - Al renovar los leases de [{WORKER_ID}]: {e}")
+
+def heartbeat_loop(stop_event):
+    """Hilo de heartbeat: renueva los leases y escribe los estados pendientes hasta que se detiene el backup
+
+    En cada renovación también devuelve a PENDING los leases expirados de otros procesos, así
+    las bases de datos de un host caído se reclaman durante esta ejecución y no en la siguiente.
+    """
+    interval = min(HEARTBEAT_SECONDS, STATUS_FLUSH_SECONDS)
+    last_renewal = time.monotonic()
+    while not stop_event.wait(interval):
+        flush_backup_status()
+        export_metrics()
+        if time.monotonic() - last_renewal >= HEARTBEAT_SECONDS:
+            renew_leases()
+            release_expired_leases()
+            last_renewal = time.monotonic()
+
+# Bucket global de ancho de banda y trabajadores permitidos por la carga actual del servidor
+global_bucket = backup_throttle.make_bucket(BACKUP_RATE_LIMIT_MB)
+allowed_workers = BACKUP_WORKERS
+
+def job_throttle():
+    """Buckets de ancho de banda para un nuevo trabajo (lista vacía si no hay límites)"""
+    return backup_throttle.job_buckets(global_bucket, BACKUP_JOB_RATE_LIMIT_MB)
+
+def get_server_load():
+    """Señales de carga del servidor de origen: sesiones activas ajenas al backup y lag de replicación"""
+    with control_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                (SELECT count(*) FROM pg_stat_activity
+                 WHERE state = 'active'
+                 AND backend_type = 'client backend'
+                 AND usename IS DISTINCT FROM %s
+                 AND pid <> pg_backend_pid()),
+                (SELECT coalesce(extract(epoch FROM max(replay_lag)), 0) FROM pg_stat_replication);
+        """, (DB_BUSER,))
+        active_sessions, replication_lag = cur.fetchone()
+    return {'active_sessions': active_sessions, 'replication_lag_seconds': float(replication_lag)}
+
+def load_monitor_loop(stop_event):
+    """Hilo que ajusta allowed_workers según la carga del servidor cada BACKUP_LOAD_POLL_SECONDS"""
+    global allowed_workers
+    while not stop_event.wait(BACKUP_LOAD_POLL_SECONDS):
+        try:
+            load = get_server_load()
+        except Exception as e:
+            log_message(f"ERROR - Al consultar la carga del servidor: {e}")
+            continue
+        workers = backup_throttle.adjust_concurrency(allowed_workers, BACKUP_MIN_WORKERS, BACKUP_WORKERS,
+                                                     load, LOAD_LIMITS)
+        if workers != allowed_workers:
+            log_message(f"INFO - Concurrencia de backup {allowed_workers} -> {workers} (sesiones activas: "
+                        f"{load['active_sessions']}, lag de replicación: {load['replication_lag_seconds']:.1f} s)")
+            allowed_workers = workers
+
+def encrypt_file_with_gpg(file_path, compression=None):
+    """Cifrar un archivo usando GPG; el archivo en claro se elimina aunque gpg falle
+
+    Un fallo de gpg se propaga como CalledProcessError con su stderr, que backup_database
+    registra como error del backup (y decide si es un error permanente, p. ej. 'no public key').
+    """
+    encrypted_file_path = file_path + '.gpg'
+    try:
+        subprocess.run(gpg_encrypt_command(compression) + ['--output', encrypted_file_path, file_path],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    finally:
         if os.path.exists(file_path):
-            os.remove(file_path)  # Eliminar el archivo de backup en caso de error
-        return None
+            os.remove(file_path)
+    return encrypted_file_path
 
-def backup_database(db, backup_path):
-    """Realizar el backup de una base de datos y cifrar el archivo"""
-    backup_file = os.path.join(backup_path, f"{db}.backup")
-    
+def copy_stream(source, target, metrics, throttle=()):
+    """Copiar la salida de la primera etapa a la segunda contando los bytes (hilo de relay)"""
     try:
-        update_backup_status([db], 'IN_PROGRESS')
-        start_time = datetime.now()
-        
-        with open(backup_file, 'wb') as f:
-            subprocess.run([PG_DUMP_PATH, '-h', PGHOST, '-U', DB_BUSER, '-d', db, '-F', 'c'], stdout=f, stderr=subprocess.PIPE, check=True)
-        
-        encrypted_backup_file = encrypt_file_with_gpg(backup_file)
-        if not encrypted_backup_file:
-            update_backup_status([db], 'FAILED')
-            return db, False
-        
-        end_time = datetime.now()
-        file_size = os.path.getsize(encrypted_backup_file)
-        log_message(f"INFO - Backup completado y cifrado para DB: [{db}] en {end_time - start_time}, size del archivo: {file_size} bytes")
-        update_backup_status([db], 'SUCCESS')
-        return db, True
-
-    except subprocess.CalledProcessError as e:
-        error_message = ""
-        if e.stderr:
-            try:
-                error_message = e.stderr.decode().strip()
-            except Exception as decode_error:
-                # log_message(f"ERROR - Decodificación de stderr fallida: {decode_error}")
-                error_message = str(e)
-
-        if not error_message:
-            error_message = str(e)
-        
-        log_message(f"ERROR - Al respaldar la base de datos {db}: {error_message}")
-
-        if "permiso denegado" in error_message.lower():
-            update_backup_status([db], 'NO_PERMISSIONS')
-        else:
-            update_backup_status([db], 'FAILED')
+        while True:
+            data = source.read1(1024 * 1024)
+            if not data:
+                break
+            metrics['bytes_in'] += len(data)
+            backup_throttle.throttle(throttle, len(data))
+            target.write(data)
+    except (BrokenPipeError, ValueError):
+        pass  # La etapa siguiente terminó: al cerrar source la primera recibe SIGPIPE
+    finally:
+        source.close()
+        try:
+            target.close()
+        except BrokenPipeError:
+            pass
+
+def run_pipeline(commands, output_path, metrics=None, throttle=()):
+    """Encadenar procesos mediante pipes y escribir la salida del último en output_path.
+
+    El stderr de cada proceso se guarda en un archivo temporal para no bloquear los pipes.
+    Si algún proceso falla se lanza CalledProcessError con su stderr, priorizando el
+    primero que no haya terminado por SIGPIPE (consecuencia del fallo de otro proceso).
+    Con metrics, la salida de la primera etapa pasa por un hilo de relay que cuenta los bytes
+    en metrics['bytes_in'] y aplica los buckets de throttle.
+    La contraseña de pg_dump solo se pasa en el entorno de estos procesos (dump_env()).
+    Devuelve (segundos hasta que termina la primera etapa, segundos totales).
+    """
+    processes = []
+    stderr_files = []
+    relay = None
+    start = time.monotonic()
+    try:
+        with open(output_path, 'wb') as output:
+            prev_stdout = None
+            for i, cmd in enumerate(commands):
+                is_last = i == len(commands) - 1
+                relayed = metrics is not None and i == 1
+                err = tempfile.TemporaryFile()
+                stderr_files.append(err)
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if relayed else prev_stdout,
+                                        stdout=output if is_last and (i or metrics is None) else subprocess.PIPE,
+                                        stderr=err, env=dump_env())
+                if relayed:
+                    relay = threading.Thread(target=copy_stream, args=(prev_stdout, proc.stdin, metrics, throttle),
+                                             daemon=True)
+                    relay.start()
+                elif prev_stdout is not None:
+                    prev_stdout.close()  # Solo el proceso siguiente debe mantener el pipe abierto
+                prev_stdout = proc.stdout
+                processes.append(proc)
+            if metrics is not None and len(commands) == 1:
+                # Una sola etapa: el relay escribe directamente en el archivo de salida
+                relay = threading.Thread(target=copy_stream, args=(prev_stdout, output, metrics, throttle), daemon=True)
+                relay.start()
+
+            processes[0].wait()
+            first_stage_end = time.monotonic()
+            for proc in processes[1:]:
+                proc.wait()
+            if relay is not None:
+                relay.join()
+        end = time.monotonic()
+
+        failed = [(proc, err) for proc, err in zip(processes, stderr_files) if proc.returncode != 0]
+        if failed:
+            primary = [f for f in failed if f[0].returncode != -signal.SIGPIPE] or failed
+            proc, err = primary[0]
+            err.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err.read())
+        return first_stage_end - start, end - start
+    finally:
+        for proc in processes:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if relay is not None:
+            relay.join()
+        for err in stderr_files:
+            err.close()
+
+# Presupuesto global de conexiones de pg_dump compartido por todos los trabajadores
+available_jobs = BACKUP_JOB_BUDGET
+jobs_condition = threading.Condition()
+
+def dump_connections(jobs):
+    """Conexiones que abre pg_dump con `jobs` jobs: -j N abre N + 1, un dump normal 1"""
+    return jobs + 1 if jobs > 1 else 1
+
+def acquire_dump_jobs(wanted):
+    """Reservar entre 1 y `wanted` jobs del presupuesto global; espera solo si no queda ninguno libre
+
+    Se descuentan las conexiones que abrirá pg_dump (dump_connections), no solo los jobs.
+    Tomar lo que esté disponible en lugar de esperar a los N jobs evita que un dump grande
+    quede bloqueado indefinidamente por los dumps pequeños que siguen entrando.
+    """
+    global available_jobs
+    with jobs_condition:
+        while available_jobs < 1:
+            jobs_condition.wait()
+        jobs = min(wanted, available_jobs - 1)
+        if jobs < 2:
+            jobs = 1
+        available_jobs -= dump_connections(jobs)
+        return jobs
+
+def release_dump_jobs(jobs):
+    """Devolver al presupuesto global las conexiones de un dump con `jobs` jobs"""
+    global available_jobs
+    with jobs_condition:
+        available_jobs += dump_connections(jobs)
+        jobs_condition.notify_all()
+
+def parse_compression_rules(rules):
+    """Convertir BACKUP_COMPRESSION en una lista [(bytes mínimos, codec, nivel)] ordenada por tamaño"""
+    parsed = []
+    for rule in filter(None, (r.strip() for r in rules.split(','))):
+        min_size_mb, codec, level = rule.split(':')
+        if codec not in COMPRESSION_CODECS and codec != 'none':
+            raise ValueError(f"Codec de compresión desconocido: {codec}")
+        parsed.append((int(float(min_size_mb) * 1024 ** 2), codec, int(level)))
+    return sorted(parsed)
 
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
-        return db, False
+# Se cargan en load_compression_rules() al arrancar main(); hasta entonces no hay etapa de compresión
+COMPRESSION_RULES = []
+
+def load_compression_rules():
+    """Validar BACKUP_COMPRESSION y cargar sus reglas; registra el error y devuelve False si no es válido"""
+    global COMPRESSION_RULES
+    try:
+        COMPRESSION_RULES = parse_compression_rules(BACKUP_COMPRESSION)
+    except ValueError as e:
+        log_message(f"ERROR - BACKUP_COMPRESSION no válido ({BACKUP_COMPRESSION!r}): {e}")
+        return False
+    return True
+
+def select_compression(size_bytes):
+    """Elegir (codec, nivel) para una base de datos según su tamaño; None si no hay etapa de compresión"""
+    selected = None
+    for min_size, codec, level in COMPRESSION_RULES:
+        if size_bytes is None and selected is not None:
+            break  # Sin datos de tamaño se usa la regla de las bases de datos más pequeñas
+        if size_bytes is None or size_bytes >= min_size:
+            selected = (codec, level)
+    return None if selected is None or selected[0] == 'none' else selected
+
+def gpg_encrypt_command(compression=None):
+    """Comando gpg de cifrado; sin su compresión cuando los datos pasan antes por un codec externo"""
+    command = ['gpg', '--yes', '--batch', '--encrypt', '--recipient', GPGNAME]
+    if compression:
+        command += ['--compress-algo', 'none']  # Los datos ya vienen comprimidos
+    return command
+
+def encryption_stages(compression=None):
+    """Comandos [compresor] -> gpg que siguen al productor del flujo y la extensión que añaden"""
+    commands = []
+    extension = ''
+
+    if compression:
+        codec, level = compression
+        command, codec_extension = COMPRESSION_CODECS[codec]
+        commands.append(command(level, BACKUP_COMPRESSION_THREADS))
+        extension += codec_extension
+
+    commands.append(gpg_encrypt_command(compression))
+    return commands, extension + '.gpg'
+
+def pg_dump_compression_args(compression):
+    """Desactivar la compresión propia de pg_dump cuando el flujo tiene su etapa de compresión"""
+    return ['-Z', '0'] if compression else []
+
+@functools.lru_cache(maxsize=None)
+def pg_dump_major_version():
+    """Versión mayor de pg_dump (0 si no se puede obtener)"""
+    try:
+        output = subprocess.run([PG_DUMP_PATH, '--version'], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    match = re.search(r'(\d+)', output)
+    return int(match.group(1)) if match else 0
+
+def directory_dump_compression_args(compression):
+    """Compresión de pg_dump -F d para el codec elegido; nunca -Z 0
+
+    En formato directorio no hay flujo que comprimir antes de escribir, así que pg_dump
+    comprime cada archivo: zstd y lz4 con su propio método (PostgreSQL 16+), gzip y pigz con el
+    nivel de gzip. Un codec sin equivalente en pg_dump usa su gzip por defecto.
+    """
+    if not compression:
+        return []
+    codec, level = compression
+    if codec in ('zstd', 'lz4') and pg_dump_major_version() >= 16:
+        return ['-Z', f'{codec}:{level}']
+    if codec in ('gzip', 'pigz'):
+        return ['-Z', str(min(max(level, 1), 9))]
+    return []
+
+def build_directory_dump_command(db, jobs, dump_dir, compression=None):
+    """Comando pg_dump -F d -j jobs comprimido por pg_dump (ver directory_dump_compression_args)"""
+    return ([PG_DUMP_PATH, '-h', PGHOST, '-U', DB_BUSER, '-d', db, '-F', 'd', '-j', str(jobs), '-f', dump_dir]
+            + directory_dump_compression_args(compression))
+
+def directory_tar_stages(compression=None):
+    """Comandos tar -> gpg que empaquetan y cifran un dump en formato directorio y su extensión
+
+    Los archivos del directorio ya vienen comprimidos por pg_dump: sin codec externo y, si se
+    eligió un codec, sin la compresión de gpg.
+    """
+    return [gpg_encrypt_command(compression)], '.backup.tar.gpg'
+
+def build_backup_pipeline(db, compression=None):
+    """Construir la lista de comandos pg_dump -> [compresor] -> gpg y la extensión del archivo"""
+    stages, extension = encryption_stages(compression)
+    dump_cmd = [PG_DUMP_PATH, '-h', PGHOST, '-U', DB_BUSER, '-d', db, '-F', 'c'] + pg_dump_compression_args(compression)
+    return [dump_cmd] + stages, '.backup' + extension
+
+def dump_database_streaming(db, backup_path, compression, metrics, throttle):
+    """Respaldar y cifrar una base de datos en un único flujo, sin escribir el dump en claro
+
+    Las etapas corren a la vez: encrypt_seconds es lo que tardan compresor y gpg en
+    terminar después de que pg_dump acaba.
+    """
+    commands, extension = build_backup_pipeline(db, compression)
+    encrypted_backup_file = os.path.join(backup_path, f"{db}{extension}")
+    dump_seconds, total_seconds = run_pipeline(commands, encrypted_backup_file, metrics, throttle)
+    metrics['dump_seconds'] = dump_seconds
+    metrics['encrypt_seconds'] = total_seconds - dump_seconds
+    return encrypted_backup_file
+
+def dump_database_to_file(db, backup_path, compression, metrics, throttle):
+    """Respaldar en un archivo .backup y cifrarlo después con GPG (modo en dos pasos)
+
+    Con un codec, el dump se comprime al escribirse (pg_dump -> compresor -> .backup.zst...)
+    y gpg cifra ese archivo sin volver a comprimirlo.
+    """
+    commands, extension = build_backup_pipeline(db, compression)
+    backup_file = os.path.join(backup_path, f"{db}{extension[:-len('.gpg')]}")
+    _, metrics['dump_seconds'] = run_pipeline(commands[:-1], backup_file, metrics, throttle)
+    start = time.monotonic()
+    encrypted_backup_file = encrypt_file_with_gpg(backup_file, compression)
+    metrics['encrypt_seconds'] = time.monotonic() - start
+    return encrypted_backup_file
+
+def dump_database_parallel(db, backup_path, jobs, compression, metrics):
+    """Respaldar en formato directorio con `jobs` procesos y empaquetar el directorio en un único flujo cifrado
+
+    pg_dump -F d no puede escribir en stdout, así que el directorio se crea en backup_path,
+    comprimido por el propio pg_dump, y se elimina en cuanto el tar cifrado está completo. Como pg_dump escribe directamente
+    en el directorio, el límite de ancho de banda no se aplica a estos dumps; su carga se
+    controla con BACKUP_JOB_BUDGET y la concurrencia adaptativa.
+    """
+    dump_dir = os.path.join(backup_path, f"{db}.backup.dir")
+    if os.path.isdir(dump_dir):
+        shutil.rmtree(dump_dir)
+    try:
+        start = time.monotonic()
+        subprocess.run(build_directory_dump_command(db, jobs, dump_dir, compression),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, env=dump_env())
+        metrics['dump_seconds'] = time.monotonic() - start
+        stages, extension = directory_tar_stages(compression)
+        encrypted_backup_file = os.path.join(backup_path, f"{db}{extension}")
+        _, metrics['encrypt_seconds'] = run_pipeline([['tar', '-C', dump_dir, '-cf', '-', '.']] + stages,
+                                                     encrypted_backup_file, metrics)
+        return encrypted_backup_file
+    finally:
+        shutil.rmtree(dump_dir, ignore_errors=True)
+
+def dump_database_dedup(db, metrics, throttle):
+    """Respaldar una base de datos en el repositorio deduplicado y escribir su manifiesto
+
+    El dump se genera sin compresión (-Z 0) para que los datos sin cambios produzcan los
+    mismos chunks entre ejecuciones; cada chunk nuevo se comprime y cifra con GPG.
+    Siempre es un único flujo -F c: un dump -F d sin comprimir escribiría la base de datos
+    entera en claro en disco antes de trocearla.
+    """
+    start = time.monotonic()
+    cmd = [PG_DUMP_PATH, '-h', PGHOST, '-U', DB_BUSER, '-d', db, '-F', 'c', '-Z', '0']
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err, env=dump_env())
+        try:
+            stream = backup_throttle.ThrottledReader(proc.stdout, throttle) if throttle else proc.stdout
+            chunks, stats = backup_store.backup_stream(BACKUP_STORE_DIR, stream, GPGNAME, BACKUP_STORE_KEY.encode())
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            err.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=err.read())
+
+    manifest_path = backup_store.write_manifest(BACKUP_STORE_DIR, db, chunks, 'custom')
+    # El cifrado de cada chunk ocurre durante el dump: todo el tiempo cuenta como dump
+    metrics['dump_seconds'] = time.monotonic() - start
+    metrics['bytes_in'] = stats['bytes_in']
+    metrics['bytes_out'] = stats['bytes_written']
+    log_message(f"INFO - Dedup DB: [{db}] {stats['bytes_in']} bytes leídos, {stats['new_chunks']}/{stats['chunks']} chunks nuevos, "
+                f"{stats['bytes_written']} bytes escritos")
+    return manifest_path
+
+def remove_partial_backups(db, backup_path):
+    """Eliminar los archivos y directorios parciales de una base de datos tras un error
+
+    Solo se eliminan los nombres exactos de esta base de datos: el dump sin cifrar (comprimido
+    o no), el directorio de -F d y los artefactos cifrados (backup_index.ARTIFACT_NAME). Un
+    prefijo no basta porque 'foo.backup.' también es el comienzo de los archivos de 'foo.backup.x'.
+    """
+    scratch_names = {f"{db}.backup", f"{db}.backup.dir"}
+    scratch_names.update(f"{db}.backup{extension}" for _, extension in COMPRESSION_CODECS.values())
+    for name in os.listdir(backup_path):
+        match = backup_index.ARTIFACT_NAME.match(name)
+        if name in scratch_names or (match and match.group('datname') == db):
+            path = os.path.join(backup_path, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.isfile(path):
+                os.remove(path)
+
+def process_error_message(error):
+    """Mensaje de un CalledProcessError: el stderr del proceso o, si no hay, la excepción"""
+    error_message = ""
+    if error.stderr:
+        try:
+            error_message = error.stderr.decode().strip()
+        except Exception:
+            error_message = str(error)
+    return error_message or str(error)
+
+def backup_error_status(error_message):
+    """Estado de backup_dbs que corresponde a un error de pg_dump"""
+    message = error_message.lower()
+    if "permiso denegado" in message or "permission denied" in message:
+        return 'NO_PERMISSIONS'
+    return 'FAILED'
+
+def is_transient_error(error_message):
+    """Un error es transitorio (se reintenta) salvo que coincida con PERMANENT_ERROR_PATTERNS"""
+    message = error_message.lower()
+    return not any(re.search(pattern, message) for pattern in PERMANENT_ERROR_PATTERNS)
+
+def retry_delay(attempt):
+    """Backoff exponencial con jitter: entre la mitad y el total de base * 2^(intento - 1), con tope"""
+    delay = min(BACKUP_RETRY_MAX_SECONDS, BACKUP_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def plan_retry(db, attempt, error_message, status='FAILED'):
+    """Estado tras un fallo: RETRY si el error es transitorio y quedan intentos, si no `status`
+
+    Devuelve (estado, fecha del siguiente intento o None).
+    """
+    if status == 'FAILED' and is_transient_error(error_message) and attempt < BACKUP_MAX_ATTEMPTS:
+        delay = retry_delay(attempt)
+        log_message(f"INFO - Reintento {attempt + 1}/{BACKUP_MAX_ATTEMPTS} de la DB: [{db}] en {delay:.0f} s")
+        return 'RETRY', datetime.now() + timedelta(seconds=delay)
+    return status, None
+
+def record_backup_failure(db, attempt, error_message, status='FAILED'):
+    """Registrar un fallo en backup_dbs (RETRY con next_attempt_at o el estado final)"""
+    status, next_attempt_at = plan_retry(db, attempt, error_message, status)
+    update_backup_status([db], status, next_attempt_at=next_attempt_at, error=error_message[:1000])
+    if status == 'RETRY':
+        # Sin esperar al lote: hasta que se escribe, la fila sigue IN_PROGRESS con el lease de
+        # este proceso y nadie puede reclamar el reintento cuando vence el backoff
+        flush_backup_status()
+    return status, next_attempt_at
+
+def backup_database(db, backup_path, size_bytes=None, claimed_at=None, attempt=1):
+    """Realizar el backup de una base de datos y cifrar el archivo
+
+    Las bases de datos por encima de BACKUP_PARALLEL_THRESHOLD_MB se respaldan en formato
+    directorio con varios jobs, tomados del presupuesto global BACKUP_JOB_BUDGET (salvo en modo
+    'dedup', que siempre usa un único flujo). El codec de
+    compresión se elige según el tamaño con las reglas de BACKUP_COMPRESSION.
+    Los mensajes del trabajo llevan job_id, datname y attempt en el log (ver job_context).
+    Devuelve (db, estado final o RETRY, fecha del siguiente intento o None).
+    """
+    parallel = (BACKUP_STORE != 'dedup' and size_bytes is not None
+                and size_bytes >= PARALLEL_DUMP_THRESHOLD_MB * 1024 ** 2)
+    compression = select_compression(size_bytes)
+    jobs = acquire_dump_jobs(PARALLEL_DUMP_JOBS if parallel else 1)
+    jobs_held = True
+    throttle = job_throttle()
+    metrics = {
+        'datname': db, 'status': 'FAILED', 'attempt': attempt,
+        'started_at': datetime.now(), 'finished_at': None,
+        'queue_wait_seconds': time.monotonic() - claimed_at if claimed_at is not None else 0.0,
+        'dump_seconds': 0.0, 'encrypt_seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0,
+    }
+    with core.job_context(job_id=uuid.uuid4().hex, datname=db, attempt=attempt, worker_id=WORKER_ID):
+        try:
+            start_time = datetime.now()
+            fingerprint = get_database_fingerprint(db)
+
+            if BACKUP_STORE == 'dedup':
+                encrypted_backup_file = dump_database_dedup(db, metrics, throttle)
+            elif parallel and jobs > 1:
+                log_message(f"INFO - Backup en paralelo para DB: [{db}] con {jobs} jobs")
+                encrypted_backup_file = dump_database_parallel(db, backup_path, jobs, compression, metrics)
+            elif BACKUP_STREAMING:
+                encrypted_backup_file = dump_database_streaming(db, backup_path, compression, metrics, throttle)
+            else:
+                encrypted_backup_file = dump_database_to_file(db, backup_path, compression, metrics, throttle)
+
+            end_time = datetime.now()
+            # El registro en el índice (con el sha256, que relee el artefacto) ya no usa conexiones de pg_dump
+            release_dump_jobs(jobs)
+            jobs_held = False
+            if BACKUP_STORE == 'dedup':
+                # El manifiesto ocupa unos pocos KB: el tamaño que importa es el del dump
+                file_size = metrics['bytes_in']
+                size_label = "size del dump"
+            else:
+                file_size = os.path.getsize(encrypted_backup_file)
+                metrics['bytes_out'] = metrics['bytes_out'] or file_size
+                size_label = "size del archivo"
+            metrics['status'] = 'SUCCESS'
+            log_message(f"INFO - Backup completado y cifrado para DB: [{db}] en {end_time - start_time}, {size_label}: {file_size} bytes")
+            index_artifact(db, encrypted_backup_file, file_size, end_time)
+            update_backup_status([db], 'SUCCESS', fingerprint)
+            return db, 'SUCCESS', None
+
+        except subprocess.CalledProcessError as e:
+            error_message = process_error_message(e)
+            log_message(f"ERROR - Al respaldar la base de datos {db}: {error_message}")
+            remove_partial_backups(db, backup_path)
+            metrics['status'], next_attempt_at = record_backup_failure(db, attempt, error_message,
+                                                                       backup_error_status(error_message))
+            return db, metrics['status'], next_attempt_at
+        except Exception as e:
+            log_message(f"ERROR - backup_database - Al respaldar la base de datos {db}: {e}")
+            remove_partial_backups(db, backup_path)
+            metrics['status'], next_attempt_at = record_backup_failure(db, attempt, str(e))
+            return db, metrics['status'], next_attempt_at
+        finally:
+            if jobs_held:
+                release_dump_jobs(jobs)
+            metrics['finished_at'] = datetime.now()
+            record_backup_metrics(metrics)
+
+def index_artifact(db, path, size_bytes, created_at):
+    """Registrar el artefacto de un backup exitoso en el índice; un fallo aquí no invalida el backup"""
+    try:
+        kind = 'manifest' if BACKUP_STORE == 'dedup' else 'file'
+        if kind == 'manifest':
+            with open(path) as f:
+                size_bytes = json.load(f)['size']
+        sha256 = backup_index.file_sha256(path) if BACKUP_INDEX_CHECKSUM else None
+        backup_index.record_artifact(db, path, kind, size_bytes, sha256, created_at, BACKUP_INDEX_PATH)
     except Exception as e:
-        log_message(f"ERROR - backup_database - Al respaldar la base de datos {db}: {e}")
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
-        update_backup_status([db], 'FAILED')
-        return db, False
+        log_message(f"ERROR - Al registrar el backup de {db} en el índice: {e}")
+
+def ensure_backup_index():
+    """Reconstruir el índice recorriendo los backups en disco si todavía no existe"""
+    if os.path.exists(BACKUP_INDEX_PATH):
+        return
+    try:
+        count = backup_index.rebuild_index(BACKUP_DIR, BACKUP_STORE_DIR, BACKUP_INDEX_CHECKSUM, BACKUP_INDEX_PATH)
+        log_message(f"INFO - Índice de backups creado en {BACKUP_INDEX_PATH} con {count} artefactos existentes")
+    except Exception as e:
+        log_message(f"ERROR - Al reconstruir el índice de backups: {e}")
 
 def delete_old_backups():
-    """Eliminar backups antiguos que exceden el período de retención"""
-    retention_date = datetime.now() - timedelta(days=RETENTION_DAYS)
-    log_message(f"Eliminando backups anteriores a {retention_date.strftime('%Y-%m-%d')}")
-    for folder in os.listdir(BACKUP_DIR):
-        folder_path = os.path.join(BACKUP_DIR, folder)
-        if os.path.isdir(folder_path):
-            try:
-                folder_date = datetime.strptime(folder, "%Y-%m-%d")
-                if folder_date < retention_date:
-                    shutil.rmtree(folder_path)
-                    log_message(f"INFO - Backup antiguo eliminado: {folder_path}")
-            except ValueError:
-                # No es una carpeta con formato de fecha válido, ignorar
-                continue
-            except Exception as e:
-                log_message(f"ERROR - Al eliminar el backup antiguo {folder}: {e}")
+    """Eliminar los backups que ninguna regla de BACKUP_RETENTION conserva
 
-def main():
-    """Función principal para la ejecución del script de backup"""
-    backup_path = create_backup_dir()
-    log_message(f"Directorio de backup: {backup_path}")
+    Los artefactos a eliminar se seleccionan sobre el índice y se borran en paralelo. Antes se
+    registran los que no llegaron al índice (si falló index_artifact) para que la política también
+    los alcance: solo se recorren las carpetas y manifiestos entre el último barrido y la ventana
+    within_days (ver backup_index.sweep_unindexed).
+    En el repositorio deduplicado se eliminan los manifiestos y después los chunks que quedaron
+    sin referencias.
+    """
+    try:
+        cutoff = datetime.now() - timedelta(days=BACKUP_RETENTION['within_days'])
+        swept = backup_index.sweep_unindexed(BACKUP_DIR, BACKUP_STORE_DIR, until=cutoff, index_path=BACKUP_INDEX_PATH)
+        if swept:
+            log_message(f"WARNING - Retención: {len(swept)} backups anteriores a {cutoff:%Y-%m-%d} no estaban en el índice; "
+                        f"se registran y se les aplica la política")
+        expired = backup_index.select_expired(backup_index.list_artifacts(index_path=BACKUP_INDEX_PATH),
+                                              BACKUP_RETENTION, datetime.now())
+        deleted, freed, errors = backup_index.delete_artifacts(expired, BACKUP_DELETE_WORKERS, BACKUP_INDEX_PATH)
+        for path, error in errors:
+            log_message(f"ERROR - Al eliminar el backup antiguo {path}: {error}")
+        log_message(f"INFO - Retención: {deleted} backups antiguos eliminados, {freed} bytes liberados")
+
+        if BACKUP_STORE == 'dedup':
+            removed, freed = backup_store.collect_garbage(BACKUP_STORE_DIR)
+            log_message(f"INFO - Repositorio deduplicado: {removed} chunks eliminados, {freed} bytes liberados")
+        else:
+            backup_index.remove_empty_folders(BACKUP_DIR)
+    except Exception as e:
+        log_message(f"ERROR - Al aplicar la retención de backups: {e}")
 
-    batch_size = 3  # Cantidad de bases de datos por lote
-    num_workers = 3  # Número de trabajadores
+def main():
+    """Función principal para la ejecución del script de backup
 
-    max_failed_attempts = 3
-    consecutive_failed_batches = 0
+    Cada trabajador toma la siguiente base de datos PENDING en cuanto queda libre,
+    en lugar de esperar a que termine un lote completo. Las bases de datos con un fallo
+    transitorio vuelven a la cola como RETRY y se reclaman cuando vence su backoff.
+    Devuelve 0, o 1 si la configuración no es válida o alguna base de datos falló.
+    """
+    if not load_compression_rules():
+        return 1
+    if BACKUP_STORE == 'dedup':
+        if not BACKUP_STORE_KEY:
+            log_message("ERROR - BACKUP_STORE=dedup necesita la clave del repositorio en BACKUP_STORE_KEY")
+            return 1
+        backup_path = BACKUP_STORE_DIR
+        os.makedirs(backup_path, exist_ok=True)
+    else:
+        backup_path = create_backup_dir()
+    log_message(f"Directorio de backup: {backup_path}")
+    log_message(f"Usando {BACKUP_WORKERS} hilos para el proceso de backup (orden: {BACKUP_ORDER}, worker: {WORKER_ID})")
 
-    while True:
-        databases = get_databases_to_backup(limit=batch_size)
+    release_expired_leases()
+    ensure_backup_index()
+    metrics_server = backup_metrics.start_http_server(BACKUP_METRICS_PORT) if BACKUP_METRICS_PORT else None
+    heartbeat_stop = threading.Event()
+    heartbeat = threading.Thread(target=heartbeat_loop, args=(heartbeat_stop,), daemon=True)
+    heartbeat.start()
+    monitor = None
+    if ADAPTIVE_CONCURRENCY:
+        monitor = threading.Thread(target=load_monitor_loop, args=(heartbeat_stop,), daemon=True)
+        monitor.start()
 
-        if not databases:
-            log_message("INFO - No se encontraron bases de datos para respaldar.")
-            break
+    submitted = set()
+    successful_dbs = []
+    failed_dbs = []
+    # Reintentos programados por este proceso: {datname: next_attempt_at}
+    retries = {}
+    consecutive_failures = 0
+    stop = False
 
-        log_message(f"Usando {num_workers} hilos para el proceso de backup")
+    with ThreadPoolExecutor(max_workers=BACKUP_WORKERS) as executor:
+        futures = {}
+        while True:
+            # Los trabajos en curso terminan aunque la concurrencia permitida baje; solo se frena la reclamación
+            free_workers = allowed_workers - len(futures)
+            if free_workers > 0 and not stop:
+                claimed_at = time.monotonic()
+                for db, size_bytes, attempt in claim_databases_to_backup(limit=free_workers):
+                    submitted.add(db)
+                    retries.pop(db, None)
+                    futures[executor.submit(backup_database, db, backup_path, size_bytes, claimed_at, attempt)] = db
 
-        successful_dbs = []
-        failed_dbs = []
+            if not futures:
+                if stop or not retries:
+                    break
+                # Solo quedan reintentos en backoff: esperar al primero que venza.
+                # Los vencidos se reclaman en la siguiente vuelta (o ya los tomó otro proceso).
+                time.sleep(max(0.0, (min(retries.values()) - datetime.now()).total_seconds()))
+                now = datetime.now()
+                retries = {db: next_attempt_at for db, next_attempt_at in retries.items() if next_attempt_at > now}
+                continue
 
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            futures = {executor.submit(backup_database, db, backup_path): db for db in databases}
-            for future in as_completed(futures):
-                db = futures[future]
+            # Se despierta cuando vence el primer reintento, para reclamarlo si hay un trabajador libre, y
+            # con concurrencia adaptativa periódicamente para aprovechar los aumentos de allowed_workers
+            timeout = BACKUP_LOAD_POLL_SECONDS if ADAPTIVE_CONCURRENCY else None
+            if retries:
+                until_retry = max(0.0, (min(retries.values()) - datetime.now()).total_seconds())
+                timeout = until_retry if timeout is None else min(timeout, until_retry)
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            now = datetime.now()
+            retries = {db: next_attempt_at for db, next_attempt_at in retries.items() if next_attempt_at > now}
+            for future in done:
+                db = futures.pop(future)
                 try:
-                    db, success = future.result()
-                    if success:
-                        successful_dbs.append(db)
-                    else:
-                        failed_dbs.append(db)
+                    db, status, next_attempt_at = future.result()
                 except Exception as e:
                     log_message(f"ERROR - Al procesar la base de datos {db}: {e}")
+                    status, next_attempt_at = 'FAILED', None
+
+                if status == 'SUCCESS':
+                    successful_dbs.append(db)
+                    consecutive_failures = 0
+                elif status == 'RETRY':
+                    retries[db] = next_attempt_at
+                else:
                     failed_dbs.append(db)
+                    consecutive_failures += 1
+                    if consecutive_failures >= BACKUP_MAX_CONSECUTIVE_FAILURES and not stop:
+                        log_message(f"ERROR - Se alcanzó el número máximo de fallos consecutivos [{BACKUP_MAX_CONSECUTIVE_FAILURES}]. Deteniendo el proceso de backup.")
+                        stop = True
 
-        if successful_dbs:
-            log_message(f"INFO - Bases de datos respaldadas con éxito: {successful_dbs}")
-            consecutive_failed_batches = 0
+    heartbeat_stop.set()
+    heartbeat.join()
+    if monitor is not None:
+        monitor.join()
+    flush_backup_status()
+    export_metrics()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
-        if failed_dbs:
-            log_message(f"ERROR - Bases de datos que fallaron al respaldar: {failed_dbs}")
-            # Incrementar el contador de lotes fallidos consecutivos
-            consecutive_failed_batches += 1
-            if consecutive_failed_batches >= max_failed_attempts:
-                log_message(f"ERROR - Se alcanzó el número máximo de lotes fallidos consecutivos [{max_failed_attempts}]. Deteniendo el proceso de backup.")
-                break
+    if not submitted:
+        log_message("INFO - No se encontraron bases de datos para respaldar.")
+    if successful_dbs:
+        log_message(f"INFO - Bases de datos respaldadas con éxito: {successful_dbs}")
+    if failed_dbs:
+        log_message(f"ERROR - Bases de datos que fallaron al respaldar: {failed_dbs}")
+    if retries:
+        log_message(f"INFO - Bases de datos en RETRY para la siguiente ejecución: {sorted(retries)}")
 
     delete_old_backups()
     log_message("---")
     print(f"Proceso de backups completados. Detalles en el archivo {LOG_FILE}")
+    return 1 if failed_dbs else 0
 
 if __name__ == "__main__":
+    exit_code = 1
     try:
-        main()
+        exit_code = main()
     except Exception as e:
         log_message(f"ERROR - Error inesperado: {e}")
-        print(f"Error inesperado: {e}. Revisa el log para más detalles.")
\ No newline at end of file
+        print(f"Error inesperado: {e}. Revisa el log para más detalles.")
+    finally:
+        close_control_pool()
+    sys.exit(exit_code)
\ No newline at end of file
@@ -0,0 +1,380 @@
+"""
+Repositorio de backups deduplicado y direccionado por contenido.
+
+Los flujos de pg_dump se dividen con content-defined chunking (FastCDC): los cortes dependen
+solo del contenido local (un hash gear rodante sobre los últimos 32 bytes), así que un cambio
+en una tabla solo altera los chunks de alrededor y el resto se reutiliza entre ejecuciones.
+Cada chunk se guarda una sola vez, cifrado individualmente con GPG, bajo el HMAC-SHA256 de su
+contenido con la clave secreta BACKUP_STORE_KEY (con un sha256 sin clave, quien lea el
+repositorio podría comprobar si contiene un contenido conocido):
+
+    store/chunks/ab/abcdef....gpg
+    store/manifests/<datname>/<YYYYmmddTHHMMSS>.json
+
+Los chunks nuevos se cifran por lotes, con un proceso gpg --multifile por lote en lugar de uno
+por chunk; al restaurar se descifran también por lotes. Cada ejecución escribe un manifiesto por base de datos con la lista ordenada de chunks.
+La retención consiste en eliminar manifiestos y después recoger (GC) los chunks que ya no
+referencia ningún manifiesto. Cambiar la clave hace que todos los chunks se vuelvan a guardar.
+
+Uso:
+    python backup_store.py list [--db DB]
+    python backup_store.py restore DB [--manifest ARCHIVO] > DB.backup
+    python backup_store.py gc [--retention-days 7]
+"""
+
+import os
+import sys
+import json
+import time
+import hmac
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from urllib.parse import quote, unquote
+
+STORE_DIR = os.getenv('BACKUP_STORE_DIR', os.path.join("backup", "store"))
+
+# Tamaños de chunk: mínimo, medio (potencia de 2) y máximo
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# Los chunks sin referencias más recientes que este margen no se eliminan: pueden pertenecer
+# a un backup en curso cuyo manifiesto todavía no se ha escrito
+GC_GRACE_HOURS = 6
+
+# Chunks nuevos que se cifran con un mismo proceso gpg; se escriben en claro en un directorio
+# temporal del repositorio (0700) hasta que se cifran
+ENCRYPT_BATCH_CHUNKS = 32
+# Chunks que se descifran con un mismo proceso gpg al restaurar
+DECRYPT_BATCH_CHUNKS = 32
+
+# Hash gear de FastCDC: h = (h << 1) + GEAR[byte] sobre 32 bits, así el bit más alto depende
+# de los últimos 32 bytes. La tabla se deriva de sha256 para que sea estable entre ejecuciones.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little') for i in range(256)]
+GEAR_WINDOW = 32
+# Cada byte del valor gear, para repartir la tabla en carriles de 64 bits con bytes.translate
+GEAR_BYTES = [bytes((value >> (8 * k)) & 0xFF for value in GEAR) for k in range(4)]
+# Bytes que se evalúan de una vez: con bloques pequeños los enteros intermedios caben en caché
+SCAN_SIZE = 64 * 1024
+
+def gear_mask(bits):
+    """Máscara sobre los bits altos del hash, que son los que dependen de toda la ventana"""
+    return ((1 << bits) - 1) << (32 - bits)
+
+def chunk_masks(avg_size):
+    """Máscaras de normalized chunking: más exigente antes de avg_size y más permisiva después"""
+    bits = avg_size.bit_length() - 1
+    return gear_mask(bits + 2), gear_mask(bits - 2)
+
+def gear_scan(data, masks):
+    """Hash gear en cada posición de data; para cada máscara, bytes con un 0 donde el hash la cumple
+
+    Recorrer el flujo byte a byte en Python es demasiado lento, así que el hash se calcula con
+    aritmética de enteros grandes: cada posición es un carril de 64 bits con GEAR[byte] y la
+    suma desplazada de la ventana, sum(GEAR[data[i - k]] << k for k < 32), se obtiene
+    duplicando la ventana cinco veces (nunca supera 2**64, así que no hay acarreo entre
+    carriles). Las primeras GEAR_WINDOW - 1 posiciones no tienen la ventana completa.
+    """
+    size = len(data)
+    lanes = bytearray(8 * size)
+    for k in range(4):
+        lanes[k::8] = data.translate(GEAR_BYTES[k])
+    value = int.from_bytes(lanes, 'little')
+    shift = 65
+    while shift < 65 * GEAR_WINDOW:
+        value += value << shift
+        shift *= 2
+    hashes = value.to_bytes((value.bit_length() + 7) // 8 or 1, 'little')
+    marks = []
+    for mask in masks:
+        found = 0
+        for k in range(4):
+            mask_byte = (mask >> (8 * k)) & 0xFF
+            if mask_byte:
+                column = hashes[k:8 * size:8].ljust(size, b'\0')
+                found |= int.from_bytes(column.translate(bytes(b & mask_byte for b in range(256))), 'little')
+        marks.append(found.to_bytes(size, 'little'))
+    return marks
+
+def find_cut_point(buffer, min_size, avg_size, max_size, masks):
+    """Posición del siguiente corte en buffer según el contenido, entre min_size y max_size
+
+    Como en FastCDC, los primeros min_size bytes no se evalúan, hasta avg_size se exige la
+    máscara estricta y a partir de ahí la permisiva.
+    """
+    size = len(buffer)
+    if size <= min_size:
+        return size
+    end = min(size, max_size)
+    normal = min(avg_size, end)
+    start = min_size
+    while start < end:
+        stop = min(start + SCAN_SIZE, end)
+        # El hash de start necesita los GEAR_WINDOW - 1 bytes anteriores
+        offset = start - GEAR_WINDOW + 1
+        strict, relaxed = gear_scan(bytes(buffer[offset:stop]), masks)
+        if start < normal:
+            pos = strict.find(0, start - offset, normal - offset)
+            if pos != -1:
+                return offset + pos + 1
+        if stop > normal:
+            pos = relaxed.find(0, max(start, normal) - offset)
+            if pos != -1:
+                return offset + pos + 1
+        start = stop
+    return end
+
+def chunk_stream(stream, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE, max_size=CHUNK_MAX_SIZE):
+    """Dividir un flujo binario en chunks definidos por contenido"""
+    masks = chunk_masks(avg_size)
+    buffer = bytearray()
+    eof = False
+    while not eof or buffer:
+        while not eof and len(buffer) < max_size:
+            data = stream.read(READ_SIZE)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            break
+        cut = find_cut_point(buffer, min_size, avg_size, max_size, masks)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+def chunk_path(store_dir, digest):
+    return os.path.join(store_dir, 'chunks', digest[:2], digest + '.gpg')
+
+def manifest_dir(store_dir, db):
+    # Los nombres de base de datos pueden contener caracteres no válidos en rutas
+    return os.path.join(store_dir, 'manifests', quote(db, safe=''))
+
+def chunk_id(key, data):
+    """Nombre de un chunk: HMAC-SHA256 de su contenido con la clave del repositorio"""
+    return hmac.new(key, data, hashlib.sha256).hexdigest()
+
+def encrypt_batch(store_dir, batch_dir, digests, recipient):
+    """Cifrar los chunks de batch_dir con un único proceso gpg y moverlos al repositorio
+
+    gpg --multifile escribe <archivo>.gpg junto a cada archivo; el texto en claro se elimina en
+    cuanto termina gpg. Devuelve los bytes escritos.
+    """
+    paths = [os.path.join(batch_dir, digest) for digest in digests]
+    try:
+        subprocess.run(['gpg', '--yes', '--batch', '--recipient', recipient, '--multifile', '--encrypt'] + paths,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    finally:
+        for path in paths:
+            os.remove(path)
+
+    written = 0
+    for digest, path in zip(digests, paths):
+        target = chunk_path(store_dir, digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path + '.gpg', target)  # Escritura atómica: otro proceso puede guardar el mismo chunk a la vez
+        written += os.path.getsize(target)
+    return written
+
+def decrypt_batch(batch_dir, sources):
+    """Descifrar chunks con un único proceso gpg; devuelve su contenido en el mismo orden
+
+    gpg --multifile escribe cada <archivo> junto a <archivo>.gpg: los chunks se enlazan en
+    batch_dir para que el texto en claro no quede junto al repositorio, y se elimina al leerlo.
+    """
+    links = []
+    for i, source in enumerate(sources):
+        link = os.path.join(batch_dir, f"{i}.gpg")
+        os.symlink(os.path.abspath(source), link)
+        links.append(link)
+    try:
+        subprocess.run(['gpg', '--yes', '--batch', '--quiet', '--multifile', '--decrypt'] + links,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        contents = []
+        for link in links:
+            with open(link[:-len('.gpg')], 'rb') as f:
+                contents.append(f.read())
+        return contents
+    finally:
+        for link in links:
+            for path in (link, link[:-len('.gpg')]):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+def backup_stream(store_dir, stream, recipient, key):
+    """Guardar un flujo como chunks deduplicados; devuelve la lista de chunks y estadísticas"""
+    chunks = []
+    stats = {'bytes_in': 0, 'bytes_written': 0, 'chunks': 0, 'new_chunks': 0}
+    os.makedirs(os.path.join(store_dir, 'tmp'), exist_ok=True)
+    batch_dir = tempfile.mkdtemp(prefix='batch.', dir=os.path.join(store_dir, 'tmp'))
+    pending = []
+
+    def flush():
+        stats['bytes_written'] += encrypt_batch(store_dir, batch_dir, pending, recipient)
+        stats['new_chunks'] += len(pending)
+        pending.clear()
+
+    try:
+        for data in chunk_stream(stream):
+            digest = chunk_id(key, data)
+            chunks.append([digest, len(data)])
+            stats['bytes_in'] += len(data)
+            stats['chunks'] += 1
+            path = chunk_path(store_dir, digest)
+            if os.path.exists(path):
+                os.utime(path)  # Protege el chunk reutilizado del GC durante el margen de gracia
+            elif digest not in pending:
+                with open(os.path.join(batch_dir, digest), 'wb') as f:
+                    f.write(data)
+                pending.append(digest)
+                if len(pending) >= ENCRYPT_BATCH_CHUNKS:
+                    flush()
+        if pending:
+            flush()
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+    return chunks, stats
+
+def write_manifest(store_dir, db, chunks, dump_format):
+    """Escribir el manifiesto de una ejecución; solo se llama cuando el dump terminó sin errores"""
+    created_at = datetime.now()
+    directory = manifest_dir(store_dir, db)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, created_at.strftime("%Y%m%dT%H%M%S") + '.json')
+    manifest = {
+        'database': db,
+        'created_at': created_at.isoformat(),
+        'format': dump_format,
+        'size': sum(length for _, length in chunks),
+        'chunk_id': 'hmac-sha256',
+        'chunks': chunks,
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+def list_manifests(store_dir, db=None):
+    """Lista de (datname, ruta) de los manifiestos, del más antiguo al más reciente por base de datos"""
+    root = os.path.join(store_dir, 'manifests')
+    if not os.path.isdir(root):
+        return []
+    folders = [quote(db, safe='')] if db else sorted(os.listdir(root))
+    manifests = []
+    for folder in folders:
+        directory = os.path.join(root, folder)
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.json'):
+                    manifests.append((unquote(folder), os.path.join(directory, name)))
+    return manifests
+
+def restore_manifest(store_dir, manifest_path, output, key):
+    """Descifrar y concatenar los chunks de un manifiesto en output (archivo binario)
+
+    Los chunks se descifran en lotes de DECRYPT_BATCH_CHUNKS con un proceso gpg por lote.
+    Los manifiestos anteriores a las claves HMAC nombran los chunks por su sha256.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    keyed = manifest.get('chunk_id') == 'hmac-sha256'
+    os.makedirs(os.path.join(store_dir, 'tmp'), exist_ok=True)
+    batch_dir = tempfile.mkdtemp(prefix='restore.', dir=os.path.join(store_dir, 'tmp'))
+    try:
+        for start in range(0, len(manifest['chunks']), DECRYPT_BATCH_CHUNKS):
+            batch = manifest['chunks'][start:start + DECRYPT_BATCH_CHUNKS]
+            contents = decrypt_batch(batch_dir, [chunk_path(store_dir, digest) for digest, _ in batch])
+            for (digest, length), data in zip(batch, contents):
+                expected = chunk_id(key, data) if keyed else hashlib.sha256(data).hexdigest()
+                if len(data) != length or not hmac.compare_digest(expected, digest):
+                    raise ValueError(f"Chunk corrupto {digest} en {manifest_path}")
+                output.write(data)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+    return manifest
+
+def prune_manifests(store_dir, retention_days):
+    """Eliminar los manifiestos más antiguos que la retención, conservando siempre el último de cada base"""
+    retention_date = datetime.now() - timedelta(days=retention_days)
+    by_db = {}
+    for db, path in list_manifests(store_dir):
+        by_db.setdefault(db, []).append(path)
+
+    removed = []
+    for db, paths in by_db.items():
+        for path in paths[:-1]:
+            created_at = datetime.strptime(os.path.basename(path)[:-len('.json')], "%Y%m%dT%H%M%S")
+            if created_at < retention_date:
+                os.remove(path)
+                removed.append(path)
+    return removed
+
+def collect_garbage(store_dir, grace_hours=GC_GRACE_HOURS):
+    """Eliminar los chunks que no referencia ningún manifiesto. Devuelve (chunks eliminados, bytes liberados)"""
+    referenced = set()
+    for _, path in list_manifests(store_dir):
+        with open(path) as f:
+            referenced.update(digest for digest, _ in json.load(f)['chunks'])
+
+    cutoff = time.time() - grace_hours * 3600
+    removed = 0
+    freed = 0
+    root = os.path.join(store_dir, 'chunks')
+    if not os.path.isdir(root):
+        return removed, freed
+    for prefix in os.listdir(root):
+        directory = os.path.join(root, prefix)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            digest = name.split('.', 1)[0]
+            stat = os.stat(path)
+            if digest not in referenced and stat.st_mtime < cutoff:
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+    return removed, freed
+
+def main():
+    parser = argparse.ArgumentParser(description="Repositorio de backups deduplicado")
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help="Listar manifiestos")
+    list_parser.add_argument('--db')
+
+    restore_parser = subparsers.add_parser('restore', help="Restaurar el último manifiesto de una base de datos en stdout")
+    restore_parser.add_argument('db')
+    restore_parser.add_argument('--manifest', help="Manifiesto concreto en lugar del último")
+
+    gc_parser = subparsers.add_parser('gc', help="Eliminar manifiestos antiguos y chunks sin referencias")
+    gc_parser.add_argument('--retention-days', type=int, default=7)
+    gc_parser.add_argument('--grace-hours', type=float, default=GC_GRACE_HOURS)
+
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for db, path in list_manifests(args.store_dir, args.db):
+            with open(path) as f:
+                manifest = json.load(f)
+            print(f"{db}\t{manifest['created_at']}\t{manifest['size']}\t{len(manifest['chunks'])}\t{path}")
+    elif args.command == 'restore':
+        manifests = list_manifests(args.store_dir, args.db)
+        manifest_path = args.manifest or (manifests[-1][1] if manifests else None)
+        if not manifest_path:
+            sys.exit(f"No hay manifiestos para la base de datos {args.db}")
+        key = os.getenv('BACKUP_STORE_KEY')
+        if not key:
+            sys.exit("Falta la clave del repositorio en BACKUP_STORE_KEY")
+        restore_manifest(args.store_dir, manifest_path, sys.stdout.buffer, key.encode())
+    elif args.command == 'gc':
+        pruned = prune_manifests(args.store_dir, args.retention_days)
+        removed, freed = collect_garbage(args.store_dir, args.grace_hours)
+        print(f"Manifiestos eliminados: {len(pruned)}, chunks eliminados: {removed}, bytes liberados: {freed}")
+
+if __name__ == "__main__":
+    main()
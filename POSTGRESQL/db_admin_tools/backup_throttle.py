@@ -0,0 +1,77 @@
+"""
+Limitación de carga del proceso de backup sobre el servidor de origen.
+
+- Ancho de banda: token buckets de bytes por segundo, uno global compartido por todos los
+  trabajos y otro por trabajo. Se aplican al leer la salida de pg_dump; al leer más despacio
+  el pipe se llena y pg_dump se bloquea, así que el servidor también lee más despacio.
+- Concurrencia adaptativa: con las señales de carga del servidor (sesiones activas y lag de
+  replicación) se reduce a la mitad el número de dumps simultáneos cuando alguna supera su
+  límite y se aumenta de uno en uno cuando todas están por debajo de la mitad (AIMD).
+"""
+
+import time
+import threading
+
+class TokenBucket:
+    """Token bucket de `rate` bytes por segundo con ráfagas de hasta `burst` bytes
+
+    reserve() descuenta los bytes aunque no haya tokens suficientes (el saldo queda en
+    negativo) y devuelve cuánto hay que esperar, así sirve tanto para hilos como para asyncio
+    y los bloques mayores que la ráfaga no se quedan esperando para siempre.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+def make_bucket(rate_mb):
+    """Token bucket para un límite en MB/s; None si el límite está desactivado (0)"""
+    return TokenBucket(rate_mb * 1024 ** 2) if rate_mb > 0 else None
+
+def job_buckets(global_bucket, job_rate_mb):
+    """Buckets que limitan un trabajo: el global compartido y uno propio del trabajo"""
+    return [bucket for bucket in (global_bucket, make_bucket(job_rate_mb)) if bucket is not None]
+
+def throttle_delay(buckets, amount):
+    """Reservar `amount` bytes en todos los buckets y devolver los segundos que hay que esperar"""
+    return max((bucket.reserve(amount) for bucket in buckets), default=0.0)
+
+def throttle(buckets, amount):
+    delay = throttle_delay(buckets, amount)
+    if delay > 0:
+        time.sleep(delay)
+
+class ThrottledReader:
+    """Envoltorio de un flujo binario cuyas lecturas respetan los buckets"""
+
+    def __init__(self, stream, buckets):
+        self.stream = stream
+        self.buckets = buckets
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        throttle(self.buckets, len(data))
+        return data
+
+def adjust_concurrency(current, minimum, maximum, load, limits):
+    """Nueva concurrencia según la carga: mitad si alguna señal supera su límite, +1 si todas
+    están por debajo de la mitad del suyo, igual en otro caso. Un límite 0 desactiva la señal."""
+    active = {name: limit for name, limit in limits.items() if limit > 0}
+    if not active:
+        return maximum
+    if any(load[name] > limit for name, limit in active.items()):
+        return max(minimum, current // 2)
+    if all(load[name] < limit / 2 for name, limit in active.items()):
+        return min(maximum, current + 1)
+    return current
@@ -0,0 +1,88 @@
+"""
+Benchmark de los codecs de compresión del flujo de backup_postgres.py.
+
+Genera un dump sintético parecido a la sección de datos de pg_dump (bloques COPY con
+identificadores, fechas, importes y texto repetitivo) o usa un dump real sin comprimir
+(pg_dump -F c -Z 0), y mide para cada codec y nivel disponible en el PATH el throughput
+de compresión y el ratio obtenido.
+
+Uso:
+    python benchmarks/compression_benchmark.py --size-mb 256
+    python benchmarks/compression_benchmark.py --input mi_db.backup --codecs zstd:1,zstd:3,lz4:1
+"""
+
+import os
+import sys
+import argparse
+import random
+import shutil
+import subprocess
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backup_postgres import COMPRESSION_CODECS
+
+DEFAULT_CODECS = "zstd:1,zstd:3,zstd:9,lz4:1,lz4:9,pigz:6,gzip:6"
+
+WORDS = ("cliente pedido factura pago envio producto almacen proveedor pendiente completado "
+         "cancelado devuelto Madrid Lima Bogota Quito Santiago Mexico activo inactivo").split()
+
+def generate_dump(size_bytes, seed):
+    """Generar datos con la estructura de bloques COPY de un dump de PostgreSQL"""
+    rng = random.Random(seed)
+    start = date(2015, 1, 1)
+    parts = []
+    total = 0
+    table = 0
+    while total < size_bytes:
+        table += 1
+        header = f"COPY public.tabla_{table} (id, fecha, importe, estado, descripcion) FROM stdin;\n"
+        rows = []
+        for row_id in range(1, 20001):
+            fecha = start + timedelta(days=rng.randrange(3650))
+            descripcion = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 12)))
+            rows.append(f"{row_id}\t{fecha}\t{rng.randrange(100, 10 ** 7) / 100:.2f}\t{rng.choice(WORDS)}\t{descripcion}\n")
+        block = (header + "".join(rows) + "\\.\n\n").encode()
+        parts.append(block)
+        total += len(block)
+    return b"".join(parts)[:size_bytes]
+
+def run_codec(command, data):
+    """Comprimir data con el comando y devolver (segundos, bytes de salida)"""
+    start = time.perf_counter()
+    result = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return time.perf_counter() - start, len(result.stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de codecs de compresión para el flujo de backup")
+    parser.add_argument('--size-mb', type=int, default=128, help="Tamaño del dump sintético")
+    parser.add_argument('--input', help="Dump real sin comprimir en lugar del sintético")
+    parser.add_argument('--codecs', default=DEFAULT_CODECS, help="Lista codec:nivel separada por comas")
+    parser.add_argument('--threads', type=int, default=0, help="Hilos para los codecs multihilo (0 = todos)")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'rb') as f:
+            data = f.read()
+    else:
+        data = generate_dump(args.size_mb * 1024 ** 2, args.seed)
+    size_mb = len(data) / 1024 ** 2
+    print(f"Entrada: {size_mb:.1f} MB")
+    print(f"{'codec':<10} {'nivel':>5} {'MB/s':>10} {'ratio':>8} {'salida MB':>10}")
+
+    for spec in args.codecs.split(','):
+        codec, level = spec.split(':')
+        if codec not in COMPRESSION_CODECS:
+            print(f"{codec:<10} {level:>5}  codec desconocido")
+            continue
+        command = COMPRESSION_CODECS[codec][0](int(level), args.threads)
+        if not shutil.which(command[0]):
+            print(f"{codec:<10} {level:>5}  no disponible en el PATH")
+            continue
+        seconds, output_size = run_codec(command, data)
+        print(f"{codec:<10} {level:>5} {size_mb / seconds:>10.1f} {len(data) / output_size:>8.2f} {output_size / 1024 ** 2:>10.1f}")
+
+if __name__ == "__main__":
+    main()
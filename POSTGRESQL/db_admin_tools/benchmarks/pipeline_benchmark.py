@@ -0,0 +1,365 @@
+"""
+Benchmark de db_admin_tools contra un PostgreSQL local.
+
+Crea un cluster temporal con initdb, genera N bases de datos con tamaños de distribución
+log-normal y varios esquemas, carga la tabla de control (SQL/query.sql) y mide, en este orden:
+
+    grant     grant_permissions_pguser.grant_permissions()
+    sync      sync_databases.sync_databases()
+    backup    backup_postgres.main()
+    drop_user revoke_drop_pguser.drop_user_everywhere()
+
+Cada etapa se ejecuta en un proceso propio (los scripts leen su configuración al importarse)
+con el directorio de trabajo como cwd, así que las variables BACKUP_*, GRANT_WORKERS, etc.
+del entorno se aplican igual que en producción. Por cada etapa se registra el tiempo total,
+bases de datos/s, MB/s sobre el tamaño total de las bases generadas y el pico de disco del
+directorio de backups. El resultado se escribe en JSON para comparar ejecuciones.
+
+Los scripts registran sus errores en el log y terminan con código 0, así que después de cada
+etapa se comprueba su resultado en el cluster (ver check_stage): privilegios tras grant,
+filas de backup_dbs tras sync, estados de backup_dbs tras backup y el usuario tras drop_user.
+Si alguna etapa falla, el benchmark termina con código 1.
+
+Uso:
+    python benchmarks/pipeline_benchmark.py --databases 50 --median-mb 20 --schemas 3
+    BACKUP_WORKERS=6 python benchmarks/pipeline_benchmark.py --output nuevo.json --baseline anterior.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bytes aproximados por fila de las tablas generadas (cabecera de tupla + int + md5 + timestamp)
+ROW_BYTES = 80
+
+BACKUP_USER = 'bench_backup'
+CONTROL_DB = 'bench_control'
+GPG_RECIPIENT = 'db-admin-bench <bench@localhost>'
+
+# Etapa -> código que se ejecuta en el proceso hijo
+STAGES = [
+    ('grant', "import grant_permissions_pguser as m; m.grant_permissions()"),
+    ('sync', "import sync_databases as m\nwith m.connect_to_database() as conn: m.sync_databases(conn)"),
+    ('backup', "import backup_postgres as m; m.main()"),
+    ('drop_user', "import revoke_drop_pguser as m; m.drop_user_everywhere(resume=False)"),
+]
+
+def pg_command(pg_bin, name):
+    return os.path.join(pg_bin, name) if pg_bin else name
+
+def start_cluster(pg_bin, root, port):
+    """Crear y arrancar el cluster del benchmark en 127.0.0.1:port (autenticación trust)"""
+    data_dir = os.path.join(root, 'data')
+    subprocess.run([pg_command(pg_bin, 'initdb'), '-D', data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                   stdout=subprocess.DEVNULL, check=True)
+    options = f"-p {port} -k {root} -c listen_addresses=127.0.0.1 -c max_connections=200"
+    subprocess.run([pg_command(pg_bin, 'pg_ctl'), '-D', data_dir, '-o', options,
+                    '-l', os.path.join(root, 'postgres.log'), '-w', 'start'], stdout=subprocess.DEVNULL, check=True)
+    return data_dir
+
+def stop_cluster(pg_bin, data_dir):
+    subprocess.run([pg_command(pg_bin, 'pg_ctl'), '-D', data_dir, '-m', 'fast', '-w', 'stop'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def connect(port, dbname):
+    return psycopg2.connect(host='127.0.0.1', port=port, user='postgres', dbname=dbname)
+
+def control_schema_sql():
+    """Parte de SQL/query.sql que crea backup_dbs, backup_history y sync_databases() (sin los ejemplos)"""
+    with open(os.path.join(TOOLS_DIR, 'SQL', 'query.sql')) as f:
+        text = f.read()
+    schema = text.split('SELECT * FROM sync_databases();')[0]
+    return '\n'.join(line for line in schema.splitlines() if not line.startswith('CREATE USER'))
+
+def generate_sizes(count, seed, median_mb, sigma):
+    """Tamaños (MB) log-normales, como en scheduler_simulation.py"""
+    rng = random.Random(seed)
+    return [rng.lognormvariate(0, sigma) * median_mb for _ in range(count)]
+
+def create_database(port, name, size_mb, schemas):
+    """Crear una base de datos con una tabla por esquema que suman aproximadamente size_mb"""
+    conn = connect(port, 'postgres')
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+
+    rows = max(1, int(size_mb * 1024 ** 2 / ROW_BYTES / schemas))
+    conn = connect(port, name)
+    try:
+        with conn.cursor() as cur:
+            for i in range(1, schemas + 1):
+                schema = sql.Identifier(f"schema_{i}")
+                cur.execute(sql.SQL("CREATE SCHEMA {};").format(schema))
+                cur.execute(sql.SQL("""
+                    CREATE TABLE {}.datos (id INTEGER PRIMARY KEY, valor TEXT, creado TIMESTAMPTZ);
+                    INSERT INTO {}.datos SELECT g, md5(g::text), now() - g * INTERVAL '1 second'
+                    FROM generate_series(1, %s) g;
+                """).format(schema, schema), (rows,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def prepare_cluster(port, sizes, schemas, workers):
+    """Roles, base de datos de control y bases de datos generadas. Devuelve (bases de datos, bytes, versión)"""
+    conn = connect(port, 'postgres')
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("CREATE ROLE {} LOGIN PASSWORD 'bench';").format(sql.Identifier(BACKUP_USER)))
+            cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(CONTROL_DB)))
+    finally:
+        conn.close()
+
+    conn = connect(port, CONTROL_DB)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(control_schema_sql())
+        conn.commit()
+    finally:
+        conn.close()
+
+    names = [f"bench_{i:05d}" for i in range(len(sizes))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda args: create_database(port, *args, schemas), zip(names, sizes)))
+
+    conn = connect(port, 'postgres')
+    try:
+        with conn.cursor() as cur:
+            # Los scripts procesan todas las bases de datos no plantilla, incluidas postgres y la de control
+            cur.execute("SELECT count(*), sum(pg_database_size(datname)) FROM pg_database WHERE NOT datistemplate;")
+            count, total_bytes = cur.fetchone()
+            cur.execute("SHOW server_version;")
+            version = cur.fetchone()[0]
+    finally:
+        conn.close()
+    return count, int(total_bytes), version
+
+def create_gpg_key(gnupg_home):
+    """Clave GPG desechable para que backup_postgres.py cifre los dumps"""
+    os.makedirs(gnupg_home, mode=0o700)
+    subprocess.run(['gpg', '--batch', '--passphrase', '', '--quick-gen-key', GPG_RECIPIENT, 'default', 'default', 'never'],
+                   env=dict(os.environ, GNUPGHOME=gnupg_home), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   check=True)
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass  # El archivo se eliminó mientras se recorría el directorio
+    return total
+
+def run_stage(code, env, work_dir, watch_dir, interval):
+    """Ejecutar una etapa midiendo el tiempo total y el pico de disco de watch_dir"""
+    peak = [directory_size(watch_dir)]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak[0] = max(peak[0], directory_size(watch_dir))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', f"import sys\nsys.path.insert(0, {TOOLS_DIR!r})\n{code}"],
+                          cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+    peak[0] = max(peak[0], directory_size(watch_dir))
+    return {'wall_seconds': wall, 'peak_disk_bytes': peak[0], 'returncode': proc.returncode,
+            'stderr': proc.stderr[-2000:]}
+
+GRANT_CHECK_QUERY = """
+    SELECT has_database_privilege(%(user)s, current_database(), 'CONNECT'),
+           (SELECT count(*) FROM pg_namespace n
+            WHERE n.nspname NOT IN ('information_schema', 'pg_catalog') AND n.nspname NOT LIKE 'pg\\_%%'
+            AND NOT has_schema_privilege(%(user)s, n.oid, 'USAGE')),
+           (SELECT count(*) FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'p')
+            AND n.nspname NOT IN ('information_schema', 'pg_catalog') AND n.nspname NOT LIKE 'pg\\_%%'
+            AND NOT has_table_privilege(%(user)s, c.oid, 'SELECT'));
+"""
+
+def cluster_databases(port):
+    conn = connect(port, 'postgres')
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT datname FROM pg_database WHERE NOT datistemplate ORDER BY datname;")
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+def check_grant(port):
+    """Bases de datos en las que BACKUP_USER no tiene CONNECT, USAGE en algún esquema o SELECT en alguna tabla"""
+    problems = []
+    for db in cluster_databases(port):
+        conn = connect(port, db)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(GRANT_CHECK_QUERY, {'user': BACKUP_USER})
+                can_connect, schemas, tables = cur.fetchone()
+        finally:
+            conn.close()
+        if not can_connect or schemas or tables:
+            problems.append(f"{db}: connect={can_connect}, esquemas sin USAGE={schemas}, tablas sin SELECT={tables}")
+    return problems
+
+def backup_status_counts(port):
+    conn = connect(port, CONTROL_DB)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT status, count(*) FROM backup_dbs GROUP BY status ORDER BY status;")
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+def check_stage(name, port, databases):
+    """Comprobar en el cluster el resultado de una etapa. Devuelve (detalle, lista de problemas)"""
+    if name == 'grant':
+        problems = check_grant(port)
+        return {'databases_with_missing_privileges': len(problems)}, problems
+    if name in ('sync', 'backup'):
+        counts = backup_status_counts(port)
+        tracked = sum(counts.values())
+        problems = []
+        if tracked != databases:
+            problems.append(f"backup_dbs tiene {tracked} bases de datos, el cluster {databases}")
+        if name == 'backup' and counts.get('SUCCESS', 0) != tracked:
+            problems.append(f"estados en backup_dbs: {counts}")
+        return {'status_counts': counts}, problems
+    if name == 'drop_user':
+        conn = connect(port, 'postgres')
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*) FROM pg_roles WHERE rolname = %s;", (BACKUP_USER,))
+                exists = cur.fetchone()[0] > 0
+        finally:
+            conn.close()
+        return {'user_exists': exists}, [f"el usuario {BACKUP_USER} sigue existiendo"] if exists else []
+    return {}, []
+
+def stage_env(port, gnupg_home):
+    return dict(os.environ,
+                DB_HOST='127.0.0.1', DB_PORT=str(port), PGPORT=str(port),
+                DB_USER='postgres', DB_PASSWORD='bench', DB_DEFAULT=CONTROL_DB,
+                DB_BPUSER=BACKUP_USER, DB_BPUSERPASS='bench',
+                GPG_NAME=GPG_RECIPIENT, GNUPGHOME=gnupg_home)
+
+def print_report(result, baseline=None):
+    print(f"PostgreSQL {result['postgres_version']}, {result['databases']} bases de datos, "
+          f"{result['total_bytes'] / 1024 ** 2:.1f} MB")
+    print(f"{'etapa':<10} {'segundos':>10} {'DB/s':>8} {'MB/s':>8} {'pico disco MB':>14} {'vs base':>8}")
+    for name, stage in result['stages'].items():
+        ratio = ''
+        if baseline and name in baseline.get('stages', {}) and stage['wall_seconds'] > 0:
+            ratio = f"{baseline['stages'][name]['wall_seconds'] / stage['wall_seconds']:.2f}x"
+        if stage['returncode'] != 0:
+            status = f"  (código {stage['returncode']})"
+        elif stage['problems']:
+            status = f"  (verificación fallida: {'; '.join(stage['problems'][:3])})"
+        else:
+            status = ''
+        print(f"{name:<10} {stage['wall_seconds']:>10.2f} {stage['databases_per_sec']:>8.1f} {stage['mb_per_sec']:>8.1f} "
+              f"{stage['peak_disk_bytes'] / 1024 ** 2:>14.1f} {ratio:>8}{status}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de db_admin_tools contra un PostgreSQL local")
+    parser.add_argument('--databases', type=int, default=20)
+    parser.add_argument('--median-mb', type=float, default=10.0)
+    parser.add_argument('--sigma', type=float, default=1.0, help="Dispersión de la distribución log-normal")
+    parser.add_argument('--schemas', type=int, default=2, help="Esquemas (con una tabla cada uno) por base de datos")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--port', type=int, default=55433)
+    parser.add_argument('--pg-bin', default='', help="Directorio de initdb/pg_ctl/pg_dump (por defecto, el PATH)")
+    parser.add_argument('--stages', default=','.join(name for name, _ in STAGES))
+    parser.add_argument('--sample-interval', type=float, default=0.5, help="Segundos entre mediciones de disco")
+    parser.add_argument('--output', default=f"pipeline_benchmark_{datetime.now():%Y%m%dT%H%M%S}.json")
+    parser.add_argument('--baseline', help="JSON de una ejecución anterior para comparar")
+    parser.add_argument('--keep', action='store_true', help="Conservar el cluster y el directorio de trabajo")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='db_admin_bench_')
+    os.makedirs(os.path.join(work_dir, 'log'))
+    os.makedirs(os.path.join(work_dir, 'backup'))
+    gnupg_home = os.path.join(work_dir, 'gnupg')
+    data_dir = None
+    started_at = datetime.now()
+    failed = False
+    try:
+        data_dir = start_cluster(args.pg_bin, work_dir, args.port)
+        sizes = generate_sizes(args.databases, args.seed, args.median_mb, args.sigma)
+        generation_start = time.perf_counter()
+        databases, total_bytes, version = prepare_cluster(args.port, sizes, args.schemas, os.cpu_count() or 1)
+        generation_seconds = time.perf_counter() - generation_start
+        create_gpg_key(gnupg_home)
+
+        env = stage_env(args.port, gnupg_home)
+        if args.pg_bin:
+            env['PATH'] = args.pg_bin + os.pathsep + env.get('PATH', '')
+        selected = args.stages.split(',')
+        stages = {}
+        for name, code in STAGES:
+            if name not in selected:
+                continue
+            stage = run_stage(code, env, work_dir, os.path.join(work_dir, 'backup'), args.sample_interval)
+            stage['databases_per_sec'] = databases / stage['wall_seconds'] if stage['wall_seconds'] else 0.0
+            stage['mb_per_sec'] = total_bytes / 1024 ** 2 / stage['wall_seconds'] if stage['wall_seconds'] else 0.0
+            stage['check'], stage['problems'] = check_stage(name, args.port, databases)
+            stage['ok'] = stage['returncode'] == 0 and not stage['problems']
+            failed = failed or not stage['ok']
+            stages[name] = stage
+
+        result = {
+            'started_at': started_at.isoformat(),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'postgres_version': version,
+            'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'keep')},
+            'environment': {key: value for key, value in os.environ.items()
+                            if key.startswith(('BACKUP_', 'GRANT_', 'REVOKE_'))},
+            'databases': databases,
+            'total_bytes': total_bytes,
+            'generation_seconds': generation_seconds,
+            'stages': stages,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        print_report(result, baseline)
+        print(f"Resultados en {args.output}")
+    finally:
+        if data_dir and not args.keep:
+            stop_cluster(args.pg_bin, data_dir)
+        if args.keep:
+            print(f"Cluster y directorio de trabajo conservados en {work_dir} (puerto {args.port})")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Simulación del planificador de backup_postgres.py.
+
+Compara el makespan (tiempo total de la ventana de backup) del bucle por lotes
+original (lotes de N bases de datos ordenadas por rank ascendente, esperando a que
+termine todo el lote) con el planificador continuo, en el que cada trabajador toma
+la siguiente base de datos en cuanto queda libre.
+
+Uso:
+    python benchmarks/scheduler_simulation.py --databases 300 --workers 3
+"""
+
+import argparse
+import heapq
+import random
+
+def generate_sizes(count, seed, median_mb, sigma):
+    """Generar tamaños sintéticos (MB) con distribución log-normal: muchas bases pequeñas y pocas grandes"""
+    rng = random.Random(seed)
+    return [rng.lognormvariate(0, sigma) * median_mb for _ in range(count)]
+
+def batch_makespan(durations, workers):
+    """Bucle original: lotes de `workers` bases por rank ascendente, cada lote espera a la más lenta"""
+    ordered = sorted(durations)
+    return sum(max(ordered[i:i + workers]) for i in range(0, len(ordered), workers))
+
+def continuous_makespan(durations, workers, largest_first=True):
+    """Planificador continuo: cada trabajador toma la siguiente base en cuanto termina la anterior"""
+    ordered = sorted(durations, reverse=largest_first)
+    finish_times = [0.0] * workers
+    heapq.heapify(finish_times)
+    for duration in ordered:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulación de makespan del planificador de backups")
+    parser.add_argument('--databases', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--median-mb', type=float, default=200.0)
+    parser.add_argument('--sigma', type=float, default=2.0, help="Dispersión de la distribución log-normal")
+    parser.add_argument('--throughput-mbs', type=float, default=50.0, help="MB/s de un pg_dump")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sizes = generate_sizes(args.databases, args.seed, args.median_mb, args.sigma)
+    durations = [size / args.throughput_mbs for size in sizes]
+    lower_bound = max(max(durations), sum(durations) / args.workers)
+
+    results = [
+        ("lotes (actual, rank ASC)", batch_makespan(durations, args.workers)),
+        ("continuo, smallest_first", continuous_makespan(durations, args.workers, largest_first=False)),
+        ("continuo, largest_first", continuous_makespan(durations, args.workers, largest_first=True)),
+    ]
+
+    print(f"Bases de datos: {args.databases}, trabajadores: {args.workers}, total: {sum(sizes) / 1024:.1f} GB")
+    print(f"Cota inferior del makespan: {lower_bound:.0f} s")
+    baseline = results[0][1]
+    for name, makespan in results:
+        print(f"{name:<28} {makespan:>10.0f} s  {baseline / makespan:5.2f}x  eficiencia {lower_bound / makespan:6.1%}")
+
+if __name__ == "__main__":
+    main()
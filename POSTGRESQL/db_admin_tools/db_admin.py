@@ -0,0 +1,101 @@
+"""
+Punto de entrada único de db_admin_tools.
+
+Uso:
+    python db_admin.py sync [--timing] [--runs N]
+    python db_admin.py grant [--reconcile] [--dry-run]
+    python db_admin.py revoke [--restart]
+    python db_admin.py backup [--async]
+    python db_admin.py sync + grant --reconcile
+    python db_admin.py --env-file .env.production sync + grant --reconcile + backup
+
+Los comandos separados por '+' se ejecutan en orden en el mismo proceso y comparten el pool de
+conexiones y el catálogo de bases de datos y esquemas (ver db_admin_core.py): sync y backup usan
+las mismas conexiones a la base de datos de control, y grant, revoke y backup reutilizan la lista
+de bases de datos y los fingerprints que leyó sync. Si un comando falla (su main() devuelve un
+código distinto de 0 o lanza una excepción) no se ejecutan los siguientes.
+
+Cada script se importa solo cuando se ejecuta su comando, así que `db-admin sync` no carga el
+motor de backup. Sin --env-file cada script carga su propio archivo .env (columna env de COMMANDS).
+Como el entorno es del proceso, una cadena de comandos con archivos distintos (sync + backup)
+exige --env-file: ese archivo común sustituye al de cada script para todos los comandos.
+"""
+
+import sys
+import argparse
+import importlib
+
+import db_admin_core as core
+
+# Comando -> (módulo, archivo .env que carga el módulo, descripción)
+COMMANDS = {
+    'sync': ('sync_databases', '.env.production', "Sincronizar backup_dbs con las bases de datos del cluster"),
+    'grant': ('grant_permissions_pguser', '.env.production', "Otorgar permisos de lectura al usuario de backup"),
+    'revoke': ('revoke_drop_pguser', '.env.production', "Revocar privilegios y eliminar el usuario de backup"),
+    'backup': ('backup_postgres', '.env.local', "Respaldar las bases de datos PENDING (--async: motor asyncio)"),
+}
+
+def split_commands(argv):
+    """['sync', '+', 'backup', '--async'] -> [['sync'], ['backup', '--async']]"""
+    commands = [[]]
+    for arg in argv:
+        if arg == '+':
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+    return [command for command in commands if command]
+
+def run_command(name, argv):
+    """Ejecutar el main() de un comando y devolver su código de salida (0 = correcto)"""
+    module_name, _, description = COMMANDS[name]
+    if name == 'backup':
+        parser = argparse.ArgumentParser(prog='db-admin backup', description=description)
+        parser.add_argument('--async', dest='use_async', action='store_true',
+                            help="Usar el motor asyncio (backup_async.py)")
+        args = parser.parse_args(argv)
+        if args.use_async:
+            module_name = 'backup_async'
+        return importlib.import_module(module_name).main() or 0
+    return importlib.import_module(module_name).main(argv) or 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='db-admin', description="Herramientas de administración de PostgreSQL",
+        epilog="Comandos: " + ", ".join(f"{name} ({help})" for name, (_, _, help) in COMMANDS.items())
+               + ". Varios comandos se encadenan con '+'.")
+    parser.add_argument('--env-file', help="Archivo .env común para todos los comandos, en lugar del de cada script")
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    segments = split_commands(sys.argv[1:] if argv is None else argv)
+
+    # Las opciones globales van antes del primer comando
+    head = parser.parse_args(segments[0] if segments else [])
+    commands = [[head.command] + head.args] + segments[1:]
+    for command in commands:
+        if command[0] not in COMMANDS:
+            parser.error(f"comando desconocido: {command[0]}")
+
+    env_files = sorted({COMMANDS[name][1] for name, *_ in commands})
+    if head.env_file:
+        core.use_shared_env(head.env_file)
+    elif len(env_files) > 1:
+        # Las variables ya cargadas no se sobrescriben: el segundo archivo no tendría efecto
+        parser.error(f"los comandos usan archivos .env distintos ({', '.join(env_files)}); "
+                     f"indica el archivo común con --env-file")
+
+    try:
+        for name, *args in commands:
+            status = run_command(name, args)
+            if status != 0:
+                print(f"db-admin {name} terminó con errores (código {status}); no se ejecutan los comandos siguientes",
+                      file=sys.stderr)
+                return status
+    except Exception as e:
+        print(f"Error en db-admin {name}: {e}", file=sys.stderr)
+        return 1
+    finally:
+        core.close_all_pools()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+"""
+Núcleo compartido de db_admin_tools: entorno, conexiones, catálogo y logging.
+
+- load_env(): carga cada archivo .env una sola vez por proceso; use_shared_env() fija un único
+  archivo para todos los comandos encadenados (ver db_admin.py).
+- Conexiones: un ThreadedConnectionPool por (host, puerto, base de datos, usuario), creado la
+  primera vez que se pide y compartido por todos los comandos que se ejecutan en el proceso
+  (ver db_admin.py). Las conexiones puntuales a cada base de datos usan connect().
+- Catálogo: lista de bases de datos del cluster, su fingerprint de actividad y esquemas de cada
+  base de datos, cacheados durante DB_CATALOG_TTL_SECONDS. sync_databases guarda lo que ya leyó
+  (remember_databases) para que los comandos siguientes no vuelvan a consultarlo.
+- pg_env(): entorno para procesos hijos (pg_dump) con PGPASSWORD, sin modificar os.environ.
+- get_logger(): un logger con su propio archivo por script, así varios comandos en el mismo
+  proceso no escriben en el log del primero que configuró logging. Los mensajes pasan por una
+  cola y un hilo los escribe en disco (JSON por línea, con rotación por tamaño o por tiempo);
+  job_context() añade el trabajo en curso (job_id, datname...) a cada línea.
+
+psycopg2 y python-dotenv se importan al usarse por primera vez, así los comandos que no los
+necesitan arrancan sin cargarlos.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import contextvars
+from datetime import datetime
+from contextlib import contextmanager
+
+loaded_env_files = set()
+
+# Archivo .env común fijado por db_admin.py (--env-file); sustituye al archivo propio de cada script
+shared_env_file = None
+
+def use_shared_env(path):
+    """Cargar path y usarlo en lugar del archivo .env de cada script que se importe después"""
+    global shared_env_file
+    shared_env_file = path
+    load_env(path)
+
+def load_env(path):
+    """Cargar un archivo .env una sola vez; las variables ya definidas no se sobrescriben
+
+    El núcleo se importa antes de cargar el .env, así que su configuración (DB_POOL_MAX_CONNECTIONS,
+    DB_POOL_WAIT_SECONDS, DB_CATALOG_TTL_SECONDS) se lee del entorno al usarse y no al importarse.
+    Con un archivo común (use_shared_env) se carga ese y se ignora path.
+    """
+    path = shared_env_file or path
+    if path in loaded_env_files:
+        return
+    from dotenv import load_dotenv
+    load_dotenv(path)
+    loaded_env_files.add(path)
+
+def admin_config():
+    """Parámetros de conexión del usuario administrador (DB_USER)"""
+    return {
+        "host": os.getenv('DB_HOST'),
+        "port": os.getenv('DB_PORT'),
+        "user": os.getenv('DB_USER'),
+        "password": os.getenv('DB_PASSWORD'),
+    }
+
+def pg_env(password):
+    """Entorno para un proceso hijo de PostgreSQL con la contraseña en PGPASSWORD"""
+    env = dict(os.environ)
+    if password:
+        env['PGPASSWORD'] = password
+    return env
+
+def connect(dbname, **overrides):
+    """Nueva conexión (sin pool) a una base de datos; overrides reemplaza host, user, password..."""
+    import psycopg2
+    config = admin_config()
+    config.update(overrides)
+    return psycopg2.connect(dbname=dbname, **config)
+
+# Pools de conexiones: {(host, puerto, base de datos, usuario): ThreadedConnectionPool}
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(dbname, maxconn=None, **overrides):
+    """Pool de conexiones a una base de datos, creado una sola vez por proceso
+
+    Si un comando posterior necesita más conexiones que el que creó el pool, se amplía el máximo.
+    getconn() lanza PoolError con el pool agotado en lugar de esperar: pool.slots cuenta las
+    conexiones libres para que connection() espere a que se devuelva una.
+    """
+    config = admin_config()
+    config.update(overrides)
+    key = (config['host'], config['port'], dbname, config['user'])
+    maxconn = maxconn or int(os.getenv('DB_POOL_MAX_CONNECTIONS', '10'))
+    with pools_lock:
+        if key not in pools:
+            from psycopg2 import pool
+            pools[key] = pool.ThreadedConnectionPool(1, maxconn, dbname=dbname, **config)
+            pools[key].slots = threading.Semaphore(maxconn)
+        elif pools[key].maxconn < maxconn:
+            for _ in range(maxconn - pools[key].maxconn):
+                pools[key].slots.release()
+            pools[key].maxconn = maxconn
+        return pools[key]
+
+@contextmanager
+def connection(dbname, maxconn=None, **overrides):
+    """Tomar una conexión del pool, confirmar la transacción al salir y devolverla al pool
+
+    Con el pool agotado espera hasta DB_POOL_WAIT_SECONDS a que otro hilo devuelva una conexión.
+    """
+    db_pool = get_pool(dbname, maxconn, **overrides)
+    if not db_pool.slots.acquire(timeout=float(os.getenv('DB_POOL_WAIT_SECONDS', '60'))):
+        from psycopg2 import pool
+        raise pool.PoolError(f"sin conexiones libres en el pool de {dbname} ({db_pool.maxconn})")
+    try:
+        conn = db_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        db_pool.slots.release()
+
+def close_pool(dbname, **overrides):
+    """Cerrar el pool de una base de datos, si existe"""
+    config = admin_config()
+    config.update(overrides)
+    with pools_lock:
+        db_pool = pools.pop((config['host'], config['port'], dbname, config['user']), None)
+    if db_pool is not None:
+        db_pool.closeall()
+
+def close_all_pools():
+    with pools_lock:
+        all_pools = list(pools.values())
+        pools.clear()
+    for db_pool in all_pools:
+        db_pool.closeall()
+
+# Catálogo cacheado: {clave: (momento de la consulta, valor)}
+catalog = {}
+catalog_lock = threading.Lock()
+
+def cached(key, loader=None):
+    """Valor del catálogo para key; se consulta con loader() si no está o ya venció (None sin loader)"""
+    with catalog_lock:
+        entry = catalog.get(key)
+        ttl = float(os.getenv('DB_CATALOG_TTL_SECONDS', '300'))
+        if entry is not None and time.monotonic() - entry[0] < ttl:
+            return entry[1]
+    if loader is None:
+        return None
+    value = loader()
+    store_catalog(key, value)
+    return value
+
+def store_catalog(key, value):
+    """Guardar en el catálogo un valor ya consultado por otro comando"""
+    with catalog_lock:
+        catalog[key] = (time.monotonic(), value)
+
+def invalidate_catalog(dbname=None):
+    """Descartar el catálogo completo o solo los esquemas de una base de datos"""
+    with catalog_lock:
+        if dbname is None:
+            catalog.clear()
+        else:
+            catalog.pop(('schemas', dbname), None)
+
+def list_databases(default_db):
+    """Bases de datos del cluster que no son plantillas, consultadas desde default_db"""
+    def load():
+        with connection(default_db) as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT datname FROM pg_database WHERE datistemplate = false ORDER BY datname;")
+            return [row[0] for row in cursor.fetchall()]
+    return list(cached(('databases', os.getenv('DB_HOST'), default_db), load))
+
+# Misma expresión que sync_databases() (SQL/query.sql) para detectar cambios desde el último backup
+FINGERPRINTS_QUERY = """
+    SELECT d.datname, md5(concat_ws(':', s.tup_inserted, s.tup_updated, s.tup_deleted, s.stats_reset))
+    FROM pg_database d
+    LEFT JOIN pg_stat_database s ON s.datname = d.datname
+    WHERE d.datistemplate = false;
+"""
+
+def remember_databases(default_db, fingerprints):
+    """Guardar las bases de datos del cluster y su fingerprint ya leídos (p. ej. por sync_databases)
+
+    Así grant, revoke y backup ejecutados después en el mismo proceso no vuelven a consultar pg_database.
+    """
+    store_catalog(('databases', os.getenv('DB_HOST'), default_db), sorted(fingerprints))
+    store_catalog(('fingerprints', os.getenv('DB_HOST'), default_db), dict(fingerprints))
+
+def database_fingerprints(default_db, load=True):
+    """{base de datos: fingerprint de actividad} del cluster; con load=False, None si no está en el catálogo"""
+    def load_fingerprints():
+        with connection(default_db) as conn, conn.cursor() as cursor:
+            cursor.execute(FINGERPRINTS_QUERY)
+            fingerprints = dict(cursor.fetchall())
+        store_catalog(('databases', os.getenv('DB_HOST'), default_db), sorted(fingerprints))
+        return fingerprints
+    fingerprints = cached(('fingerprints', os.getenv('DB_HOST'), default_db), load_fingerprints if load else None)
+    return None if fingerprints is None else dict(fingerprints)
+
+def list_schemas(conn, dbname):
+    """Esquemas de usuario de una base de datos, consultados con una conexión a esa base de datos"""
+    def load():
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT schema_name FROM information_schema.schemata
+                WHERE schema_name NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
+                AND schema_name NOT LIKE 'pg_temp_%'
+                AND schema_name NOT LIKE 'pg_toast_temp_%';
+            """)
+            return [row[0] for row in cursor.fetchall()]
+    return list(cached(('schemas', dbname), load))
+
+# Contexto del trabajo en curso (job_id, datname, attempt...) que se añade a cada línea JSON.
+# Un ContextVar sirve tanto para los hilos del pool como para las tareas asyncio.
+log_context = contextvars.ContextVar('log_context', default={})
+
+@contextmanager
+def job_context(**fields):
+    """Añadir fields al contexto de log mientras dura el bloque"""
+    token = log_context.set({**log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+class ContextFilter(logging.Filter):
+    """Copiar el contexto del hilo que registra el mensaje, antes de que pase a la cola"""
+
+    def filter(self, record):
+        record.context = log_context.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por mensaje: hora, nivel, logger, hilo, mensaje, contexto y campos extra"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Listeners en segundo plano, uno por archivo de log; se detienen (vaciando la cola) al salir
+listeners = []
+
+def file_handler(log_file):
+    """Handler del archivo con la rotación de LOG_ROTATION: 'size' (LOG_MAX_MB), 'time' (LOG_ROTATE_WHEN) o 'none'"""
+    rotation = os.getenv('LOG_ROTATION', 'size')
+    backup_count = int(os.getenv('LOG_BACKUP_COUNT', '10'))
+    if rotation == 'size':
+        return logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=int(float(os.getenv('LOG_MAX_MB', '50')) * 1024 ** 2),
+            backupCount=backup_count, encoding='utf-8')
+    if rotation == 'time':
+        return logging.handlers.TimedRotatingFileHandler(
+            log_file, when=os.getenv('LOG_ROTATE_WHEN', 'midnight'), backupCount=backup_count, encoding='utf-8')
+    return logging.FileHandler(log_file, encoding='utf-8')
+
+def get_logger(name, log_file, fmt='%(asctime)s - %(message)s'):
+    """Logger con su propio archivo; se configura una sola vez aunque se pida varias veces
+
+    Los mensajes se encolan con un QueueHandler y un QueueListener los escribe en el archivo
+    desde su propio hilo, así los trabajadores no esperan al disco. LOG_FORMAT elige entre
+    líneas JSON ('json') y el formato de texto fmt ('text').
+    """
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = file_handler(log_file)
+        if os.getenv('LOG_FORMAT', 'json') == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(fmt))
+        records = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(records)
+        queue_handler.addFilter(ContextFilter())
+        listener = logging.handlers.QueueListener(records, handler)
+        listener.start()
+        if not listeners:
+            atexit.register(stop_logging)
+        listeners.append(listener)
+        logger.addHandler(queue_handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+def stop_logging():
+    """Escribir los mensajes pendientes y detener los listeners"""
+    while listeners:
+        listeners.pop().stop()
+
+def log(logger, message, **fields):
+    """Registrar un mensaje con campos extra; el nivel sale del prefijo ERROR/WARNING que usan los scripts"""
+    prefix = message[:7].upper()
+    if prefix.startswith('ERROR'):
+        level = logging.ERROR
+    elif prefix.startswith('WARN'):
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    logger.log(level, message, extra={'fields': fields} if fields else None)
@@ -1,33 +1,27 @@
 import psycopg2
 from psycopg2 import sql
-from datetime import datetime
-from dotenv import load_dotenv
 import os
-import logging
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import db_admin_core as core
 
 # Cargar las variables de entorno desde el archivo .env
-load_dotenv('.env.production')
+core.load_env('.env.production')
 
 BACKUP_USER = os.getenv('DB_BPUSER')
 DB_NAME = os.getenv('DB_DEFAULT')
 LOG_FILE = "log/grant_permissions_pguser.log"
-
-# Configuración de conexión
-db_config = {
-    "host": os.getenv('DB_HOST'),
-    "user": os.getenv('DB_USER'),
-    "password": os.getenv('DB_PASSWORD'),
-    "port": os.getenv('DB_PORT'),
-}
+# Número máximo de bases de datos procesadas en paralelo
+GRANT_WORKERS = int(os.getenv('GRANT_WORKERS', '8'))
 
 # Configuración de logging
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+logger = core.get_logger('grant_permissions_pguser', LOG_FILE, '%(asctime)s - %(levelname)s - %(message)s')
 
-# Establecer conexión con PostgreSQL
+# Establecer conexión con PostgreSQL (conexión propia, sin pool, para cada base de datos)
 def connect_to_postgres(dbname):
     try:
-        conn = psycopg2.connect(dbname=dbname, **db_config)
+        conn = core.connect(dbname)
         return conn
     except psycopg2.OperationalError as e:
         logger.error(f"Connection - Error al conectar a la DB {dbname}: {e}")
@@ -49,102 +43,201 @@ def user_exists(conn, username):
         logger.error(f"Error al verificar la existencia del usuario {username}: {e}")
         return False
 
-# Obtener lista de bases de datos
-def get_databases(conn):
+# Obtener lista de bases de datos (catálogo compartido con los demás comandos)
+def get_databases():
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                sql.SQL("SELECT datname FROM pg_database WHERE datistemplate = false;")
-            )
-            databases = [row[0] for row in cursor.fetchall()]
-            logger.info(f"Bases de datos obtenidas: {len(databases)}")
+        databases = core.list_databases(DB_NAME)
+        logger.info(f"Bases de datos obtenidas: {len(databases)}")
         return databases
     except psycopg2.Error as e:
         logger.error(f"Error al obtener la lista de bases de datos: {e}")
         return []
 
-# Obtener lista de esquemas en una base de datos
-def get_schemas(conn):
+# Obtener lista de esquemas en una base de datos (catálogo compartido con los demás comandos)
+def get_schemas(conn, db):
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                sql.SQL("""
-                    SELECT schema_name FROM information_schema.schemata
-                    WHERE schema_name NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
-                    AND schema_name NOT LIKE 'pg_temp_%'
-                    AND schema_name NOT LIKE 'pg_toast_temp_%';
-                """)
-            )
-            schemas = [row[0] for row in cursor.fetchall()]
-        return schemas
+        return core.list_schemas(conn, db)
     except psycopg2.Error as e:
         logger.error(f"Error al obtener la lista de esquemas: {e}")
         return []
 
-# Otorgar permisos al usuario backup_user en cada base de datos
-def grant_permissions():
-    conn_ = connect_to_postgres(DB_NAME)
-    if not conn_:
-        return
+# Construir las sentencias GRANT / ALTER DEFAULT PRIVILEGES para una base de datos
+def build_grant_statements(db, schemas):
+    sql_statements = [
+        sql.SQL("GRANT CONNECT ON DATABASE {} TO {}").format(
+            sql.Identifier(db), sql.Identifier(BACKUP_USER)),
+    ]
+
+    for esquema in schemas:
+        sql_statements.extend([
+            sql.SQL("GRANT USAGE ON SCHEMA {} TO {}").format(
+                sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
+
+            sql.SQL("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO {}").format(
+                sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
+            sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT SELECT ON TABLES TO {}").format(
+                sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
+
+            sql.SQL("GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA {} TO {}").format(
+                sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
+            sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT USAGE, SELECT ON SEQUENCES TO {}").format(
+                sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
+        ])
+    return sql_statements
+
+# Privilegios actuales de BACKUP_USER por esquema, leídos del catálogo en una sola consulta.
+# Las columnas NULL (esquema sin tablas o sin secuencias) significan que no falta nada.
+# CONNECT se consulta aparte (CONNECT_PRIVILEGE_QUERY): una base de datos sin esquemas de usuario no devuelve filas.
+CURRENT_PRIVILEGES_QUERY = """
+    WITH grantee AS (
+        SELECT oid FROM pg_roles WHERE rolname = %(user)s
+    ),
+    default_acl AS (
+        SELECT d.defaclnamespace, d.defaclobjtype, a.privilege_type
+        FROM pg_default_acl d
+        CROSS JOIN LATERAL aclexplode(d.defaclacl) a
+        WHERE d.defaclrole = (SELECT oid FROM pg_roles WHERE rolname = current_user)
+        AND a.grantee = (SELECT oid FROM grantee)
+    )
+    SELECT n.nspname,
+        has_schema_privilege(%(user)s, n.oid, 'USAGE') AS has_usage,
+        bool_and(has_table_privilege(%(user)s, c.oid, 'SELECT'))
+            FILTER (WHERE c.relkind IN ('r', 'v', 'm', 'f', 'p')) AS has_tables,
+        bool_and(has_sequence_privilege(%(user)s, c.oid, 'USAGE')
+                 AND has_sequence_privilege(%(user)s, c.oid, 'SELECT'))
+            FILTER (WHERE c.relkind = 'S') AS has_sequences,
+        EXISTS (SELECT 1 FROM default_acl da
+                WHERE da.defaclnamespace = n.oid AND da.defaclobjtype = 'r'
+                AND da.privilege_type = 'SELECT') AS has_default_tables,
+        (SELECT count(DISTINCT da.privilege_type) FROM default_acl da
+         WHERE da.defaclnamespace = n.oid AND da.defaclobjtype = 'S'
+         AND da.privilege_type IN ('USAGE', 'SELECT')) = 2 AS has_default_sequences
+    FROM pg_namespace n
+    LEFT JOIN pg_class c ON c.relnamespace = n.oid
+    WHERE n.nspname NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
+    AND n.nspname NOT LIKE 'pg_temp_%%'
+    AND n.nspname NOT LIKE 'pg_toast_temp_%%'
+    GROUP BY n.oid, n.nspname;
+"""
+
+CONNECT_PRIVILEGE_QUERY = "SELECT has_database_privilege(%(user)s, current_database(), 'CONNECT');"
+
+# Construir solo las sentencias GRANT que faltan según los privilegios actuales del catálogo
+def build_missing_grant_statements(conn, db):
+    with conn.cursor() as cursor:
+        cursor.execute(CONNECT_PRIVILEGE_QUERY, {"user": BACKUP_USER})
+        has_connect = cursor.fetchone()[0]
+        cursor.execute(CURRENT_PRIVILEGES_QUERY, {"user": BACKUP_USER})
+        rows = cursor.fetchall()
+
+    user = sql.Identifier(BACKUP_USER)
+    sql_statements = []
+    if not has_connect:
+        sql_statements.append(sql.SQL("GRANT CONNECT ON DATABASE {} TO {}").format(sql.Identifier(db), user))
+
+    for esquema, has_usage, has_tables, has_sequences, has_default_tables, has_default_sequences in rows:
+        schema = sql.Identifier(esquema)
+        if not has_usage:
+            sql_statements.append(sql.SQL("GRANT USAGE ON SCHEMA {} TO {}").format(schema, user))
+        if has_tables is False:
+            sql_statements.append(sql.SQL("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO {}").format(schema, user))
+        if not has_default_tables:
+            sql_statements.append(sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT SELECT ON TABLES TO {}").format(schema, user))
+        if has_sequences is False:
+            sql_statements.append(sql.SQL("GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA {} TO {}").format(schema, user))
+        if not has_default_sequences:
+            sql_statements.append(sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT USAGE, SELECT ON SEQUENCES TO {}").format(schema, user))
+    return sql_statements
+
+# Otorgar permisos en una base de datos: todas las sentencias en un único envío y una transacción.
+# Con reconcile solo se envían los privilegios que faltan; con dry_run se imprime el plan sin ejecutarlo.
+# Devuelve (db, éxito, mensaje de error, número de sentencias)
+def grant_permissions_in_database(db, reconcile=False, dry_run=False):
+    conn_db = connect_to_postgres(db)
+    if not conn_db:
+        return db, False, "Error de conexión", 0
 
     try:
-        if not user_exists(conn_, BACKUP_USER):
-            logger.error(f"El usuario {BACKUP_USER} no existe. Terminando el script.")
-            return
-
-        databases = get_databases(conn_)
+        if reconcile or dry_run:
+            sql_statements = build_missing_grant_statements(conn_db, db)
+        else:
+            sql_statements = build_grant_statements(db, get_schemas(conn_db, db))
+
+        if dry_run:
+            for statement in sql_statements:
+                print(f"[{db}] {statement.as_string(conn_db)};")
+            conn_db.rollback()
+            return db, True, None, len(sql_statements)
+
+        if not sql_statements:
+            conn_db.rollback()
+            logger.info(f"Sin privilegios pendientes para usuario:[{BACKUP_USER}] - DB: [{db}]")
+            return db, True, None, 0
+
+        with conn_db.cursor() as cursor:
+            cursor.execute(sql.SQL(";\n").join(sql_statements))
+        conn_db.commit()
+
+        logger.info(f"Permisos otorgados para usuario:[{BACKUP_USER}] - DB: [{db}] ({len(sql_statements)} sentencias)")
+        return db, True, None, len(sql_statements)
+    except psycopg2.Error as e:
+        logger.error(f"Error al otorgar permisos usuario:[{BACKUP_USER}] - DB: [{db}]: {e}")
+        conn_db.rollback()
+        return db, False, str(e).strip(), 0
+    finally:
+        conn_db.close()
+
+# Registrar el resumen de resultados por base de datos
+def log_summary(results):
+    failed = {db: error for db, ok, error, _ in results if not ok}
+    unchanged = sum(1 for _, ok, _, statements in results if ok and statements == 0)
+    statements = sum(count for *_, count in results)
+    logger.info(f"Resumen: {len(results) - len(failed)} bases de datos correctas ({unchanged} sin cambios), "
+                f"{len(failed)} con errores, {statements} sentencias")
+    for db, error in sorted(failed.items()):
+        logger.error(f"Resumen - DB: [{db}]: {error}")
+
+# Otorgar permisos al usuario backup_user en cada base de datos, en paralelo.
+# Devuelve los resultados por base de datos, o None si no se pudo empezar.
+def grant_permissions(reconcile=False, dry_run=False):
+    try:
+        with core.connection(DB_NAME) as conn_:
+            if not user_exists(conn_, BACKUP_USER):
+                logger.error(f"El usuario {BACKUP_USER} no existe. Terminando el script.")
+                return None
+    except psycopg2.Error as e:
+        logger.error(f"Connection - Error al conectar a la DB {DB_NAME}: {e}")
+        return None
 
-        for db in databases:
-            conn_db = connect_to_postgres(db)
-            if not conn_db:
-                continue
+    databases = get_databases()
 
+    results = []
+    with ThreadPoolExecutor(max_workers=GRANT_WORKERS) as executor:
+        futures = {executor.submit(grant_permissions_in_database, db, reconcile, dry_run): db for db in databases}
+        for future in as_completed(futures):
+            db = futures[future]
             try:
-                schemas = get_schemas(conn_db)
-
-                sql_statements = [
-                    sql.SQL("GRANT CONNECT ON DATABASE {} TO {}").format(
-                        sql.Identifier(db), sql.Identifier(BACKUP_USER)),
-                ]
-
-                for esquema in schemas:
-                    sql_statements.extend([
-                        sql.SQL("GRANT USAGE ON SCHEMA {} TO {}").format(
-                            sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
-
-                        sql.SQL("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO {}").format(
-                            sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
-                        sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT SELECT ON TABLES TO {}").format(
-                            sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
-
-                        sql.SQL("GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA {} TO {}").format(
-                            sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
-                        sql.SQL("ALTER DEFAULT PRIVILEGES IN SCHEMA {} GRANT USAGE, SELECT ON SEQUENCES TO {}").format(
-                            sql.Identifier(esquema), sql.Identifier(BACKUP_USER)),
-                    ])
-
-                with conn_db.cursor() as cursor:
-                    cursor.execute("BEGIN;")
-                    for statement in sql_statements:
-                        # logger.info(f"{sql_statements}")
-                        cursor.execute(statement)
-                    cursor.execute("COMMIT;")
-
-                logger.info(f"Permisos otorgados para usuario:[{BACKUP_USER}] - DB: [{db}]")
-            except psycopg2.Error as e:
-                logger.error(f"Error al otorgar permisos usuario:[{BACKUP_USER}] - DB: [{db}]: {e}")
-                with conn_db.cursor() as cursor:
-                    cursor.execute("ROLLBACK;")
-
-            finally:
-                conn_db.close()
-    finally:
-        conn_.close()
-
-def main():
-    grant_permissions()
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Error inesperado al otorgar permisos - DB: [{db}]: {e}")
+                results.append((db, False, str(e), 0))
+
+    log_summary(results)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Otorgar permisos de lectura al usuario de backup en todas las bases de datos")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="Leer los privilegios actuales y otorgar solo los que faltan")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Imprimir las sentencias que faltan sin ejecutarlas (implica --reconcile)")
+    args = parser.parse_args(argv)
+
+    results = grant_permissions(reconcile=args.reconcile, dry_run=args.dry_run)
     logger.info("---")
     print(f"Proceso de otorgamiento de permisos completado. Detalles en el archivo {LOG_FILE}")
+    # 1 si no se pudo empezar o alguna base de datos quedó sin permisos
+    return 1 if results is None or any(not ok for _, ok, _, _ in results) else 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -1,38 +1,41 @@
 import os
+import sys
+import json
+import argparse
+import threading
 import psycopg2
 from psycopg2 import sql
 from psycopg2.errors import DependentObjectsStillExist, UndefinedObject
 from datetime import datetime
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import db_admin_core as core
 
 # Cargar las variables de entorno desde el archivo .env
-load_dotenv('.env.production')
+core.load_env('.env.production')
 
 # Archivo de log
 LOG_FILE = 'log/revoke_drop_pguser.log'
+# Registro de progreso para reanudar una ejecución interrumpida
+PROGRESS_FILE = 'log/revoke_drop_pguser.progress.json'
+# Número máximo de bases de datos procesadas en paralelo
+REVOKE_WORKERS = int(os.getenv('REVOKE_WORKERS', '8'))
 
-# Configuración de conexión
-db_config = {
-    "host": os.getenv('DB_HOST'),
-    "user": os.getenv('DB_USER'),
-    "password": os.getenv('DB_PASSWORD'),
-    "port": os.getenv('DB_PORT'),
-}
 DB_NAME = os.getenv('DB_DEFAULT')
 
 # Nombre del usuario a eliminar
 user_to_drop = os.getenv('DB_BPUSER')
 
-#Escribe un mensaje en el archivo de log con una marca de tiempo.
-def log_message(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, 'a') as log:
-        log.write(f"{timestamp} - {message}\n")
+progress_lock = threading.Lock()
+logger = core.get_logger('revoke_drop_pguser', LOG_FILE)
 
-#Conecta a la base de datos especificada y devuelve la conexión.
+#Escribe un mensaje en el log; lo encola y un hilo en segundo plano lo escribe en el archivo.
+def log_message(message, **fields):
+    core.log(logger, message, **fields)
+
+#Conecta a la base de datos especificada y devuelve una conexión propia (sin pool) en modo autocommit.
 def connect_to_database(dbname):
     try:
-        conn = psycopg2.connect(dbname=dbname, **db_config)
+        conn = core.connect(dbname)
         conn.autocommit = True
         return conn
     except psycopg2.OperationalError as e:
@@ -53,19 +56,70 @@ def user_exists(conn, user):
         log_message(f"ERROR: al verificar la existencia del usuario {user}: {e}")
         return False
 
-#Obtiene la lista de bases de datos no plantillas.
-def get_databases(conn):
+#Obtiene la lista de bases de datos no plantillas (catálogo compartido con los demás comandos).
+def get_databases():
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT datname FROM pg_database WHERE datistemplate = false;")
-            databases = [row[0] for row in cursor.fetchall()]
-            log_message(f"Bases de datos obtenidas: {len(databases)}")
+        databases = core.list_databases(DB_NAME)
+        log_message(f"Bases de datos obtenidas: {len(databases)}")
         return databases
     except psycopg2.Error as e:
         log_message(f"Error al obtener la lista de bases de datos: {e}")
         return []
 
+#Obtiene solo las bases de datos donde el usuario es dueño de objetos o tiene privilegios (pg_shdepend).
+#Incluye las dependencias locales de cada base (dbid) y los privilegios sobre la propia base de datos.
+def get_databases_with_dependencies(conn, user):
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                WITH role AS (
+                    SELECT oid FROM pg_roles WHERE rolname = %(user)s
+                )
+                SELECT DISTINCT d.datname
+                FROM pg_shdepend s
+                JOIN pg_database d
+                    ON d.oid = s.dbid
+                    OR (s.dbid = 0 AND s.classid = 'pg_database'::regclass AND s.objid = d.oid)
+                WHERE s.refclassid = 'pg_authid'::regclass
+                AND s.refobjid = (SELECT oid FROM role)
+                AND d.datistemplate = false
+                ORDER BY d.datname;
+            """, {"user": user})
+            databases = [row[0] for row in cursor.fetchall()]
+            log_message(f"Bases de datos con dependencias del usuario {user}: {len(databases)}")
+        return databases
+    except psycopg2.Error as e:
+        log_message(f"ERROR: al consultar pg_shdepend para el usuario {user}: {e}")
+        return None
+
+#Carga las bases de datos ya procesadas para el usuario en una ejecución anterior.
+def load_progress(user):
+    try:
+        with open(PROGRESS_FILE) as f:
+            progress = json.load(f)
+    except FileNotFoundError:
+        return set()
+    except (OSError, ValueError) as e:
+        log_message(f"ERROR: al leer el archivo de progreso {PROGRESS_FILE}: {e}")
+        return set()
+    if progress.get("user") != user:
+        return set()
+    return set(progress.get("done", []))
+
+#Guarda de forma atómica las bases de datos ya procesadas.
+def save_progress(user, done):
+    tmp_file = PROGRESS_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({"user": user, "done": sorted(done), "updated_at": datetime.now().isoformat()}, f)
+    os.replace(tmp_file, PROGRESS_FILE)
+
+#Elimina el archivo de progreso al terminar.
+def clear_progress():
+    if os.path.exists(PROGRESS_FILE):
+        os.remove(PROGRESS_FILE)
+
 #Revoca los privilegios y elimina objetos del usuario especificado en la base de datos.
+#Devuelve True si las operaciones se completaron sin errores.
 def revoke_privileges_and_drop_user(conn, dbname):
     try:
         with conn.cursor() as cur:
@@ -79,45 +133,93 @@ def revoke_privileges_and_drop_user(conn, dbname):
             ))
 
             log_message(f"INFO: Privilegios revocados y objetos eliminados en la base de datos [{dbname}]")
+        return True
 
     except (DependentObjectsStillExist, UndefinedObject) as e:
         log_message(f"ERROR: en la base de datos {dbname}: {e}")
     except psycopg2.Error as e:
         log_message(f"ERROR: general en la base de datos {dbname}: {e}")
+    return False
+
+#Procesa una base de datos en su propia conexión.
+def revoke_in_database(dbname):
+    conn_db = connect_to_database(dbname)
+    if not conn_db:
+        return False
+    try:
+        return revoke_privileges_and_drop_user(conn_db, dbname)
+    finally:
+        conn_db.close()
+        core.invalidate_catalog(dbname)  # DROP OWNED puede haber eliminado esquemas
 
 #Revoca privilegios y elimina el usuario en todas las bases de datos.
-def drop_user_everywhere():
-    conn = connect_to_database(DB_NAME)
-    if not conn:
-        return
+#Solo se procesan, en paralelo, las bases de datos con dependencias del usuario; el progreso se guarda
+#en PROGRESS_FILE para que una ejecución interrumpida continúe donde se quedó.
+#Devuelve True si el usuario quedó eliminado.
+def drop_user_everywhere(resume=True):
+    try:
+        with core.connection(DB_NAME) as conn:
+            if not user_exists(conn, user_to_drop):
+                log_message(f"ERROR: Usuario {user_to_drop} no existe en PostgreSQL.")
+                return False
 
-    if not user_exists(conn, user_to_drop):
-        log_message(f"ERROR: Usuario {user_to_drop} no existe en PostgreSQL.")
-        return
+            databases = get_databases_with_dependencies(conn, user_to_drop)
+    except psycopg2.Error as e:
+        log_message(f"ERROR:Connection - Error al conectar a la DB {DB_NAME}: {e}")
+        return False
+    if databases is None:
+        databases = get_databases()
+
+    done = load_progress(user_to_drop) if resume else set()
+    pending = [db for db in databases if db not in done]
+    if done:
+        log_message(f"INFO: Reanudando, {len(done)} bases de datos ya procesadas, {len(pending)} pendientes")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=REVOKE_WORKERS) as executor:
+        futures = {executor.submit(revoke_in_database, db): db for db in pending}
+        for future in as_completed(futures):
+            db = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                log_message(f"ERROR: inesperado en la base de datos {db}: {e}")
+                ok = False
+            if ok:
+                with progress_lock:
+                    done.add(db)
+                    save_progress(user_to_drop, done)
+            else:
+                failed.append(db)
+
+    if failed:
+        log_message(f"ERROR: No se elimina el usuario {user_to_drop}, fallaron las bases de datos: {sorted(failed)}. "
+                    f"Vuelve a ejecutar el script para reintentar solo las pendientes.")
+        return False
 
     try:
-        databases = get_databases(conn)
-
-        for db in databases:
-            conn_db = connect_to_database(db)
-            if conn_db:
-                revoke_privileges_and_drop_user(conn_db, db)
-                conn_db.close()
-
-        with connect_to_database(DB_NAME) as conn_postgres:
-            if conn_postgres:
-                with conn_postgres.cursor() as cur:
-                    cur.execute(sql.SQL("DROP USER IF EXISTS {}").format(
-                        sql.Identifier(user_to_drop)
-                    ))
-                    log_message(f"INFO: Usuario {user_to_drop} eliminado en PostgreSQL")
+        with core.connection(DB_NAME) as conn_postgres:
+            with conn_postgres.cursor() as cur:
+                cur.execute(sql.SQL("DROP USER IF EXISTS {}").format(
+                    sql.Identifier(user_to_drop)
+                ))
+        log_message(f"INFO: Usuario {user_to_drop} eliminado en PostgreSQL")
+        clear_progress()
+        return True
     except psycopg2.Error as e:
         log_message(f"ERROR: al realizar operaciones: {e}")
+        return False
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Revocar privilegios y eliminar un usuario en todas las bases de datos")
+    parser.add_argument('--restart', action='store_true',
+                        help=f"Ignorar el progreso guardado en {PROGRESS_FILE} y procesar todas las bases de datos")
+    args = parser.parse_args(argv)
 
-def main():
-    drop_user_everywhere()
+    dropped = drop_user_everywhere(resume=not args.restart)
     log_message("---")
     print(f"Proceso de revocados y eliminar usuario completado. Detalles en el archivo {LOG_FILE}")
+    return 0 if dropped else 1
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -1,56 +1,95 @@
+import sys
+import argparse
+import time
 import psycopg2
-import logging
-from dotenv import load_dotenv
 import os
+import db_admin_core as core
 
 # Cargar las variables de entorno desde el archivo .env
-load_dotenv('.env.production')
+core.load_env('.env.production')
 
 # Configuración
-PGHOST = os.getenv('DB_HOST')
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAME = os.getenv('DB_DEFAULT')
+# Días máximos sin respaldar una base de datos sin cambios (0 = respaldar todas)
+BACKUP_MAX_AGE_DAYS = float(os.getenv('BACKUP_MAX_AGE_DAYS', '6'))
 
 # Configuración de logging
 LOG_FILE = "log/sync_databases.log"
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(message)s')
+logger = core.get_logger('sync_databases', LOG_FILE)
 
-def log_message(message):
-    """Log a message to the log file."""
-    logging.info(message)
+def log_message(message, **fields):
+    """Log a message (queued, written by a background thread) with optional structured fields."""
+    core.log(logger, message, **fields)
 
 def connect_to_database():
-    """Establish a connection to the PostgreSQL database."""
-    try:
-        conn = psycopg2.connect(host=PGHOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
-        return conn
-    except psycopg2.DatabaseError as e:
-        log_message(f"Error al conectar a la base de datos: {e}")
-        raise
+    """Borrow a pooled connection to the control database, shared with the other db-admin commands."""
+    return core.connection(DB_NAME)
 
 def sync_databases(conn):
-    """Synchronize databases by calling the PostgreSQL function."""
+    """Synchronize databases by calling the PostgreSQL function.
+
+    Only databases whose change fingerprint differs from the last successful backup,
+    or whose last backup is older than BACKUP_MAX_AGE_DAYS, are marked PENDING.
+    Returns a dict with the sync duration in seconds and the rows inserted,
+    updated and deleted in backup_dbs.
+    The databases and fingerprints of the sync snapshot are stored in the shared catalog, so
+    grant, revoke and backup run afterwards in the same process (db_admin.py) reuse them.
+    """
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT sync_databases()")
+            start = time.perf_counter()
+            cur.execute("SELECT * FROM sync_databases(make_interval(secs => %s))", (BACKUP_MAX_AGE_DAYS * 86400,))
+            inserted, updated, deleted = cur.fetchone()
+            # sync_snapshot se elimina al confirmar (ON COMMIT DROP)
+            cur.execute("SELECT datname, fingerprint FROM pg_temp.sync_snapshot")
+            fingerprints = dict(cur.fetchall())
             conn.commit()
-            log_message("Synchronize databases completada exitosamente.")
+            core.remember_databases(DB_NAME, fingerprints)
+            result = {
+                "duration": time.perf_counter() - start,
+                "inserted": inserted,
+                "updated": updated,
+                "deleted": deleted,
+            }
+            log_message(f"Synchronize databases completada exitosamente en {result['duration']:.3f}s - "
+                        f"insertadas: {inserted}, actualizadas: {updated}, eliminadas: {deleted}", **result)
+            return result
     except psycopg2.Error as e:
         conn.rollback()
         log_message(f"Error al sincronizar las bases de datos: {e}")
         raise
 
-def main():
-    """Main function to synchronize databases."""
+def report_timings(results):
+    """Print the duration and rows changed of each sync run, plus a summary for repeated runs."""
+    for i, result in enumerate(results, 1):
+        changed = result["inserted"] + result["updated"] + result["deleted"]
+        print(f"Run {i}: {result['duration']:.3f}s - filas modificadas: {changed} "
+              f"(insertadas: {result['inserted']}, actualizadas: {result['updated']}, eliminadas: {result['deleted']})")
+    if len(results) > 1:
+        durations = [result["duration"] for result in results]
+        print(f"Duración min/avg/max: {min(durations):.3f}s / {sum(durations) / len(durations):.3f}s / {max(durations):.3f}s")
+
+def main(argv=None):
+    """Main function to synchronize databases. Returns 0 on success and 1 if the sync failed."""
+    parser = argparse.ArgumentParser(description="Synchronize backup_dbs with the databases in the cluster.")
+    parser.add_argument('--timing', action='store_true', help="Print the sync duration and rows changed")
+    parser.add_argument('--runs', type=int, default=1,
+                        help="Number of consecutive syncs to run (later runs show the cost of a no-change sync)")
+    args = parser.parse_args(argv)
+
+    status = 0
     try:
         with connect_to_database() as conn:
-            sync_databases(conn)
+            results = [sync_databases(conn) for _ in range(max(args.runs, 1))]
+        if args.timing:
+            report_timings(results)
     except Exception as e:
         log_message(f"Proceso fallido: {e}")
+        status = 1
     finally:
         log_message("---")
         print(f"Proceso de sincronización completado. Detalles en el archivo {LOG_FILE}")
+    return status
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""
+Configuración común de las pruebas de db_admin_tools.
+
+Los scripts leen su configuración y abren sus logs al importarse: las pruebas se ejecutan en un
+directorio temporal (con log/) y con valores de conexión ficticios, sin servidor PostgreSQL.
+"""
+
+import os
+import sys
+import tempfile
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOLS_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix='db_admin_tools_tests_')
+os.makedirs(os.path.join(WORK_DIR, 'log'))
+os.chdir(WORK_DIR)
+
+for name, value in {
+    'DB_HOST': 'localhost',
+    'DB_PORT': '5432',
+    'DB_USER': 'postgres',
+    'DB_DEFAULT': 'postgres',
+    'DB_BPUSER': 'backup',
+    'DB_BPUSERPASS': 'secret',
+    'GPG_NAME': 'backup@example.com',
+}.items():
+    os.environ.setdefault(name, value)
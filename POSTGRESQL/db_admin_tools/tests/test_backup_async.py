@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+import backup_async
+import backup_postgres as bp
+
+
+@pytest.fixture
+def job_budget(monkeypatch):
+    monkeypatch.setattr(bp, 'available_jobs', 9)
+    monkeypatch.setattr(bp, 'PARALLEL_DUMP_JOBS', 8)
+    monkeypatch.setattr(bp, 'PARALLEL_DUMP_THRESHOLD_MB', 1)
+    monkeypatch.setattr(bp, 'COMPRESSION_RULES', [])
+
+
+@pytest.fixture
+def fake_dump(monkeypatch, tmp_path):
+    commands = []
+
+    async def run_process(cmd):
+        commands.append(cmd)
+
+    async def run_pipeline(pipeline, output_path, metrics=None, throttle=()):
+        commands.append(pipeline[0])
+        return 0.0, 0.0
+
+    monkeypatch.setattr(backup_async, 'run_process_async', run_process)
+    monkeypatch.setattr(backup_async, 'run_pipeline_async', run_pipeline)
+    return commands
+
+
+def dump_jobs(command):
+    return int(command[command.index('-j') + 1]) if '-j' in command else 1
+
+
+def test_lone_large_dump_uses_free_budget(job_budget, fake_dump, tmp_path):
+    asyncio.run(backup_async.dump_database('big', str(tmp_path), 2 * 1024 ** 2, {}))
+
+    assert dump_jobs(fake_dump[0]) == 8
+    assert bp.available_jobs == 9
+
+
+def test_large_dump_gets_what_is_left(job_budget, fake_dump, tmp_path):
+    held = bp.acquire_dump_jobs(1) + bp.acquire_dump_jobs(1)
+    asyncio.run(backup_async.dump_database('big', str(tmp_path), 2 * 1024 ** 2, {}))
+    bp.release_dump_jobs(1)
+    bp.release_dump_jobs(1)
+
+    assert held == 2
+    assert dump_jobs(fake_dump[0]) == 6
+    assert bp.available_jobs == 9
+
+
+def test_cancelled_wait_returns_jobs(job_budget):
+    async def scenario():
+        held = bp.acquire_dump_jobs(8)  # Agota el presupuesto: 8 jobs = 9 conexiones
+        waiter = asyncio.create_task(backup_async.acquire_dump_jobs(1))
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        bp.release_dump_jobs(held)
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if bp.available_jobs == 9:
+                break
+
+    asyncio.run(scenario())
+    assert bp.available_jobs == 9
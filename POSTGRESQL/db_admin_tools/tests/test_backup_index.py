@@ -0,0 +1,49 @@
+import os
+from datetime import datetime
+
+import backup_index
+
+
+def write_backup(backup_dir, day, db):
+    folder = os.path.join(backup_dir, day)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{db}.backup.gpg")
+    with open(path, 'wb') as f:
+        f.write(b'x')
+    return path
+
+
+def indexed_paths(index_path):
+    return {artifact['path'] for artifact in backup_index.list_artifacts(index_path=index_path)}
+
+
+def test_sweep_only_scans_after_last_sweep(tmp_path):
+    backup_dir = str(tmp_path / 'backup')
+    store_dir = str(tmp_path / 'store')
+    index_path = str(tmp_path / 'index.sqlite3')
+    first = write_backup(backup_dir, '2024-01-01', 'a')
+
+    swept = backup_index.sweep_unindexed(backup_dir, store_dir, until=datetime(2024, 1, 10), index_path=index_path)
+    assert [artifact['path'] for artifact in swept] == [first]
+    assert backup_index.get_meta('swept_until', index_path) == '2024-01-10T00:00:00'
+
+    # Lo anterior al último barrido ya no se recorre; lo que queda entre ese barrido y until, sí
+    skipped = write_backup(backup_dir, '2024-01-05', 'b')
+    second = write_backup(backup_dir, '2024-01-15', 'c')
+    write_backup(backup_dir, '2024-01-25', 'd')
+    swept = backup_index.sweep_unindexed(backup_dir, store_dir, until=datetime(2024, 1, 20), index_path=index_path)
+
+    assert [artifact['path'] for artifact in swept] == [second]
+    assert skipped not in indexed_paths(index_path)
+    backup_index.close_index(index_path)
+
+
+def test_rebuild_marks_everything_swept(tmp_path):
+    backup_dir = str(tmp_path / 'backup')
+    index_path = str(tmp_path / 'index.sqlite3')
+    write_backup(backup_dir, '2024-01-01', 'a')
+
+    assert backup_index.rebuild_index(backup_dir, str(tmp_path / 'store'), index_path=index_path) == 1
+    assert backup_index.sweep_unindexed(backup_dir, str(tmp_path / 'store'), until=datetime(2024, 1, 10),
+                                        index_path=index_path) == []
+    backup_index.close_index(index_path)
@@ -0,0 +1,57 @@
+import pytest
+
+import backup_postgres as bp
+
+
+def has_option(command, option, value):
+    return any(command[i:i + 2] == [option, value] for i in range(len(command) - 1))
+
+
+@pytest.mark.parametrize('version', [0, 15, 16, 17])
+@pytest.mark.parametrize('compression', [None] + [(codec, level) for codec in bp.COMPRESSION_CODECS for level in (1, 3, 9)])
+def test_directory_dump_never_uncompressed(monkeypatch, version, compression):
+    monkeypatch.setattr(bp, 'pg_dump_major_version', lambda: version)
+    command = bp.build_directory_dump_command('db', 4, '/tmp/db.backup.dir', compression)
+    assert has_option(command, '-F', 'd')
+    assert not has_option(command, '-Z', '0')
+
+
+def test_directory_dump_uses_pg_dump_codec(monkeypatch):
+    monkeypatch.setattr(bp, 'pg_dump_major_version', lambda: 16)
+    command = bp.build_directory_dump_command('db', 4, '/tmp/db.backup.dir', ('zstd', 3))
+    assert has_option(command, '-Z', 'zstd:3')
+
+
+def test_directory_tar_has_no_codec_stage():
+    stages, extension = bp.directory_tar_stages(('zstd', 3))
+    assert [stage[0] for stage in stages] == ['gpg']
+    assert has_option(stages[0], '--compress-algo', 'none')
+    assert extension == '.backup.tar.gpg'
+
+
+@pytest.mark.parametrize('message', [
+    'pg_dump: error: query failed: ERROR:  relation with OID 12345 does not exist',
+    'pg_dump: error: query failed: ERROR:  could not find a relation named "public.orders"',
+    'pg_dump: error: connection to server at "db" (10.0.0.1), port 5432 failed: Connection refused',
+    'pg_dump: error: Dumping the contents of table "t" failed: PQgetResult() failed.\nserver closed the connection unexpectedly',
+    'pg_dump: error: query failed: ERROR:  canceling statement due to conflict with recovery',
+    'gpg: error writing to stdout: No space left on device',
+])
+def test_transient_errors_are_retried(message):
+    assert bp.is_transient_error(message)
+
+
+@pytest.mark.parametrize('message', [
+    'pg_dump: error: connection to server at "db" (10.0.0.1), port 5432 failed: FATAL:  database "sales" does not exist',
+    'pg_dump: error: falló la conexión al servidor: FATAL:  la base de datos «ventas» no existe',
+    'pg_dump: error: connection to server failed: FATAL:  role "backup" does not exist',
+    'pg_dump: error: falló la conexión al servidor: FATAL:  el rol «backup» no existe',
+    'pg_dump: error: connection to server failed: FATAL:  password authentication failed for user "backup"',
+    'pg_dump: error: falló la conexión al servidor: FATAL:  la autentificación password falló para el usuario «backup»',
+    'pg_dump: error: connection to server failed: FATAL:  no pg_hba.conf entry for host "10.0.0.2", user "backup"',
+    'pg_dump: error: query failed: ERROR:  permission denied for table orders',
+    'gpg: backup@example.com: skipped: No public key',
+    'pg_dump: error: aborting because of server version mismatch',
+])
+def test_permanent_errors_are_not_retried(message):
+    assert not bp.is_transient_error(message)
@@ -0,0 +1,50 @@
+import io
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+import backup_store
+
+RECIPIENT = 'restore-test@example.com'
+
+
+@pytest.fixture
+def gpg_home(tmp_path, monkeypatch):
+    if shutil.which('gpg') is None:
+        pytest.skip("gpg no está instalado")
+    home = tmp_path / 'gnupg'
+    home.mkdir(mode=0o700)
+    monkeypatch.setenv('GNUPGHOME', str(home))
+    subprocess.run(['gpg', '--batch', '--passphrase', '', '--quick-gen-key', RECIPIENT, 'default', 'default', 'never'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    yield home
+    subprocess.run(['gpgconf', '--kill', 'gpg-agent'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def test_restore_decrypts_chunks_in_batches(tmp_path, gpg_home, monkeypatch):
+    store_dir = str(tmp_path / 'store')
+    rng = random.Random(0)
+    block = rng.randbytes(3 * 1024 * 1024)
+    data = block + rng.randbytes(40 * 1024 * 1024) + block
+    key = b'secret'
+    chunks, _ = backup_store.backup_stream(store_dir, io.BytesIO(data), RECIPIENT, key)
+    manifest_path = backup_store.write_manifest(store_dir, 'db', chunks, 'custom')
+
+    gpg_runs = []
+    run = subprocess.run
+
+    def counting_run(command, *args, **kwargs):
+        if command[0] == 'gpg':
+            gpg_runs.append(command)
+        return run(command, *args, **kwargs)
+
+    monkeypatch.setattr(backup_store.subprocess, 'run', counting_run)
+    output = io.BytesIO()
+    backup_store.restore_manifest(store_dir, manifest_path, output, key)
+
+    assert output.getvalue() == data
+    assert len(gpg_runs) == -(-len(chunks) // backup_store.DECRYPT_BATCH_CHUNKS)
+    assert os.listdir(os.path.join(store_dir, 'tmp')) == []
@@ -0,0 +1,43 @@
+import sys
+import types
+
+import db_admin
+
+
+def fake_command(monkeypatch, module_name, calls, status):
+    module = types.ModuleType(module_name)
+
+    def main(argv=None):
+        calls.append(module_name)
+        return status
+
+    module.main = main
+    monkeypatch.setitem(sys.modules, module_name, module)
+
+
+def test_failed_command_stops_chain(monkeypatch):
+    calls = []
+    fake_command(monkeypatch, 'sync_databases', calls, 1)
+    fake_command(monkeypatch, 'grant_permissions_pguser', calls, 0)
+
+    assert db_admin.main(['sync', '+', 'grant']) == 1
+    assert calls == ['sync_databases']
+
+
+def test_successful_chain_runs_every_command(monkeypatch):
+    calls = []
+    fake_command(monkeypatch, 'sync_databases', calls, 0)
+    fake_command(monkeypatch, 'grant_permissions_pguser', calls, None)
+
+    assert db_admin.main(['sync', '+', 'grant']) == 0
+    assert calls == ['sync_databases', 'grant_permissions_pguser']
+
+
+def test_sync_main_reports_failure(monkeypatch):
+    import sync_databases
+
+    def fail():
+        raise RuntimeError("sin conexión")
+
+    monkeypatch.setattr(sync_databases, 'connect_to_database', fail)
+    assert sync_databases.main([]) == 1
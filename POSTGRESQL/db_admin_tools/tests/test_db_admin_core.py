@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+from psycopg2 import pool
+
+import db_admin_core as core
+
+
+class FakeConnection:
+    closed = 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    """Como ThreadedConnectionPool: getconn() falla con el pool agotado en lugar de esperar"""
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.maxconn = maxconn
+        self.used = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.used >= self.maxconn:
+                raise pool.PoolError("connection pool exhausted")
+            self.used += 1
+            self.peak = max(self.peak, self.used)
+        return FakeConnection()
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            self.used -= 1
+
+    def closeall(self):
+        pass
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(pool, 'ThreadedConnectionPool', FakePool)
+    core.close_all_pools()
+    yield
+    core.close_all_pools()
+
+
+def test_connection_waits_when_pool_is_exhausted(fake_pool):
+    errors = []
+
+    def use_connection():
+        try:
+            with core.connection('control', maxconn=2):
+                time.sleep(0.02)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=use_connection) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert core.get_pool('control').peak == 2
+
+
+def test_connection_gives_up_after_pool_wait(fake_pool, monkeypatch):
+    monkeypatch.setenv('DB_POOL_WAIT_SECONDS', '0.05')
+    with core.connection('control', maxconn=1):
+        with pytest.raises(pool.PoolError):
+            with core.connection('control', maxconn=1):
+                pass
@@ -0,0 +1,360 @@
+"""
+Verificación de backups: restaura una muestra de los últimos backups en un cluster temporal.
+
+Para cada base de datos de la muestra se localiza su último artefacto (carpeta del día o
+manifiesto del repositorio deduplicado), se descifra y descomprime en un único flujo y se
+restaura con pg_restore -j en un cluster local creado con initdb (o en VERIFY_PGHOST si se
+indica uno). Después se comparan las tablas restauradas con las de origen: deben existir
+las mismas, con un número de filas dentro de VERIFY_ROW_TOLERANCE respecto a las
+estadísticas de origen (el origen sigue cambiando después del backup) y un tamaño
+(pg_total_relation_size) dentro de VERIFY_SIZE_TOLERANCE; si no, el resultado es MISMATCH.
+
+El resultado, el tiempo de verificación y el throughput de restauración (bytes de la base
+restaurada por segundo de pg_restore, nuestro RTO real) se guardan en backup_dbs.
+
+pg_restore no admite -j leyendo de stdin, así que el archivo descifrado se escribe en
+VERIFY_SCRATCH_DIR y se elimina al terminar cada base de datos.
+
+Uso:
+    python verify_backups.py [--sample 3] [--db DB ...] [--jobs 4] [--keep-cluster]
+"""
+
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import psycopg2
+from psycopg2 import sql
+
+import backup_postgres as bp
+import backup_store
+import backup_index
+import db_admin_core as core
+
+# Binarios del cluster temporal (por defecto, los del PATH)
+PG_RESTORE_PATH = os.getenv('PG_RESTORE_PATH', 'pg_restore')
+INITDB_PATH = os.getenv('INITDB_PATH', 'initdb')
+PG_CTL_PATH = os.getenv('PG_CTL_PATH', 'pg_ctl')
+
+# Bases de datos verificadas por ejecución y jobs de pg_restore
+VERIFY_SAMPLE = int(os.getenv('VERIFY_SAMPLE', '3'))
+VERIFY_JOBS = int(os.getenv('VERIFY_JOBS', str(os.cpu_count() or 1)))
+# Directorio para el cluster temporal y los archivos descifrados
+VERIFY_SCRATCH_DIR = os.getenv('VERIFY_SCRATCH_DIR', tempfile.gettempdir())
+VERIFY_PORT = int(os.getenv('VERIFY_PORT', '55432'))
+# Cluster existente en lugar de uno temporal (vacío = initdb local)
+VERIFY_PGHOST = os.getenv('VERIFY_PGHOST', '')
+VERIFY_PGUSER = os.getenv('VERIFY_PGUSER', 'postgres')
+# Diferencia relativa de filas admitida por tabla frente a n_live_tup de origen
+VERIFY_ROW_TOLERANCE = float(os.getenv('VERIFY_ROW_TOLERANCE', '0.1'))
+# Diferencia relativa de tamaño admitida por tabla (con índices y TOAST); es más amplia que la de
+# filas porque la tabla restaurada no arrastra el bloat del origen. Por debajo de
+# VERIFY_SIZE_MIN_BYTES de diferencia no se compara
+VERIFY_SIZE_TOLERANCE = float(os.getenv('VERIFY_SIZE_TOLERANCE', '0.5'))
+VERIFY_SIZE_MIN_BYTES = int(os.getenv('VERIFY_SIZE_MIN_BYTES', str(8 * 1024 ** 2)))
+
+# Extensión de compresión del artefacto -> comando de descompresión a stdout
+DECOMPRESSION_COMMANDS = {
+    '.zst': ['zstd', '-q', '-d', '-c'],
+    '.lz4': ['lz4', '-q', '-d', '-c'],
+    '.gz': ['gzip', '-d', '-c'],
+    '.xz': ['xz', '-d', '-c'],
+}
+ARTIFACT_PATTERN = re.compile(r'^\.backup(\.tar)?(\.zst|\.lz4|\.gz|\.xz)?\.gpg$')
+
+TABLES_QUERY = """
+    SELECT n.nspname, c.relname, pg_total_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p')
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg_toast%';
+"""
+
+log_message = bp.log_message
+
+def start_scratch_cluster(base_dir, port):
+    """Crear y arrancar un cluster temporal (initdb + pg_ctl) accesible solo por socket Unix"""
+    root = tempfile.mkdtemp(prefix='verify_cluster_', dir=base_dir)
+    data_dir = os.path.join(root, 'data')
+    try:
+        subprocess.run([INITDB_PATH, '-D', data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        # Durabilidad desactivada: el cluster se descarta al terminar
+        options = (f"-p {port} -k {root} -c listen_addresses='' -c fsync=off "
+                   f"-c full_page_writes=off -c synchronous_commit=off -c max_wal_size=4GB")
+        subprocess.run([PG_CTL_PATH, '-D', data_dir, '-o', options, '-l', os.path.join(root, 'postgres.log'), '-w', 'start'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    except Exception:
+        shutil.rmtree(root, ignore_errors=True)
+        raise
+    # El host es el directorio del socket
+    return {'host': root, 'port': port, 'user': 'postgres', 'data_dir': data_dir}
+
+def stop_scratch_cluster(target, keep=False):
+    """Detener el cluster temporal y eliminar sus archivos (salvo keep)"""
+    subprocess.run([PG_CTL_PATH, '-D', target['data_dir'], '-m', 'fast', '-w', 'stop'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if keep:
+        log_message(f"INFO - Cluster de verificación conservado en {target['host']}")
+    else:
+        shutil.rmtree(target['host'], ignore_errors=True)
+
+def connect_scratch(target, dbname):
+    return psycopg2.connect(host=target['host'], port=target['port'], user=target['user'], dbname=dbname)
+
+def get_databases_to_verify(sample, databases=None):
+    """Bases de datos con backup exitoso; primero las nunca verificadas y después las verificadas hace más tiempo"""
+    with bp.control_connection() as conn, conn.cursor() as cur:
+        if databases:
+            cur.execute("SELECT datname FROM backup_dbs WHERE datname = ANY(%s) ORDER BY datname;", (databases,))
+        else:
+            cur.execute("""
+                SELECT datname FROM backup_dbs
+                WHERE last_success_date IS NOT NULL
+                ORDER BY last_verify_date NULLS FIRST, random()
+                LIMIT %s;
+            """, (sample,))
+        return [row[0] for row in cur.fetchall()]
+
+def update_verify_status(db, status, verify_seconds, restore_bytes_per_sec):
+    """Guardar el resultado de la verificación en backup_dbs"""
+    try:
+        with bp.control_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE backup_dbs
+                SET verify_status = %s,
+                    last_verify_date = CURRENT_TIMESTAMP,
+                    verify_seconds = %s,
+                    restore_bytes_per_sec = %s
+                WHERE datname = %s;
+            """, (status, verify_seconds, restore_bytes_per_sec, db))
+    except Exception as e:
+        log_message(f"ERROR - Al actualizar el estado de verificación para {db}: {e}")
+
+def find_latest_artifact(db):
+    """Último artefacto de una base de datos: ('manifest', ruta) o ('file', ruta); None si no hay
+
+    Se parte del índice, pero antes se quitan las entradas cuyo archivo ya no existe y se
+    registran los artefactos de la base de datos más recientes que su última entrada que no
+    llegaron al índice. Ambos casos se avisan en el log: sin ellos se verificaría en silencio
+    un backup anterior al último.
+    """
+    bp.ensure_backup_index()
+    dropped = backup_index.drop_missing(db, bp.BACKUP_INDEX_PATH)
+    if dropped:
+        log_message(f"WARNING - El índice apuntaba a backups de [{db}] que ya no existen: {dropped}")
+    latest = backup_index.latest_artifact(db, bp.BACKUP_INDEX_PATH)
+    since = datetime.fromisoformat(latest['created_at']) if latest else None
+    added = backup_index.index_unindexed(backup_index.scan_artifacts(bp.BACKUP_DIR, bp.BACKUP_STORE_DIR, db, since=since),
+                                         index_path=bp.BACKUP_INDEX_PATH)
+    if added:
+        log_message(f"WARNING - Backups de [{db}] que no estaban en el índice: {[artifact['path'] for artifact in added]}")
+        latest = backup_index.latest_artifact(db, bp.BACKUP_INDEX_PATH)
+    return (latest['kind'], latest['path']) if latest else None
+
+def decrypt_artifact(db, kind, path, work_dir):
+    """Descifrar (y descomprimir) el artefacto en work_dir; devuelve la ruta que recibe pg_restore"""
+    if kind == 'manifest':
+        archive = os.path.join(work_dir, 'archive')
+        with open(archive, 'wb') as output:
+            manifest = backup_store.restore_manifest(bp.BACKUP_STORE_DIR, path, output, bp.BACKUP_STORE_KEY.encode())
+        if manifest['format'] != 'directory-tar':
+            return archive
+        dump_dir = os.path.join(work_dir, 'dump')
+        os.makedirs(dump_dir)
+        subprocess.run(['tar', '-C', dump_dir, '-xf', archive], stderr=subprocess.PIPE, check=True)
+        os.remove(archive)
+        return dump_dir
+
+    match = ARTIFACT_PATTERN.match(os.path.basename(path)[len(db):])
+    commands = [['gpg', '--batch', '--quiet', '--decrypt', path]]
+    if match.group(2):
+        commands.append(DECOMPRESSION_COMMANDS[match.group(2)])
+    if not match.group(1):
+        archive = os.path.join(work_dir, 'archive')
+        bp.run_pipeline(commands, archive)
+        return archive
+    dump_dir = os.path.join(work_dir, 'dump')
+    os.makedirs(dump_dir)
+    bp.run_pipeline(commands + [['tar', '-C', dump_dir, '-xf', '-']], os.devnull)
+    return dump_dir
+
+def get_source_tables(db):
+    """{(esquema, tabla): (filas estimadas, bytes)} de la base de datos de origen"""
+    conn = core.connect(db, user=bp.DB_BUSER, password=bp.DB_BPASSWORD)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT n.nspname, c.relname, greatest(coalesce(s.n_live_tup, c.reltuples::bigint), 0),
+                       pg_total_relation_size(c.oid)
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE c.relkind IN ('r', 'p')
+                AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                AND n.nspname NOT LIKE 'pg_toast%';
+            """)
+            return {(schema, table): (rows, size) for schema, table, rows, size in cur.fetchall()}
+    finally:
+        conn.close()
+
+def get_restored_tables(target, dbname):
+    """{(esquema, tabla): (filas exactas, bytes)} de la base de datos restaurada"""
+    conn = connect_scratch(target, dbname)
+    try:
+        tables = {}
+        with conn.cursor() as cur:
+            cur.execute(TABLES_QUERY)
+            for schema, table, size in cur.fetchall():
+                cur.execute(sql.SQL("SELECT count(*) FROM ONLY {}.{};").format(sql.Identifier(schema), sql.Identifier(table)))
+                tables[(schema, table)] = (cur.fetchone()[0], size)
+        return tables
+    finally:
+        conn.close()
+
+def compare_tables(source, restored):
+    """Lista de diferencias entre origen y restauración (vacía si la verificación es correcta)"""
+    problems = []
+    for key in sorted(source.keys() - restored.keys()):
+        problems.append(f"falta la tabla {key[0]}.{key[1]}")
+    for key in sorted(source.keys() & restored.keys()):
+        (expected, source_size), (restored_rows, restored_size) = source[key], restored[key]
+        if abs(restored_rows - expected) > max(VERIFY_ROW_TOLERANCE * expected, 100):
+            problems.append(f"{key[0]}.{key[1]}: {restored_rows} filas restauradas, ~{expected} en origen")
+        if abs(restored_size - source_size) > max(VERIFY_SIZE_TOLERANCE * source_size, VERIFY_SIZE_MIN_BYTES):
+            problems.append(f"{key[0]}.{key[1]}: {restored_size} bytes restaurados, {source_size} en origen")
+    return problems
+
+def recreate_database(target, dbname):
+    conn = connect_scratch(target, 'postgres')
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(dbname)))
+            cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(dbname)))
+    finally:
+        conn.close()
+
+def drop_database(target, dbname):
+    try:
+        conn = connect_scratch(target, 'postgres')
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(dbname)))
+        finally:
+            conn.close()
+    except Exception as e:
+        log_message(f"ERROR - Al eliminar la base de datos de verificación {dbname}: {e}")
+
+def verify_database(db, target, jobs):
+    """Restaurar y comprobar el último backup de una base de datos. Devuelve el resumen del resultado"""
+    result = {'datname': db, 'status': 'FAILED', 'verify_seconds': 0.0, 'decrypt_seconds': 0.0,
+              'restore_seconds': 0.0, 'restored_bytes': 0, 'restore_bytes_per_sec': None}
+    start = time.monotonic()
+    # Los nombres de base de datos admiten hasta 63 bytes
+    restore_db = f"verify_{db}".encode()[:63].decode(errors='ignore')
+    work_dir = tempfile.mkdtemp(prefix='verify_', dir=VERIFY_SCRATCH_DIR)
+    try:
+        artifact = find_latest_artifact(db)
+        if not artifact:
+            log_message(f"ERROR - No se encontró ningún backup para verificar la DB: [{db}]")
+            return result
+        kind, path = artifact
+
+        archive = decrypt_artifact(db, kind, path, work_dir)
+        result['decrypt_seconds'] = time.monotonic() - start
+
+        recreate_database(target, restore_db)
+        restore_start = time.monotonic()
+        subprocess.run([PG_RESTORE_PATH, '-h', target['host'], '-p', str(target['port']), '-U', target['user'],
+                        '-d', restore_db, '-j', str(jobs), '--no-owner', '--no-privileges', archive],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        result['restore_seconds'] = time.monotonic() - restore_start
+
+        conn = connect_scratch(target, restore_db)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_database_size(current_database());")
+                result['restored_bytes'] = cur.fetchone()[0]
+        finally:
+            conn.close()
+        if result['restore_seconds'] > 0:
+            result['restore_bytes_per_sec'] = result['restored_bytes'] / result['restore_seconds']
+
+        problems = compare_tables(get_source_tables(db), get_restored_tables(target, restore_db))
+        result['status'] = 'MISMATCH' if problems else 'VERIFIED'
+        for problem in problems:
+            log_message(f"ERROR - Verificación DB: [{db}] {problem}")
+    except subprocess.CalledProcessError as e:
+        log_message(f"ERROR - Al verificar el backup de la base de datos {db}: {bp.process_error_message(e)}")
+    except Exception as e:
+        log_message(f"ERROR - verify_database - Al verificar el backup de la base de datos {db}: {e}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        drop_database(target, restore_db)
+        result['verify_seconds'] = time.monotonic() - start
+    update_verify_status(db, result['status'], result['verify_seconds'], result['restore_bytes_per_sec'])
+    return result
+
+def log_result(result):
+    throughput = result['restore_bytes_per_sec']
+    throughput_text = f"{throughput / 1024 ** 2:.1f} MB/s" if throughput else "n/d"
+    log_message(f"{'INFO' if result['status'] == 'VERIFIED' else 'ERROR'} - Verificación DB: [{result['datname']}] "
+                f"{result['status']} en {result['verify_seconds']:.1f} s (descifrado {result['decrypt_seconds']:.1f} s, "
+                f"pg_restore {result['restore_seconds']:.1f} s, {result['restored_bytes']} bytes, {throughput_text})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Restaurar y verificar una muestra de los últimos backups")
+    parser.add_argument('--sample', type=int, default=VERIFY_SAMPLE, help="Bases de datos a verificar")
+    parser.add_argument('--db', action='append', help="Verificar esta base de datos (se puede repetir)")
+    parser.add_argument('--jobs', type=int, default=VERIFY_JOBS, help="Jobs de pg_restore")
+    parser.add_argument('--keep-cluster', action='store_true', help="No eliminar el cluster temporal al terminar")
+    args = parser.parse_args()
+
+    databases = get_databases_to_verify(args.sample, args.db)
+    if not databases:
+        log_message("INFO - No se encontraron backups para verificar.")
+        return
+
+    if VERIFY_PGHOST:
+        target = {'host': VERIFY_PGHOST, 'port': VERIFY_PORT, 'user': VERIFY_PGUSER}
+    else:
+        target = start_scratch_cluster(VERIFY_SCRATCH_DIR, VERIFY_PORT)
+    log_message(f"INFO - Verificando backups de {databases} con pg_restore -j {args.jobs}")
+
+    results = []
+    try:
+        for db in databases:
+            with core.job_context(datname=db):
+                result = verify_database(db, target, args.jobs)
+            log_result(result)
+            results.append(result)
+    finally:
+        if not VERIFY_PGHOST:
+            stop_scratch_cluster(target, keep=args.keep_cluster)
+        bp.close_control_pool()
+
+    restored_bytes = sum(r['restored_bytes'] for r in results)
+    restore_seconds = sum(r['restore_seconds'] for r in results)
+    failed = [r['datname'] for r in results if r['status'] != 'VERIFIED']
+    if restore_seconds > 0:
+        log_message(f"INFO - Throughput de restauración: {restored_bytes / 1024 ** 2 / restore_seconds:.1f} MB/s "
+                    f"({restored_bytes} bytes en {restore_seconds:.1f} s)")
+    if failed:
+        log_message(f"ERROR - Backups que no superaron la verificación: {failed}")
+    log_message("---")
+    print(f"Verificación completada: {len(results) - len(failed)}/{len(results)} correctas. Detalles en el archivo {bp.LOG_FILE}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        log_message(f"ERROR - Error inesperado: {e}")
+        print(f"Error inesperado: {e}. Revisa el log para más detalles.")